@@ -8,20 +8,108 @@
 增加了循环步骤的上移下移功能
 """
 
+import os
+import queue
 import sys
-import traceback
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, scrolledtext
-import json
 from datetime import datetime
-import re
 
-# 可选导入pandas
-try:
-    import pandas as pd
-    PANDAS_AVAILABLE = True
-except ImportError:
-    PANDAS_AVAILABLE = False
+from liquid_widgets import VirtualListView
+from liquid_ir import fold_repeated_steps
+from liquid_composite import composite_error, legacy_needle_motion
+from liquid_core import (
+    STEP_TYPES, LOOP_STEP_TYPES, VALVE_OPTIONS, PUMP_OPTIONS, MOTOR_OPTIONS, MOTOR_COMMANDS,
+    CodeGenerator, Process, Step, StepCodeCache, get_step_description
+)
+
+def show_widgets(shown, hidden):
+    """显示一组已布局的控件并隐藏另一组 (grid_remove 保留布局参数, 不销毁控件)"""
+    for widget in hidden:
+        widget.grid_remove()
+    for widget in shown:
+        widget.grid()
+
+
+class PreviewWorker:
+    """后台线程生成代码预览
+
+    连续的刷新请求在 delay_ms 内合并为一次; 新请求到来时置位旧任务的取消标志,
+    过期任务不再返回结果。生成在工作线程中进行, 结果经队列由 after() 轮询交回主线程显示。
+    """
+    
+    def __init__(self, root, render, apply, delay_ms=80, poll_ms=15):
+        self.root = root
+        self.render = render    # 工作线程中调用: render(*args, cancel) -> 结果或None
+        self.apply = apply      # 主线程中调用: apply(结果)
+        self.delay_ms = delay_ms
+        self.poll_ms = poll_ms
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._snapshot = None
+        self._cancel = threading.Event()
+        self._serial = 0        # 最新提交的任务序号
+        self._done_serial = 0   # 已处理完的任务序号
+        self._after_id = None
+        self._poll_id = None
+        threading.Thread(target=self._run, name="preview-worker", daemon=True).start()
+        
+    def schedule(self, snapshot):
+        """请求刷新; snapshot在主线程中调用, 返回传给render的参数"""
+        self._snapshot = snapshot
+        self._cancel.set()
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+        self._after_id = self.root.after(self.delay_ms, self._submit)
+        
+    def cancel(self):
+        """取消尚未显示的刷新"""
+        self._cancel.set()
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        self._done_serial = self._serial
+        
+    def _submit(self):
+        self._after_id = None
+        self._serial += 1
+        self._cancel = threading.Event()
+        self._jobs.put((self._serial, self._cancel, self._snapshot()))
+        if self._poll_id is None:
+            self._poll_id = self.root.after(self.poll_ms, self._poll)
+            
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            # 只处理最新的任务
+            while not self._jobs.empty():
+                job = self._jobs.get_nowait()
+            serial, cancel, args = job
+            if cancel.is_set():
+                continue
+            try:
+                result = self.render(*args, cancel)
+            except Exception:
+                # 步骤参数错误等异常只丢弃本次预览, 工作线程继续处理之后的请求
+                import traceback
+                traceback.print_exc()
+                result = None
+            if not cancel.is_set():
+                self._results.put((serial, result))
+                
+    def _poll(self):
+        self._poll_id = None
+        latest = None
+        while not self._results.empty():
+            latest = self._results.get_nowait()
+        if latest is not None and latest[0] == self._serial and self._done_serial < self._serial:
+            self._done_serial = latest[0]
+            if latest[1] is not None:
+                self.apply(latest[1])
+        if self._done_serial < self._serial:
+            self._poll_id = self.root.after(self.poll_ms, self._poll)
+
 
 class LiquidProcessGenerator:
     def __init__(self, root):
@@ -29,56 +117,31 @@ class LiquidProcessGenerator:
         self.root.title("液路流程配置与C/Lua代码生成工具 - 增强版")
         self.root.geometry("1500x950")
         
-        # 流程数据
+        # 流程数据 (Step列表)
         self.steps_data = []
         
         # 输出类型
         self.output_type = tk.StringVar(value="C")
+        self.optimize_var = tk.BooleanVar(value=False)
+        self.overlap_var = tk.BooleanVar(value=False)
+        self.group_waits_var = tk.BooleanVar(value=False)
+        self.switch_masks_var = tk.BooleanVar(value=False)
+        self.deadline_delays_var = tk.BooleanVar(value=False)
+        
+        # 代码生成后端 (无界面核心, 见liquid_core)
+        self.generator = CodeGenerator()
+        self.step_code_cache = StepCodeCache(self.generator)
+        self.preview_rendered = None  # 当前预览对应的分段生成结果
+        self.preview_worker = PreviewWorker(self.root, self.render_code_preview, self.apply_code_preview)
         
         # 设备配置映射
-        self.device_mapping = {
-            # 阀门
-            "SV1": "VALVE_SV1", "SV2": "VALVE_SV2", "SV3": "VALVE_SV3",
-            "SV4": "VALVE_SV4", "SV5": "VALVE_SV5", "SV6": "VALVE_SV6",
-            "SV7": "VALVE_SV7", "SV8": "VALVE_SV8", "SV9": "VALVE_SV9",
-            "SV10": "VALVE_SV10", "SV11": "VALVE_SV11", "SV12": "VALVE_SV12",
-            # 隔膜泵
-            "隔膜泵Q1": "DIAPHRAGM_PUMP_Q1", "隔膜泵Q2": "DIAPHRAGM_PUMP_Q2",
-            "隔膜泵Q3": "DIAPHRAGM_PUMP_Q3", "隔膜泵Q4": "DIAPHRAGM_PUMP_Q4",
-            "隔膜泵F1": "DIAPHRAGM_PUMP_F1", "隔膜泵F2": "DIAPHRAGM_PUMP_F2",
-            "隔膜泵F3": "DIAPHRAGM_PUMP_F3", "隔膜泵F4": "DIAPHRAGM_PUMP_F4",
-            # 电机
-            "样本针柱塞泵": "MOTOR_NEEDLE_S_PUMP", "试剂针柱塞泵": "MOTOR_NEEDLE_R2_PUMP",
-            "特殊清洗液泵": "MOTOR_CLEARER_PUMP", "样本针X轴": "MOTOR_NEEDLE_S_X",
-            "样本针Y轴": "MOTOR_NEEDLE_S_Y", "样本针Z轴": "MOTOR_NEEDLE_S_Z",
-            "试剂针Y轴": "MOTOR_NEEDLE_R2_Y", "试剂针Z轴": "MOTOR_NEEDLE_R2_Z",
-        }
+        self.device_mapping = self.generator.device_mapping
         
         # Lua设备映射 (简化的Lua接口)
-        self.lua_device_mapping = {
-            # 阀门 - 使用Lua风格的命名
-            "SV1": "valve.sv1", "SV2": "valve.sv2", "SV3": "valve.sv3",
-            "SV4": "valve.sv4", "SV5": "valve.sv5", "SV6": "valve.sv6",
-            "SV7": "valve.sv7", "SV8": "valve.sv8", "SV9": "valve.sv9",
-            "SV10": "valve.sv10", "SV11": "valve.sv11", "SV12": "valve.sv12",
-            # 泵
-            "隔膜泵Q1": "pump.q1", "隔膜泵Q2": "pump.q2",
-            "隔膜泵Q3": "pump.q3", "隔膜泵Q4": "pump.q4",
-            "隔膜泵F1": "pump.f1", "隔膜泵F2": "pump.f2",
-            "隔膜泵F3": "pump.f3", "隔膜泵F4": "pump.f4",
-            # 电机
-            "样本针柱塞泵": "motor.needle_s_pump", "试剂针柱塞泵": "motor.needle_r2_pump",
-            "特殊清洗液泵": "motor.clearer_pump", "样本针X轴": "motor.needle_s_x",
-            "样本针Y轴": "motor.needle_s_y", "样本针Z轴": "motor.needle_s_z",
-            "试剂针Y轴": "motor.needle_r2_y", "试剂针Z轴": "motor.needle_r2_z",
-        }
+        self.lua_device_mapping = self.generator.lua_device_mapping
         
         # 电机选项列表 - 统一定义
-        self.motor_options = [
-            "样本针柱塞泵", "试剂针柱塞泵", "特殊清洗液泵",
-            "样本针X轴", "样本针Y轴", "样本针Z轴", 
-            "试剂针Y轴", "试剂针Z轴"
-        ]
+        self.motor_options = MOTOR_OPTIONS
         
         self.setup_ui()
         print("液路流程配置工具初始化完成 - 已增加Lua脚本支持")
@@ -115,6 +178,16 @@ class LiquidProcessGenerator:
                        value="C", command=self.on_output_type_changed).pack(side=tk.LEFT, padx=10)
         ttk.Radiobutton(output_frame, text="Lua脚本", variable=self.output_type, 
                        value="Lua", command=self.on_output_type_changed).pack(side=tk.LEFT, padx=10)
+        ttk.Checkbutton(output_frame, text="优化代码", variable=self.optimize_var,
+                        command=self.on_optimize_changed).pack(side=tk.LEFT, padx=10)
+        ttk.Checkbutton(output_frame, text="电机并行", variable=self.overlap_var,
+                        command=self.on_optimize_changed).pack(side=tk.LEFT, padx=10)
+        ttk.Checkbutton(output_frame, text="合并等待", variable=self.group_waits_var,
+                        command=self.on_optimize_changed).pack(side=tk.LEFT, padx=10)
+        ttk.Checkbutton(output_frame, text="批量开关", variable=self.switch_masks_var,
+                        command=self.on_optimize_changed).pack(side=tk.LEFT, padx=10)
+        ttk.Checkbutton(output_frame, text="截止延时", variable=self.deadline_delays_var,
+                        command=self.on_optimize_changed).pack(side=tk.LEFT, padx=10)
         
         # 步骤配置
         steps_frame = ttk.LabelFrame(control_frame, text="步骤配置", padding="10")
@@ -126,24 +199,23 @@ class LiquidProcessGenerator:
         ttk.Label(steps_frame, text="步骤类型:").grid(row=0, column=0, sticky=tk.W, pady=5)
         self.step_type_var = tk.StringVar()
         
-        ALL_STEP_TYPES = [
-            "阀门控制", "泵控制", "延时", "电机控制", "电机等待", "循环", "复合动作"
-        ]
-        
         step_type_combo = ttk.Combobox(
             steps_frame, 
             textvariable=self.step_type_var,
-            values=ALL_STEP_TYPES,
+            values=STEP_TYPES,
             state="readonly",
             width=20
         )
         step_type_combo.grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5)
         step_type_combo.bind('<<ComboboxSelected>>', self.on_step_type_changed)
         
-        # 参数配置区域
-        self.param_frame = ttk.Frame(steps_frame)
-        self.param_frame.grid(row=1, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=10)
-        self.param_frame.columnconfigure(1, weight=1)
+        # 参数配置区域: 各步骤类型的参数面板在第一次选择时创建, 之后切换时只显示/隐藏
+        self.param_area = ttk.Frame(steps_frame)
+        self.param_area.grid(row=1, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=10)
+        self.param_area.columnconfigure(0, weight=1)
+        self.param_area.rowconfigure(0, weight=1)
+        self.param_panels = {}
+        self.param_frame = None  # 当前显示的参数面板
         
         # 步骤操作按钮
         button_frame = ttk.Frame(steps_frame)
@@ -159,21 +231,21 @@ class LiquidProcessGenerator:
         list_frame.rowconfigure(0, weight=1)
         steps_frame.rowconfigure(3, weight=1)
         
-        self.steps_listbox = tk.Listbox(list_frame, height=8)
+        # 虚拟列表: 只绘制可见行, 步骤很多时滚动和刷新依然流畅
+        self.steps_listbox = VirtualListView(list_frame, lambda: len(self.steps_data),
+                                             lambda i: self.step_row_text(self.steps_data, i), height=8)
         self.steps_listbox.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
-        scrollbar = ttk.Scrollbar(list_frame, orient=tk.VERTICAL, command=self.steps_listbox.yview)
-        scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
-        self.steps_listbox.configure(yscrollcommand=scrollbar.set)
         
         # 主要操作按钮
         main_button_frame = ttk.Frame(control_frame)
         main_button_frame.grid(row=4, column=0, columnspan=2, pady=10)
         
-        if PANDAS_AVAILABLE:
-            ttk.Button(main_button_frame, text="导入Excel", command=self.import_excel).pack(side=tk.LEFT, padx=5)
+        ttk.Button(main_button_frame, text="导入表格", command=self.import_excel).pack(side=tk.LEFT, padx=5)
         ttk.Button(main_button_frame, text="保存流程", command=self.save_process).pack(side=tk.LEFT, padx=5)
         ttk.Button(main_button_frame, text="加载流程", command=self.load_process).pack(side=tk.LEFT, padx=5)
         ttk.Button(main_button_frame, text="生成代码", command=self.generate_code).pack(side=tk.LEFT, padx=5)
+        ttk.Button(main_button_frame, text="估算时长", command=self.estimate_duration).pack(side=tk.LEFT, padx=5)
+        ttk.Button(main_button_frame, text="折叠重复", command=self.fold_repeats).pack(side=tk.LEFT, padx=5)
         
         # 右侧代码预览
         preview_frame = ttk.LabelFrame(main_frame, text="代码预览", padding="10")
@@ -197,6 +269,15 @@ class LiquidProcessGenerator:
         """输出类型改变时更新预览"""
         self.update_code_preview()
         
+    def on_optimize_changed(self):
+        """切换生成代码优化 (合并延时、删除冗余步骤等)、电机并行调度、等待合并、批量开关或截止时间延时时更新预览"""
+        self.generator.optimize = self.optimize_var.get()
+        self.generator.overlap = self.overlap_var.get()
+        self.generator.group_waits = self.group_waits_var.get()
+        self.generator.switch_masks = self.switch_masks_var.get()
+        self.generator.deadline_delays = self.deadline_delays_var.get()
+        self.update_code_preview()
+        
     def show_initial_code(self):
         """显示初始代码"""
         if self.output_type.get() == "C":
@@ -234,38 +315,42 @@ end
         
         self.code_preview.delete(1.0, tk.END)
         self.code_preview.insert(tk.END, initial_code)
+        self.code_preview.edit_modified(False)
+        self.preview_rendered = None
         
     def on_step_type_changed(self, event=None):
         step_type = self.step_type_var.get()
         print(f"选择步骤类型: '{step_type}'")
         
-        # 清空参数区域
-        for widget in self.param_frame.winfo_children():
-            widget.destroy()
-            
-        if step_type == "阀门控制":
-            self.setup_valve_params()
-        elif step_type == "泵控制":
-            self.setup_pump_params()
-        elif step_type == "延时":
-            self.setup_delay_params()
-        elif step_type == "电机控制":
-            self.setup_motor_params()
-        elif step_type == "电机等待":
-            self.setup_motor_wait_params()
-        elif step_type == "循环":
-            self.setup_loop_params()
-        elif step_type == "复合动作":
-            self.setup_complex_params()
-            
-        self.param_frame.update_idletasks()
+        setup = {
+            "阀门控制": self.setup_valve_params,
+            "泵控制": self.setup_pump_params,
+            "延时": self.setup_delay_params,
+            "电机控制": self.setup_motor_params,
+            "电机等待": self.setup_motor_wait_params,
+            "循环": self.setup_loop_params,
+            "复合动作": self.setup_complex_params,
+        }.get(step_type)
+        if setup is None:
+            return
+        
+        if self.param_frame is not None:
+            self.param_frame.grid_remove()
+        panel = self.param_panels.get(step_type)
+        if panel is None:
+            panel = self.param_panels[step_type] = ttk.Frame(self.param_area)
+            panel.columnconfigure(1, weight=1)
+            self.param_frame = panel
+            setup()
+        self.param_frame = panel
+        panel.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        panel.update_idletasks()
         
     def setup_valve_params(self):
         ttk.Label(self.param_frame, text="阀门:").grid(row=0, column=0, sticky=tk.W, pady=5)
         self.valve_var = tk.StringVar()
         ttk.Combobox(self.param_frame, textvariable=self.valve_var,
-                    values=["SV1", "SV2", "SV3", "SV4", "SV5", "SV6", 
-                           "SV7", "SV8", "SV9", "SV10", "SV11", "SV12"]).grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5)
+                    values=VALVE_OPTIONS).grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5)
         
         ttk.Label(self.param_frame, text="操作:").grid(row=1, column=0, sticky=tk.W, pady=5)
         self.valve_action_var = tk.StringVar(value="开")
@@ -276,8 +361,7 @@ end
         ttk.Label(self.param_frame, text="泵:").grid(row=0, column=0, sticky=tk.W, pady=5)
         self.pump_var = tk.StringVar()
         ttk.Combobox(self.param_frame, textvariable=self.pump_var,
-                    values=["隔膜泵Q1", "隔膜泵Q2", "隔膜泵Q3", "隔膜泵Q4",
-                           "隔膜泵F1", "隔膜泵F2", "隔膜泵F3", "隔膜泵F4"]).grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5)
+                    values=PUMP_OPTIONS).grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5)
         
         ttk.Label(self.param_frame, text="操作:").grid(row=1, column=0, sticky=tk.W, pady=5)
         self.pump_action_var = tk.StringVar(value="开")
@@ -305,7 +389,7 @@ end
         ttk.Label(self.param_frame, text="命令:").grid(row=1, column=0, sticky=tk.W, pady=5)
         self.motor_cmd_var = tk.StringVar(value="复位")
         ttk.Combobox(self.param_frame, textvariable=self.motor_cmd_var,
-                    values=["复位", "步进移动", "速度移动", "停止"], state="readonly").grid(row=1, column=1, sticky=(tk.W, tk.E), pady=5)
+                    values=MOTOR_COMMANDS, state="readonly").grid(row=1, column=1, sticky=(tk.W, tk.E), pady=5)
         
         # 运行模式
         ttk.Label(self.param_frame, text="运行模式:", foreground="red").grid(row=2, column=0, sticky=tk.W, pady=5)
@@ -322,36 +406,31 @@ end
             ttk.Entry(self.param_frame, textvariable=var).grid(row=3+i, column=1, sticky=(tk.W, tk.E), pady=5)
             setattr(self, f"motor_param{i+1}_var", var)
         
-        # 初始化模式相关变量
+        # 同步/异步模式的控件都创建在第6行, 切换模式时只显示其中一组
         self.motor_timeout_var = tk.StringVar(value="20000")
         self.motor_wait_var = tk.BooleanVar(value=True)
+        timeout_label = ttk.Label(self.param_frame, text="超时时间(ms):", foreground="green")
+        timeout_label.grid(row=6, column=0, sticky=tk.W, pady=5)
+        timeout_entry = ttk.Entry(self.param_frame, textvariable=self.motor_timeout_var)
+        timeout_entry.grid(row=6, column=1, sticky=(tk.W, tk.E), pady=5)
+        self.motor_sync_widgets = [timeout_label, timeout_entry]
+        
+        wait_label = ttk.Label(self.param_frame, text="立即等待完成:", foreground="orange")
+        wait_label.grid(row=6, column=0, sticky=tk.W, pady=5)
+        wait_frame = ttk.Frame(self.param_frame)
+        wait_frame.grid(row=6, column=1, sticky=tk.W, pady=5)
+        ttk.Checkbutton(wait_frame, variable=self.motor_wait_var, text="是").pack(side=tk.LEFT)
+        ttk.Label(wait_frame, text="(否=需后续添加'电机等待')", foreground="gray").pack(side=tk.LEFT, padx=(10, 0))
+        self.motor_async_widgets = [wait_label, wait_frame]
         
         # 显示默认模式控件
         self.on_motor_mode_changed()
         
     def on_motor_mode_changed(self, event=None):
-        mode = self.motor_mode_var.get() if hasattr(self, 'motor_mode_var') else "异步"
-        
-        # 清理动态控件
-        for attr in ['timeout_label', 'timeout_entry', 'wait_label', 'wait_check']:
-            if hasattr(self, attr):
-                getattr(self, attr).destroy()
-                delattr(self, attr)
-        
-        if mode == "同步":
-            self.timeout_label = ttk.Label(self.param_frame, text="超时时间(ms):", foreground="green")
-            self.timeout_label.grid(row=6, column=0, sticky=tk.W, pady=5)
-            self.timeout_entry = ttk.Entry(self.param_frame, textvariable=self.motor_timeout_var)
-            self.timeout_entry.grid(row=6, column=1, sticky=(tk.W, tk.E), pady=5)
-        elif mode == "异步":
-            self.wait_label = ttk.Label(self.param_frame, text="立即等待完成:", foreground="orange")
-            self.wait_label.grid(row=6, column=0, sticky=tk.W, pady=5)
-            
-            wait_frame = ttk.Frame(self.param_frame)
-            wait_frame.grid(row=6, column=1, sticky=tk.W, pady=5)
-            self.wait_check = ttk.Checkbutton(wait_frame, variable=self.motor_wait_var, text="是")
-            self.wait_check.pack(side=tk.LEFT)
-            ttk.Label(wait_frame, text="(否=需后续添加'电机等待')", foreground="gray").pack(side=tk.LEFT, padx=(10, 0))
+        if self.motor_mode_var.get() == "同步":
+            show_widgets(self.motor_sync_widgets, self.motor_async_widgets)
+        else:
+            show_widgets(self.motor_async_widgets, self.motor_sync_widgets)
         
     def setup_motor_wait_params(self):
         ttk.Label(self.param_frame, text="等待电机:").grid(row=0, column=0, sticky=tk.W, pady=5)
@@ -370,6 +449,9 @@ end
         ttk.Label(self.param_frame, text="复合动作描述:").grid(row=0, column=0, sticky=(tk.W, tk.N), pady=5)
         self.complex_desc_text = tk.Text(self.param_frame, height=4)
         self.complex_desc_text.grid(row=0, column=1, sticky=(tk.W, tk.E), pady=5)
+        ttk.Label(self.param_frame, text="每行一条: 移动/启动 电机 距离 [速度 值] [加速度 值]、复位 电机、等待 电机 [超时 值]、\n"
+                  "延时 500ms、阀门 SV1 开、泵 隔膜泵Q1 关、重复 3 { ... }、并行 { ... }",
+                  foreground="gray").grid(row=1, column=0, columnspan=2, sticky=tk.W, pady=5)
          
     def setup_loop_params(self):
         """设置循环参数界面 - 包含完整的上移下移功能，优化布局"""
@@ -412,7 +494,7 @@ end
         ttk.Label(type_frame, text="步骤类型:").pack(side=tk.LEFT, padx=(0, 10))
         self.loop_step_type_var = tk.StringVar()
         loop_step_combo = ttk.Combobox(type_frame, textvariable=self.loop_step_type_var,
-                                     values=["阀门控制", "泵控制", "延时", "电机控制", "电机等待"],
+                                     values=LOOP_STEP_TYPES,
                                      state="readonly", width=15)
         loop_step_combo.pack(side=tk.LEFT)
         loop_step_combo.bind('<<ComboboxSelected>>', self.on_loop_step_type_changed)
@@ -420,6 +502,8 @@ end
         # 循环步骤参数区域
         self.loop_param_frame = ttk.Frame(scrollable_frame)
         self.loop_param_frame.pack(fill=tk.X, padx=5, pady=10)
+        self.loop_param_panels = {}
+        self.loop_param_panel = None  # 当前显示的循环步骤参数面板
         
         # 操作按钮区域 - 在scrollable_frame的底部
         button_container = ttk.Frame(scrollable_frame)
@@ -441,13 +525,17 @@ end
         btn_row2.pack(pady=2)
         ttk.Button(btn_row2, text="↑ 上移", command=self.move_loop_step_up, width=12).pack(side=tk.LEFT, padx=3)
         ttk.Button(btn_row2, text="↓ 下移", command=self.move_loop_step_down, width=12).pack(side=tk.LEFT, padx=3)
+        ttk.Button(btn_row2, text="完成内层循环", command=self.finish_inner_loop, width=12).pack(side=tk.LEFT, padx=3)
         
         # 循环步骤列表 - 在scrollable_frame的最底部
         list_container = ttk.Frame(scrollable_frame)
         list_container.pack(fill=tk.X, padx=5, pady=10)
         
-        ttk.Label(list_container, text="当前循环步骤:", font=("Arial", 9, "bold")).pack(anchor=tk.W)
-        self.loop_steps_listbox = tk.Listbox(list_container, height=4, font=("Arial", 9))  # 减少高度
+        self.loop_list_label = ttk.Label(list_container, text="当前循环步骤:", font=("Arial", 9, "bold"))
+        self.loop_list_label.pack(anchor=tk.W)
+        self.loop_steps_listbox = VirtualListView(list_container, lambda: len(self.loop_steps_data),
+                                                  lambda i: self.step_row_text(self.loop_steps_data, i),
+                                                  height=4, font=("Arial", 9))  # 减少高度
         self.loop_steps_listbox.pack(fill=tk.X, pady=2)
         
         # 鼠标滚轮绑定
@@ -455,242 +543,135 @@ end
             canvas.yview_scroll(int(-1*(event.delta/120)), "units")
         canvas.bind_all("<MouseWheel>", _on_mousewheel)
         
-        # 初始化循环步骤数据
+        # 初始化循环步骤数据; loop_stack 保存正在编辑的内层循环之外各层的 (步骤列表, 循环次数)
         self.loop_steps_data = []
+        self.loop_stack = []
         
         # 说明文字 - 放在主param_frame的底部
         info_label = ttk.Label(self.param_frame, 
-                              text="循环功能: 重复执行步骤序列 | 使用↑↓调整顺序 | 内容区域可滚动", 
+                              text="循环功能: 重复执行步骤序列 | 可添加内层循环 | 使用↑↓调整顺序 | 内容区域可滚动", 
                               foreground="gray", font=("Arial", 8), justify=tk.CENTER)
         info_label.grid(row=2, column=0, columnspan=2, pady=5)
         
         print("循环参数界面创建完成 - 包含滚动功能和完整的5个操作按钮")
         
     def on_loop_step_type_changed(self, event=None):
-        """循环内步骤类型改变时的处理 - 优化布局"""
+        """循环内步骤类型改变时的处理: 各类型的参数面板第一次选择时创建, 之后只切换显示"""
         step_type = self.loop_step_type_var.get()
         print(f"循环步骤类型选择: {step_type}")
         
-        # 清空循环参数区域
-        for widget in self.loop_param_frame.winfo_children():
-            widget.destroy()
-            
-        if step_type == "阀门控制":
-            # 使用更紧凑的布局
-            row = 0
-            ttk.Label(self.loop_param_frame, text="阀门:").grid(row=row, column=0, sticky=tk.W, pady=2, padx=(0,5))
-            self.loop_valve_var = tk.StringVar()
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_valve_var,
-                        values=["SV1", "SV2", "SV3", "SV4", "SV5", "SV6", 
-                               "SV7", "SV8", "SV9", "SV10", "SV11", "SV12"], width=10).grid(row=row, column=1, sticky=tk.W, pady=2)
-            
-            row += 1
-            ttk.Label(self.loop_param_frame, text="操作:").grid(row=row, column=0, sticky=tk.W, pady=2, padx=(0,5))
-            self.loop_valve_action_var = tk.StringVar(value="开")
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_valve_action_var,
-                        values=["开", "关"], state="readonly", width=8).grid(row=row, column=1, sticky=tk.W, pady=2)
-            
-        elif step_type == "泵控制":
-            row = 0
-            ttk.Label(self.loop_param_frame, text="泵:").grid(row=row, column=0, sticky=tk.W, pady=2, padx=(0,5))
-            self.loop_pump_var = tk.StringVar()
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_pump_var,
-                        values=["隔膜泵Q1", "隔膜泵Q2", "隔膜泵Q3", "隔膜泵Q4",
-                               "隔膜泵F1", "隔膜泵F2", "隔膜泵F3", "隔膜泵F4"], width=12).grid(row=row, column=1, sticky=tk.W, pady=2)
-            
-            row += 1
-            ttk.Label(self.loop_param_frame, text="操作:").grid(row=row, column=0, sticky=tk.W, pady=2, padx=(0,5))
-            self.loop_pump_action_var = tk.StringVar(value="开")
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_pump_action_var,
-                        values=["开", "关"], state="readonly", width=8).grid(row=row, column=1, sticky=tk.W, pady=2)
-            
-        elif step_type == "延时":
-            row = 0
-            ttk.Label(self.loop_param_frame, text="延时:").grid(row=row, column=0, sticky=tk.W, pady=2, padx=(0,5))
-            self.loop_delay_time_var = tk.StringVar(value="100")
-            ttk.Entry(self.loop_param_frame, textvariable=self.loop_delay_time_var, width=10).grid(row=row, column=1, sticky=tk.W, pady=2)
-            
-            row += 1
-            ttk.Label(self.loop_param_frame, text="单位:").grid(row=row, column=0, sticky=tk.W, pady=2, padx=(0,5))
-            self.loop_delay_unit_var = tk.StringVar(value="ms")
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_delay_unit_var,
-                        values=["ms", "s"], state="readonly", width=8).grid(row=row, column=1, sticky=tk.W, pady=2)
-            
-        elif step_type == "电机控制":
-            # 电机控制使用更紧凑的布局
-            row = 0
-            ttk.Label(self.loop_param_frame, text="电机:").grid(row=row, column=0, sticky=tk.W, pady=1, padx=(0,5))
-            self.loop_motor_var = tk.StringVar()
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_motor_var,
-                        values=self.motor_options, width=12).grid(row=row, column=1, sticky=tk.W, pady=1)
-            
-            row += 1
-            ttk.Label(self.loop_param_frame, text="命令:").grid(row=row, column=0, sticky=tk.W, pady=1, padx=(0,5))
-            self.loop_motor_cmd_var = tk.StringVar(value="步进移动")
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_motor_cmd_var,
-                        values=["复位", "步进移动", "速度移动", "停止"], state="readonly", width=10).grid(row=row, column=1, sticky=tk.W, pady=1)
-            
-            row += 1
-            ttk.Label(self.loop_param_frame, text="模式:").grid(row=row, column=0, sticky=tk.W, pady=1, padx=(0,5))
-            self.loop_motor_mode_var = tk.StringVar(value="异步")
-            mode_combo = ttk.Combobox(self.loop_param_frame, textvariable=self.loop_motor_mode_var,
-                                    values=["异步", "同步"], state="readonly", width=8)
-            mode_combo.grid(row=row, column=1, sticky=tk.W, pady=1)
-            mode_combo.bind('<<ComboboxSelected>>', self.on_loop_motor_mode_changed)
-            
-            # 参数1-3 使用更紧凑的布局
-            for i, (param_name, default_val) in enumerate([("参数1:", "1800"), ("参数2:", "20000"), ("参数3:", "50000")]):
-                row += 1
-                ttk.Label(self.loop_param_frame, text=param_name).grid(row=row, column=0, sticky=tk.W, pady=1, padx=(0,5))
-                var = tk.StringVar(value=default_val)
-                ttk.Entry(self.loop_param_frame, textvariable=var, width=10).grid(row=row, column=1, sticky=tk.W, pady=1)
-                setattr(self, f"loop_motor_param{i+1}_var", var)
-            
-            # 初始化模式相关变量
-            self.loop_motor_timeout_var = tk.StringVar(value="20000")
-            self.loop_motor_wait_var = tk.BooleanVar(value=True)
-            
-            # 显示模式相关控件
-            self.on_loop_motor_mode_changed()
-            
-        elif step_type == "电机等待":
-            row = 0
-            ttk.Label(self.loop_param_frame, text="等待电机:").grid(row=row, column=0, sticky=tk.W, pady=2, padx=(0,5))
-            self.loop_motor_wait_motor_var = tk.StringVar()
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_motor_wait_motor_var,
-                        values=self.motor_options, width=12).grid(row=row, column=1, sticky=tk.W, pady=2)
-            
-            row += 1
-            ttk.Label(self.loop_param_frame, text="超时(ms):").grid(row=row, column=0, sticky=tk.W, pady=2, padx=(0,5))
-            self.loop_motor_wait_timeout_var = tk.StringVar(value="20000")
-            ttk.Entry(self.loop_param_frame, textvariable=self.loop_motor_wait_timeout_var, width=10).grid(row=row, column=1, sticky=tk.W, pady=2)
-            
-        # 更新滚动区域
-        self.loop_param_frame.update_idletasks()
-        
-    def on_loop_motor_mode_changed(self, event=None):
-        """处理循环中电机模式改变 - 优化布局"""
-        if not hasattr(self, 'loop_motor_mode_var'):
+        build = {
+            "阀门控制": self.build_loop_valve_params,
+            "泵控制": self.build_loop_pump_params,
+            "延时": self.build_loop_delay_params,
+            "电机控制": self.build_loop_motor_params,
+            "电机等待": self.build_loop_motor_wait_params,
+            "循环": self.build_loop_inner_loop_params,
+        }.get(step_type)
+        if build is None:
             return
-            
-        mode = self.loop_motor_mode_var.get()
-        print(f"循环电机模式切换: {mode}")
-        
-        # 清理之前的模式控件
-        for attr in ['loop_timeout_label', 'loop_timeout_entry', 'loop_wait_label', 'loop_wait_check']:
-            if hasattr(self, attr):
-                getattr(self, attr).destroy()
-                delattr(self, attr)
-        
-        # 找到下一个可用的行号
-        next_row = 6
         
-        if mode == "同步":
-            self.loop_timeout_label = ttk.Label(self.loop_param_frame, text="超时(ms):")
-            self.loop_timeout_label.grid(row=next_row, column=0, sticky=tk.W, pady=1, padx=(0,5))
-            self.loop_timeout_entry = ttk.Entry(self.loop_param_frame, textvariable=self.loop_motor_timeout_var, width=10)
-            self.loop_timeout_entry.grid(row=next_row, column=1, sticky=tk.W, pady=1)
-        elif mode == "异步":
-            self.loop_wait_label = ttk.Label(self.loop_param_frame, text="立即等待:")
-            self.loop_wait_label.grid(row=next_row, column=0, sticky=tk.W, pady=1, padx=(0,5))
-            self.loop_wait_check = ttk.Checkbutton(self.loop_param_frame, variable=self.loop_motor_wait_var, text="是")
-            self.loop_wait_check.grid(row=next_row, column=1, sticky=tk.W, pady=1)
-        
-    def on_loop_step_type_changed(self, event=None):
-        """循环内步骤类型改变时的处理"""
-        step_type = self.loop_step_type_var.get()
-        print(f"循环步骤类型选择: {step_type}")
-        
-        # 清空循环参数区域
-        for widget in self.loop_param_frame.winfo_children():
-            widget.destroy()
-            
-        if step_type == "阀门控制":
-            ttk.Label(self.loop_param_frame, text="阀门:").grid(row=0, column=0, sticky=tk.W, pady=2)
-            self.loop_valve_var = tk.StringVar()
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_valve_var,
-                        values=["SV1", "SV2", "SV3", "SV4", "SV5", "SV6", 
-                               "SV7", "SV8", "SV9", "SV10", "SV11", "SV12"], width=10).grid(row=0, column=1, sticky=tk.W, pady=2)
-            
-            ttk.Label(self.loop_param_frame, text="操作:").grid(row=1, column=0, sticky=tk.W, pady=2)
-            self.loop_valve_action_var = tk.StringVar(value="开")
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_valve_action_var,
-                        values=["开", "关"], state="readonly", width=8).grid(row=1, column=1, sticky=tk.W, pady=2)
-            
-        elif step_type == "泵控制":
-            ttk.Label(self.loop_param_frame, text="泵:").grid(row=0, column=0, sticky=tk.W, pady=2)
-            self.loop_pump_var = tk.StringVar()
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_pump_var,
-                        values=["隔膜泵Q1", "隔膜泵Q2", "隔膜泵Q3", "隔膜泵Q4",
-                               "隔膜泵F1", "隔膜泵F2", "隔膜泵F3", "隔膜泵F4"], width=12).grid(row=0, column=1, sticky=tk.W, pady=2)
-            
-            ttk.Label(self.loop_param_frame, text="操作:").grid(row=1, column=0, sticky=tk.W, pady=2)
-            self.loop_pump_action_var = tk.StringVar(value="开")
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_pump_action_var,
-                        values=["开", "关"], state="readonly", width=8).grid(row=1, column=1, sticky=tk.W, pady=2)
-            
-        elif step_type == "延时":
-            ttk.Label(self.loop_param_frame, text="延时:").grid(row=0, column=0, sticky=tk.W, pady=2)
-            self.loop_delay_time_var = tk.StringVar(value="100")
-            ttk.Entry(self.loop_param_frame, textvariable=self.loop_delay_time_var, width=10).grid(row=0, column=1, sticky=tk.W, pady=2)
-            
-            ttk.Label(self.loop_param_frame, text="单位:").grid(row=1, column=0, sticky=tk.W, pady=2)
-            self.loop_delay_unit_var = tk.StringVar(value="ms")
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_delay_unit_var,
-                        values=["ms", "s"], state="readonly", width=8).grid(row=1, column=1, sticky=tk.W, pady=2)
-            
-        elif step_type == "电机控制":
-            # 关键修复: 为循环中的电机控制添加完整的参数支持
-            ttk.Label(self.loop_param_frame, text="电机:").grid(row=0, column=0, sticky=tk.W, pady=2)
-            self.loop_motor_var = tk.StringVar()
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_motor_var,
-                        values=self.motor_options, width=12).grid(row=0, column=1, sticky=tk.W, pady=2)
-            
-            ttk.Label(self.loop_param_frame, text="命令:").grid(row=1, column=0, sticky=tk.W, pady=2)
-            self.loop_motor_cmd_var = tk.StringVar(value="步进移动")
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_motor_cmd_var,
-                        values=["复位", "步进移动", "速度移动", "停止"], state="readonly", width=10).grid(row=1, column=1, sticky=tk.W, pady=2)
-            
-            # 运行模式选择 - 与主界面保持一致
-            ttk.Label(self.loop_param_frame, text="模式:").grid(row=2, column=0, sticky=tk.W, pady=2)
-            self.loop_motor_mode_var = tk.StringVar(value="异步")
-            mode_combo = ttk.Combobox(self.loop_param_frame, textvariable=self.loop_motor_mode_var,
-                                    values=["异步", "同步"], state="readonly", width=8)
-            mode_combo.grid(row=2, column=1, sticky=tk.W, pady=2)
-            mode_combo.bind('<<ComboboxSelected>>', self.on_loop_motor_mode_changed)
-            
-            # 完整的参数支持
-            ttk.Label(self.loop_param_frame, text="参数1:").grid(row=3, column=0, sticky=tk.W, pady=2)
-            self.loop_motor_param1_var = tk.StringVar(value="1800")
-            ttk.Entry(self.loop_param_frame, textvariable=self.loop_motor_param1_var, width=10).grid(row=3, column=1, sticky=tk.W, pady=2)
-            
-            ttk.Label(self.loop_param_frame, text="参数2:").grid(row=4, column=0, sticky=tk.W, pady=2)
-            self.loop_motor_param2_var = tk.StringVar(value="20000")
-            ttk.Entry(self.loop_param_frame, textvariable=self.loop_motor_param2_var, width=10).grid(row=4, column=1, sticky=tk.W, pady=2)
-            
-            ttk.Label(self.loop_param_frame, text="参数3:").grid(row=5, column=0, sticky=tk.W, pady=2)
-            self.loop_motor_param3_var = tk.StringVar(value="50000")
-            ttk.Entry(self.loop_param_frame, textvariable=self.loop_motor_param3_var, width=10).grid(row=5, column=1, sticky=tk.W, pady=2)
-            
-            # 初始化模式相关变量
-            self.loop_motor_timeout_var = tk.StringVar(value="20000")
-            self.loop_motor_wait_var = tk.BooleanVar(value=True)
-            
-            # 显示模式相关控件
-            self.on_loop_motor_mode_changed()
-            
-        elif step_type == "电机等待":
-            ttk.Label(self.loop_param_frame, text="等待电机:").grid(row=0, column=0, sticky=tk.W, pady=2)
-            self.loop_motor_wait_motor_var = tk.StringVar()
-            ttk.Combobox(self.loop_param_frame, textvariable=self.loop_motor_wait_motor_var,
-                        values=self.motor_options, width=12).grid(row=0, column=1, sticky=tk.W, pady=2)
-            
-            ttk.Label(self.loop_param_frame, text="超时(ms):").grid(row=1, column=0, sticky=tk.W, pady=2)
-            self.loop_motor_wait_timeout_var = tk.StringVar(value="20000")
-            ttk.Entry(self.loop_param_frame, textvariable=self.loop_motor_wait_timeout_var, width=10).grid(row=1, column=1, sticky=tk.W, pady=2)
-            
+        if self.loop_param_panel is not None:
+            self.loop_param_panel.grid_remove()
+        panel = self.loop_param_panels.get(step_type)
+        if panel is None:
+            panel = self.loop_param_panels[step_type] = ttk.Frame(self.loop_param_frame)
+            build(panel)
+        self.loop_param_panel = panel
+        panel.grid(row=0, column=0, sticky=(tk.W, tk.E))
         self.loop_param_frame.update_idletasks()
         
+    def build_loop_valve_params(self, panel):
+        ttk.Label(panel, text="阀门:").grid(row=0, column=0, sticky=tk.W, pady=2)
+        self.loop_valve_var = tk.StringVar()
+        ttk.Combobox(panel, textvariable=self.loop_valve_var,
+                    values=VALVE_OPTIONS, width=10).grid(row=0, column=1, sticky=tk.W, pady=2)
+        
+        ttk.Label(panel, text="操作:").grid(row=1, column=0, sticky=tk.W, pady=2)
+        self.loop_valve_action_var = tk.StringVar(value="开")
+        ttk.Combobox(panel, textvariable=self.loop_valve_action_var,
+                    values=["开", "关"], state="readonly", width=8).grid(row=1, column=1, sticky=tk.W, pady=2)
+        
+    def build_loop_pump_params(self, panel):
+        ttk.Label(panel, text="泵:").grid(row=0, column=0, sticky=tk.W, pady=2)
+        self.loop_pump_var = tk.StringVar()
+        ttk.Combobox(panel, textvariable=self.loop_pump_var,
+                    values=PUMP_OPTIONS, width=12).grid(row=0, column=1, sticky=tk.W, pady=2)
+        
+        ttk.Label(panel, text="操作:").grid(row=1, column=0, sticky=tk.W, pady=2)
+        self.loop_pump_action_var = tk.StringVar(value="开")
+        ttk.Combobox(panel, textvariable=self.loop_pump_action_var,
+                    values=["开", "关"], state="readonly", width=8).grid(row=1, column=1, sticky=tk.W, pady=2)
+        
+    def build_loop_delay_params(self, panel):
+        ttk.Label(panel, text="延时:").grid(row=0, column=0, sticky=tk.W, pady=2)
+        self.loop_delay_time_var = tk.StringVar(value="100")
+        ttk.Entry(panel, textvariable=self.loop_delay_time_var, width=10).grid(row=0, column=1, sticky=tk.W, pady=2)
+        
+        ttk.Label(panel, text="单位:").grid(row=1, column=0, sticky=tk.W, pady=2)
+        self.loop_delay_unit_var = tk.StringVar(value="ms")
+        ttk.Combobox(panel, textvariable=self.loop_delay_unit_var,
+                    values=["ms", "s"], state="readonly", width=8).grid(row=1, column=1, sticky=tk.W, pady=2)
+        
+    def build_loop_motor_params(self, panel):
+        # 关键修复: 为循环中的电机控制添加完整的参数支持
+        ttk.Label(panel, text="电机:").grid(row=0, column=0, sticky=tk.W, pady=2)
+        self.loop_motor_var = tk.StringVar()
+        ttk.Combobox(panel, textvariable=self.loop_motor_var,
+                    values=self.motor_options, width=12).grid(row=0, column=1, sticky=tk.W, pady=2)
+        
+        ttk.Label(panel, text="命令:").grid(row=1, column=0, sticky=tk.W, pady=2)
+        self.loop_motor_cmd_var = tk.StringVar(value="步进移动")
+        ttk.Combobox(panel, textvariable=self.loop_motor_cmd_var,
+                    values=MOTOR_COMMANDS, state="readonly", width=10).grid(row=1, column=1, sticky=tk.W, pady=2)
+        
+        # 运行模式选择 - 与主界面保持一致
+        ttk.Label(panel, text="模式:").grid(row=2, column=0, sticky=tk.W, pady=2)
+        self.loop_motor_mode_var = tk.StringVar(value="异步")
+        mode_combo = ttk.Combobox(panel, textvariable=self.loop_motor_mode_var,
+                                values=["异步", "同步"], state="readonly", width=8)
+        mode_combo.grid(row=2, column=1, sticky=tk.W, pady=2)
+        mode_combo.bind('<<ComboboxSelected>>', self.on_loop_motor_mode_changed)
+        
+        # 完整的参数支持
+        for i, default in enumerate(["1800", "20000", "50000"]):
+            ttk.Label(panel, text=f"参数{i + 1}:").grid(row=3 + i, column=0, sticky=tk.W, pady=2)
+            var = tk.StringVar(value=default)
+            ttk.Entry(panel, textvariable=var, width=10).grid(row=3 + i, column=1, sticky=tk.W, pady=2)
+            setattr(self, f"loop_motor_param{i + 1}_var", var)
+        
+        # 同步/异步模式的控件都创建在第6行, 切换模式时只显示其中一组
+        self.loop_motor_timeout_var = tk.StringVar(value="20000")
+        self.loop_motor_wait_var = tk.BooleanVar(value=True)
+        self.loop_sync_widgets = [ttk.Label(panel, text="超时(ms):"),
+                                  ttk.Entry(panel, textvariable=self.loop_motor_timeout_var, width=10)]
+        self.loop_async_widgets = [ttk.Label(panel, text="立即等待:"),
+                                   ttk.Checkbutton(panel, variable=self.loop_motor_wait_var, text="是")]
+        for widgets in (self.loop_sync_widgets, self.loop_async_widgets):
+            widgets[0].grid(row=6, column=0, sticky=tk.W, pady=2)
+            widgets[1].grid(row=6, column=1, sticky=tk.W, pady=2)
+        
+        # 显示模式相关控件
+        self.on_loop_motor_mode_changed()
+        
+    def build_loop_motor_wait_params(self, panel):
+        ttk.Label(panel, text="等待电机:").grid(row=0, column=0, sticky=tk.W, pady=2)
+        self.loop_motor_wait_motor_var = tk.StringVar()
+        ttk.Combobox(panel, textvariable=self.loop_motor_wait_motor_var,
+                    values=self.motor_options, width=12).grid(row=0, column=1, sticky=tk.W, pady=2)
+        
+        ttk.Label(panel, text="超时(ms):").grid(row=1, column=0, sticky=tk.W, pady=2)
+        self.loop_motor_wait_timeout_var = tk.StringVar(value="20000")
+        ttk.Entry(panel, textvariable=self.loop_motor_wait_timeout_var, width=10).grid(row=1, column=1, sticky=tk.W, pady=2)
+        
+    def build_loop_inner_loop_params(self, panel):
+        ttk.Label(panel, text="内层循环次数:").grid(row=0, column=0, sticky=tk.W, pady=2)
+        self.loop_inner_count_var = tk.StringVar(value="2")
+        ttk.Entry(panel, textvariable=self.loop_inner_count_var, width=10).grid(row=0, column=1, sticky=tk.W, pady=2)
+        
+        ttk.Label(panel, text="添加后在内层循环中添加步骤，完成后点击“完成内层循环”",
+                  foreground="gray", font=("Arial", 8)).grid(row=1, column=0, columnspan=2, sticky=tk.W, pady=2)
+        
     def on_loop_motor_mode_changed(self, event=None):
         """处理循环中电机模式改变"""
         if not hasattr(self, 'loop_motor_mode_var'):
@@ -698,23 +679,10 @@ end
             
         mode = self.loop_motor_mode_var.get()
         print(f"循环电机模式切换: {mode}")
-        
-        # 清理之前的模式控件
-        for attr in ['loop_timeout_label', 'loop_timeout_entry', 'loop_wait_label', 'loop_wait_check']:
-            if hasattr(self, attr):
-                getattr(self, attr).destroy()
-                delattr(self, attr)
-        
         if mode == "同步":
-            self.loop_timeout_label = ttk.Label(self.loop_param_frame, text="超时(ms):")
-            self.loop_timeout_label.grid(row=6, column=0, sticky=tk.W, pady=2)
-            self.loop_timeout_entry = ttk.Entry(self.loop_param_frame, textvariable=self.loop_motor_timeout_var, width=10)
-            self.loop_timeout_entry.grid(row=6, column=1, sticky=tk.W, pady=2)
-        elif mode == "异步":
-            self.loop_wait_label = ttk.Label(self.loop_param_frame, text="立即等待:")
-            self.loop_wait_label.grid(row=6, column=0, sticky=tk.W, pady=2)
-            self.loop_wait_check = ttk.Checkbutton(self.loop_param_frame, variable=self.loop_motor_wait_var, text="是")
-            self.loop_wait_check.grid(row=6, column=1, sticky=tk.W, pady=2)
+            show_widgets(self.loop_sync_widgets, self.loop_async_widgets)
+        else:
+            show_widgets(self.loop_async_widgets, self.loop_sync_widgets)
 
     def add_to_loop(self):
         """添加步骤到循环中"""
@@ -775,17 +743,46 @@ end
             })
             desc = f"等待{step_data['motor']}完成"
             
-        self.loop_steps_data.append(step_data)
-        self.loop_steps_listbox.insert(tk.END, f"{len(self.loop_steps_data)}. {desc}")
+        elif step_type == "循环":
+            if not hasattr(self, 'loop_inner_count_var') or not self.loop_inner_count_var.get():
+                messagebox.showwarning("警告", "请输入内层循环次数")
+                return
+            # 进入内层循环: 外层的步骤列表入栈, 之后添加的步骤属于内层循环
+            self.loop_stack.append((self.loop_steps_data, self.loop_inner_count_var.get()))
+            self.loop_steps_data = []
+            self.loop_steps_listbox.selection_clear()
+            self.refresh_loop_steps_list()
+            print(f"🔁 开始第 {len(self.loop_stack) + 1} 层循环: {self.loop_inner_count_var.get()}次")
+            return
+            
+        self.loop_steps_data.append(Step.from_dict(step_data))
+        self.loop_steps_listbox.refresh(len(self.loop_steps_data) - 1)
         print(f"✅ 添加循环步骤: {desc}")
         
+    def finish_inner_loop(self):
+        """完成正在编辑的内层循环, 作为一个循环步骤加入外层循环"""
+        if not self.loop_stack:
+            messagebox.showinfo("提示", "当前不在内层循环中")
+            return
+        if not self.loop_steps_data:
+            messagebox.showwarning("警告", "请添加内层循环步骤")
+            return
+        outer_steps, count = self.loop_stack.pop()
+        outer_steps.append(Step.from_dict({"type": "循环", "count": count,
+                                           "steps": [step.to_dict() for step in self.loop_steps_data]}))
+        self.loop_steps_data = outer_steps
+        self.loop_steps_listbox.selection_clear()
+        self.refresh_loop_steps_list()
+        print(f"✅ 完成内层循环: {count}次")
+
     def remove_from_loop(self):
         """从循环中删除步骤"""
         selection = self.loop_steps_listbox.curselection()
         if selection:
             index = selection[0]
             removed_step = self.loop_steps_data.pop(index)
-            self.refresh_loop_steps_list()
+            self.loop_steps_listbox.selection_clear()
+            self.refresh_loop_steps_list(index)
             print(f"❌ 删除循环步骤: 索引 {index}")
         else:
             messagebox.showwarning("警告", "请先选择要删除的步骤")
@@ -804,8 +801,8 @@ end
         idx = selection[0]
         # 交换步骤数据
         self.loop_steps_data[idx], self.loop_steps_data[idx-1] = self.loop_steps_data[idx-1], self.loop_steps_data[idx]
-        # 刷新列表
-        self.refresh_loop_steps_list()
+        # 只刷新交换的两行
+        self.loop_steps_listbox.refresh_rows(idx-1, idx)
         # 保持选中状态在新位置
         self.loop_steps_listbox.selection_set(idx-1)
         print(f"⬆️ 循环步骤上移: 从索引 {idx} 移动到 {idx-1}")
@@ -824,8 +821,8 @@ end
         idx = selection[0]
         # 交换步骤数据
         self.loop_steps_data[idx], self.loop_steps_data[idx+1] = self.loop_steps_data[idx+1], self.loop_steps_data[idx]
-        # 刷新列表
-        self.refresh_loop_steps_list()
+        # 只刷新交换的两行
+        self.loop_steps_listbox.refresh_rows(idx, idx+1)
         # 保持选中状态在新位置
         self.loop_steps_listbox.selection_set(idx+1)
         print(f"⬇️ 循环步骤下移: 从索引 {idx} 移动到 {idx+1}")
@@ -839,15 +836,18 @@ end
         result = messagebox.askyesno("确认清空", f"确定要清空所有循环步骤吗？\n当前有 {len(self.loop_steps_data)} 个步骤。")
         if result:
             self.loop_steps_data.clear()
-            self.loop_steps_listbox.delete(0, tk.END)
+            self.refresh_loop_steps_list()
             print("🗑️ 已清空所有循环步骤")
         
-    def refresh_loop_steps_list(self):
-        """刷新循环步骤列表"""
-        self.loop_steps_listbox.delete(0, tk.END)
-        for i, step in enumerate(self.loop_steps_data):
-            desc = self.get_step_description(step)
-            self.loop_steps_listbox.insert(tk.END, f"{i+1}. {desc}")
+    def refresh_loop_steps_list(self, first=0):
+        """刷新循环步骤列表 (第first行之后的内容有变化)"""
+        depth = len(self.loop_stack)
+        self.loop_list_label.config(text=f"当前循环步骤 (第{depth + 1}层):" if depth else "当前循环步骤:")
+        self.loop_steps_listbox.refresh(first)
+        
+    def step_row_text(self, steps, index):
+        """步骤列表第index行的显示文本"""
+        return f"{index+1}. {self.get_step_description(steps[index])}"
             
     def add_step(self):
         step_type = self.step_type_var.get()
@@ -907,9 +907,12 @@ end
             if not hasattr(self, 'loop_steps_data') or not self.loop_steps_data:
                 messagebox.showwarning("警告", "请添加循环步骤")
                 return
+            if self.loop_stack:
+                messagebox.showwarning("警告", "请先完成内层循环")
+                return
             step_data.update({
                 "count": self.loop_count_var.get(),
-                "steps": self.loop_steps_data.copy()  # 复制循环步骤
+                "steps": [step.to_dict() for step in self.loop_steps_data]  # 复制循环步骤
             })
             desc = f"循环{step_data['count']}次 ({len(step_data['steps'])}个步骤)"
             
@@ -920,11 +923,18 @@ end
             if not desc_text:
                 messagebox.showwarning("警告", "请输入复合动作描述")
                 return
+            error = None if legacy_needle_motion(desc_text) else composite_error(desc_text)
+            if error and not messagebox.askyesno("复合动作无法解析", f"{error}\n仍然添加? (生成的代码中为TODO)"):
+                return
             step_data.update({"description": desc_text})
             desc = f"复合动作: {desc_text[:20]}..."
             
-        self.steps_data.append(step_data)
-        self.steps_listbox.insert(tk.END, f"{len(self.steps_data)}. {desc}")
+        self.steps_data.append(Step.from_dict(step_data))
+        if step_type == "循环":
+            # 参数面板切换时保留, 添加后清空循环步骤以便编辑下一个循环
+            self.loop_steps_data = []
+            self.refresh_loop_steps_list()
+        self.steps_listbox.refresh(len(self.steps_data) - 1)
         self.update_code_preview()
         print(f"添加步骤: {desc}")
         
@@ -932,7 +942,8 @@ end
         selection = self.steps_listbox.curselection()
         if selection:
             self.steps_data.pop(selection[0])
-            self.refresh_steps_list()
+            self.steps_listbox.selection_clear()
+            self.refresh_steps_list(selection[0])
             self.update_code_preview()
             
     def move_step_up(self):
@@ -940,7 +951,7 @@ end
         if selection and selection[0] > 0:
             idx = selection[0]
             self.steps_data[idx], self.steps_data[idx-1] = self.steps_data[idx-1], self.steps_data[idx]
-            self.refresh_steps_list()
+            self.steps_listbox.refresh_rows(idx-1, idx)
             self.steps_listbox.selection_set(idx-1)
             self.update_code_preview()
             
@@ -949,338 +960,145 @@ end
         if selection and selection[0] < len(self.steps_data)-1:
             idx = selection[0]
             self.steps_data[idx], self.steps_data[idx+1] = self.steps_data[idx+1], self.steps_data[idx]
-            self.refresh_steps_list()
+            self.steps_listbox.refresh_rows(idx, idx+1)
             self.steps_listbox.selection_set(idx+1)
             self.update_code_preview()
             
-    def refresh_steps_list(self):
-        self.steps_listbox.delete(0, tk.END)
-        for i, step in enumerate(self.steps_data):
-            desc = self.get_step_description(step)
-            self.steps_listbox.insert(tk.END, f"{i+1}. {desc}")
+    def refresh_steps_list(self, first=0):
+        """刷新步骤列表 (第first行之后的内容有变化), 只重绘可见行"""
+        self.steps_listbox.refresh(first)
             
     def get_step_description(self, step):
-        step_type = step["type"]
-        if step_type == "阀门控制":
-            return f"{step['device']} {step['action']}"
-        elif step_type == "泵控制":
-            return f"{step['device']} {step['action']}"
-        elif step_type == "延时":
-            return f"延时{step['time']}{step['unit']}"
-        elif step_type == "电机控制":
-            return f"{step['motor']} {step['command']} ({step.get('mode', '异步')})"
-        elif step_type == "电机等待":
-            return f"等待{step['motor']}完成"
-        elif step_type == "循环":
-            return f"循环{step['count']}次 ({len(step['steps'])}个步骤)"
-        elif step_type == "复合动作":
-            return f"复合动作: {step['description'][:20]}..."
-        return "未知步骤"
+        return get_step_description(step)
         
     def update_code_preview(self):
         if not self.steps_data:
+            self.preview_worker.cancel()
             self.show_initial_code()
             return
             
-        if self.output_type.get() == "C":
-            code = self.generate_c_function()
+        # 在后台线程中按步骤缓存生成, 连续修改合并为一次刷新
+        self.preview_worker.schedule(self.preview_snapshot)
+        
+    def preview_snapshot(self):
+        """在主线程中读取界面内容和生成器配置, 供后台生成使用"""
+        process = self.current_process()
+        process.steps = list(process.steps)
+        return process, self.output_type.get(), self.generator.snapshot()
+        
+    def render_code_preview(self, process, output_type, generator, cancel):
+        """在工作线程中按快照的生成器配置生成预览, 主线程之后修改选项不影响本次生成"""
+        return self.step_code_cache.render(process, output_type, cancel, generator)
+        
+    def apply_code_preview(self, rendered):
+        """将生成结果显示到预览, 能增量更新时只替换变化的行"""
+        old = self.preview_rendered
+        if old is None or old.output_type != rendered.output_type or self.code_preview.edit_modified():
+            self.code_preview.delete(1.0, tk.END)
+            self.code_preview.insert(tk.END, rendered.text())
         else:
-            code = self.generate_lua_function()
-            
-        self.code_preview.delete(1.0, tk.END)
-        self.code_preview.insert(tk.END, code)
+            self.patch_code_preview(old, rendered)
+        self.code_preview.edit_modified(False)
+        self.preview_rendered = rendered
+        
+    def replace_preview_lines(self, first, last, text):
+        """替换预览中第first行到第last行(不含, 从0开始)的内容"""
+        if first != last:
+            self.code_preview.delete(f"{first + 1}.0", f"{last + 1}.0")
+        if text:
+            self.code_preview.insert(f"{first + 1}.0", text)
+        
+    def patch_code_preview(self, old, new):
+        """按步骤比较新旧生成结果, 自下而上只替换变化的行, 使尚未处理部分的行号保持不变"""
+        old_bodies, new_bodies = old.bodies, new.bodies
+        n_old, n_new = len(old_bodies), len(new_bodies)
+        
+        # 代码相同的公共前缀/后缀步骤 (缓存命中的片段是同一对象, 比较很快)
+        limit = min(n_old, n_new)
+        prefix = 0
+        while prefix < limit and old_bodies[prefix] == new_bodies[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and old_bodies[n_old - 1 - suffix] == new_bodies[n_new - 1 - suffix]:
+            suffix += 1
+            
+        # 旧预览中每个步骤的起始行
+        starts = [old.prologue.count("\n")]
+        for body in old_bodies:
+            starts.append(starts[-1] + 1 + body.count("\n"))
+            
+        if old.epilogue != new.epilogue:
+            self.replace_preview_lines(starts[-1], starts[-1] + old.epilogue.count("\n"), new.epilogue)
+            
+        # 后缀步骤代码不变, 只可能需要更新"步骤 N"注释行
+        for k in range(1, suffix + 1):
+            old_header, new_header = old.headers[n_old - k], new.headers[n_new - k]
+            if old_header != new_header:
+                line = starts[n_old - k]
+                self.replace_preview_lines(line, line + 1, new_header)
+                
+        middle = "".join(header + body for header, body in
+                         zip(new.headers[prefix:n_new - suffix], new_bodies[prefix:n_new - suffix]))
+        self.replace_preview_lines(starts[prefix], starts[n_old - suffix], middle)
         
-    def generate_c_function(self):
-        process_name = self.process_name_var.get() or "custom_process"
-        process_desc = self.process_desc_text.get("1.0", tk.END).strip()
+        for k in range(prefix - 1, -1, -1):
+            if old.headers[k] != new.headers[k]:
+                self.replace_preview_lines(starts[k], starts[k] + 1, new.headers[k])
+                
+        if old.prologue != new.prologue:
+            self.replace_preview_lines(0, starts[0], new.prologue)
         
-        func_name = process_name.lower().replace(" ", "_").replace("-", "_")
-        func_name = "".join(c for c in func_name if c.isalnum() or c == "_")
-        if not func_name or func_name[0].isdigit():
-            func_name = "process_" + func_name
-            
-        c_code = f"""/* {process_desc or process_name} */
-void {func_name}(void)
-{{
-    int i = 0;
-
-    LOG("%llu", get_time());
-    LOG("liquid_circuit: {process_name} start\\n");
-    
-"""
-        for i, step in enumerate(self.steps_data):
-            c_code += self.generate_c_step_code(step, i)
-            
-        c_code += f"""
-    LOG("liquid_circuit: {process_name} end\\n");
-}}
-"""
-        return c_code
+    def current_process(self):
+        """根据界面内容构建流程模型"""
+        return Process(self.process_name_var.get(),
+                       self.process_desc_text.get("1.0", tk.END).strip(),
+                       self.steps_data)
+        
+    def generate_c_function(self):
+        return self.generator.generate_c_function(self.current_process())
         
     def generate_lua_function(self):
         """生成Lua脚本函数"""
-        process_name = self.process_name_var.get() or "custom_process"
-        process_desc = self.process_desc_text.get("1.0", tk.END).strip()
-        
-        func_name = process_name.lower().replace(" ", "_").replace("-", "_")
-        func_name = "".join(c for c in func_name if c.isalnum() or c == "_")
-        if not func_name or func_name[0].isdigit():
-            func_name = "process_" + func_name
-            
-        lua_code = f"""-- {process_desc or process_name}
--- 生成时间: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-
-function {func_name}()
-    local i = 0
-    
-    log.info(string.format("liquid_circuit: %s start", "{process_name}"))
-    
-"""
-        for i, step in enumerate(self.steps_data):
-            lua_code += self.generate_lua_step_code(step, i)
-            
-        lua_code += f"""
-    log.info(string.format("liquid_circuit: %s end", "{process_name}"))
-end
-
--- 调用示例
--- {func_name}()
-"""
-        return lua_code
+        return self.generator.generate_lua_function(self.current_process())
         
     def generate_c_step_code(self, step, step_index):
         """生成C语言步骤代码"""
-        step_type = step["type"]
-        code = f"    // 步骤 {step_index + 1}: {self.get_step_description(step)}\n"
-        
-        if step_type == "阀门控制":
-            device = self.device_mapping.get(step["device"], step["device"])
-            action = "ON" if step["action"] == "开" else "OFF"
-            code += f"    valve_set({device}, {action});\n"
-            
-        elif step_type == "泵控制":
-            device = self.device_mapping.get(step["device"], step["device"])
-            action = "ON" if step["action"] == "开" else "OFF"
-            code += f"    valve_set({device}, {action});\n"
-            
-        elif step_type == "延时":
-            time_val = int(step["time"])
-            if step["unit"] == "s":
-                time_val *= 1000
-            code += f"    usleep({time_val}*1000);\n"
-            
-        elif step_type == "电机控制":
-            motor = self.device_mapping.get(step["motor"], step["motor"])
-            cmd_mapping = {"复位": "CMD_MOTOR_RST", "步进移动": "CMD_MOTOR_MOVE_STEP", 
-                          "速度移动": "CMD_MOTOR_MOVE_SPEED", "停止": "CMD_MOTOR_STOP"}
-            cmd = cmd_mapping.get(step["command"], "CMD_MOTOR_RST")
-            mode = step.get("mode", "异步")
-            
-            param1 = step.get("param1", "0")
-            param2 = step.get("param2", "20000")
-            param3 = step.get("param3", "50000")
-            
-            if mode == "同步":
-                timeout = step.get("timeout", "20000")
-                code += f"    if (motor_move_ctl_sync({motor}, {cmd}, {param1}, {param2}, {param3}, {timeout}) < 0) {{\n"
-                code += f"        LOG(\"liquid_circuit: motor sync operation failed\\n\");\n"
-                code += f"        FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_PUMP);\n"
-                code += f"    }}\n"
-            else:
-                code += f"    FAULT_CHECK_START(MODULE_FAULT_LEVEL2);\n"
-                code += f"    if (motor_move_ctl_async({motor}, {cmd}, {param1}, {param2}, {param3}) < 0) {{\n"
-                code += f"        LOG(\"liquid_circuit: motor async operation failed\\n\");\n"
-                code += f"        FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_PUMP);\n"
-                code += f"    }}\n"
-                code += f"    FAULT_CHECK_END();\n"
-                
-                wait_complete = step.get("wait_complete", True)
-                if wait_complete:
-                    code += f"    FAULT_CHECK_START(MODULE_FAULT_LEVEL2);\n"
-                    code += f"    if (motor_timedwait({motor}, MOTOR_DEFAULT_TIMEOUT) != 0) {{\n"
-                    code += f"        LOG(\"liquid_circuit: motor wait timeout!\\n\");\n"
-                    code += f"        FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_PUMP);\n"
-                    code += f"    }}\n"
-                    code += f"    FAULT_CHECK_END();\n"
-                else:
-                    code += f"    // 注意: 需要在后续步骤中添加对应的电机等待步骤\n"
-                    
-        elif step_type == "电机等待":
-            motor = self.device_mapping.get(step["motor"], step["motor"])
-            timeout = step.get("timeout", "20000")
-            code += f"    FAULT_CHECK_START(MODULE_FAULT_LEVEL2);\n"
-            code += f"    if (motor_timedwait({motor}, {timeout}) != 0) {{\n"
-            code += f"        LOG(\"liquid_circuit: motor wait timeout!\\n\");\n"
-            code += f"        FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_PUMP);\n"
-            code += f"    }}\n"
-            code += f"    FAULT_CHECK_END();\n"
-            
-        elif step_type == "循环":
-            count = step.get("count", "1")
-            loop_steps = step.get("steps", [])
-            code += f"    for (i=0; i<{count}; i++) {{\n"
-            code += f"        // 循环第 i+1 次，共执行 {len(loop_steps)} 个步骤\n"
-            
-            for j, loop_step in enumerate(loop_steps):
-                loop_code = self.generate_c_step_code(loop_step, j)
-                # 给循环内的代码增加缩进
-                loop_code_lines = loop_code.split('\n')
-                for line in loop_code_lines:
-                    if line.strip():
-                        if line.startswith('    //'):
-                            code += f"    {line}\n"
-                        elif line.startswith('    '):
-                            code += f"    {line}\n"
-                        else:
-                            code += f"        {line}\n"
-            
-            code += f"    }}\n"
-            
-        elif step_type == "复合动作":
-            desc = step["description"]
-            code += f"    /* 复合动作: {desc} */\n"
-            if "针下、上" in desc and "脉冲" in desc:
-                pulse_match = re.search(r'(\d+)脉冲', desc)
-                repeat_match = re.search(r'重复(\d+)次', desc)
-                pulses = pulse_match.group(1) if pulse_match else "1800"
-                repeats = repeat_match.group(1) if repeat_match else "1"
-                
-                code += f"    for (i=0; i<{repeats}; i++) {{\n"
-                code += f"        if (motor_move_ctl_async(MOTOR_NEEDLE_S_Z, CMD_MOTOR_MOVE_STEP, {pulses}, NEEDLE_S_Z_REMOVE_SPEED, NEEDLE_S_Z_REMOVE_ACC) < 0) {{\n"
-                code += f"            FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_Z);\n"
-                code += f"        }}\n"
-                code += f"        usleep(500*1000);\n"
-                code += f"        if (motor_timedwait(MOTOR_NEEDLE_S_Z, MOTOR_DEFAULT_TIMEOUT) != 0) {{\n"
-                code += f"            LOG(\"liquid_circuit: motor wait timeout!\\n\");\n"
-                code += f"            FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_Z);\n"
-                code += f"        }}\n"
-                code += f"        if (motor_move_ctl_async(MOTOR_NEEDLE_S_Z, CMD_MOTOR_MOVE_STEP, -{pulses}, NEEDLE_S_Z_REMOVE_SPEED, NEEDLE_S_Z_REMOVE_ACC) < 0) {{\n"
-                code += f"            FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_Z);\n"
-                code += f"        }}\n"
-                code += f"        usleep(500*1000);\n"
-                code += f"        if (motor_timedwait(MOTOR_NEEDLE_S_Z, MOTOR_DEFAULT_TIMEOUT) != 0) {{\n"
-                code += f"            LOG(\"liquid_circuit: motor wait timeout!\\n\");\n"
-                code += f"            FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_Z);\n"
-                code += f"        }}\n"
-                code += f"    }}\n"
-            else:
-                code += f"    // TODO: 实现复合动作逻辑\n"
-                
-        code += "\n"
-        return code
+        return self.generator.generate_c_step_code(step, step_index)
         
     def generate_lua_step_code(self, step, step_index):
         """生成Lua脚本步骤代码"""
-        step_type = step["type"]
-        code = f"    -- 步骤 {step_index + 1}: {self.get_step_description(step)}\n"
-        
-        if step_type == "阀门控制":
-            device = self.lua_device_mapping.get(step["device"], step["device"].lower())
-            action = "true" if step["action"] == "开" else "false"
-            code += f"    {device}:set({action})\n"
-            
-        elif step_type == "泵控制":
-            device = self.lua_device_mapping.get(step["device"], step["device"].lower())
-            action = "true" if step["action"] == "开" else "false"
-            code += f"    {device}:set({action})\n"
-            
-        elif step_type == "延时":
-            time_val = int(step["time"])
-            if step["unit"] == "s":
-                time_val *= 1000
-            code += f"    time.sleep({time_val})  -- 延时{time_val}ms\n"
-            
-        elif step_type == "电机控制":
-            motor = self.lua_device_mapping.get(step["motor"], step["motor"].lower())
-            cmd_mapping = {"复位": "reset", "步进移动": "move_step", 
-                          "速度移动": "move_speed", "停止": "stop"}
-            cmd = cmd_mapping.get(step["command"], "reset")
-            mode = step.get("mode", "异步")
-            
-            param1 = step.get("param1", "0")
-            param2 = step.get("param2", "20000")
-            param3 = step.get("param3", "50000")
-            
-            if mode == "同步":
-                timeout = step.get("timeout", "20000")
-                code += f"    local result = {motor}:{cmd}_sync({param1}, {param2}, {param3}, {timeout})\n"
-                code += f"    if not result then\n"
-                code += f"        log.error(\"liquid_circuit: motor sync operation failed\")\n"
-                code += f"        error(\"Motor operation failed\")\n"
-                code += f"    end\n"
-            else:
-                code += f"    local result = {motor}:{cmd}_async({param1}, {param2}, {param3})\n"
-                code += f"    if not result then\n"
-                code += f"        log.error(\"liquid_circuit: motor async operation failed\")\n"
-                code += f"        error(\"Motor operation failed\")\n"
-                code += f"    end\n"
-                
-                wait_complete = step.get("wait_complete", True)
-                if wait_complete:
-                    code += f"    if not {motor}:wait_complete(20000) then\n"
-                    code += f"        log.error(\"liquid_circuit: motor wait timeout!\")\n"
-                    code += f"        error(\"Motor wait timeout\")\n"
-                    code += f"    end\n"
-                else:
-                    code += f"    -- 注意: 需要在后续步骤中添加对应的电机等待步骤\n"
-                    
-        elif step_type == "电机等待":
-            motor = self.lua_device_mapping.get(step["motor"], step["motor"].lower())
-            timeout = step.get("timeout", "20000")
-            code += f"    if not {motor}:wait_complete({timeout}) then\n"
-            code += f"        log.error(\"liquid_circuit: motor wait timeout!\")\n"
-            code += f"        error(\"Motor wait timeout\")\n"
-            code += f"    end\n"
-            
-        elif step_type == "循环":
-            count = step.get("count", "1")
-            loop_steps = step.get("steps", [])
-            code += f"    for i = 1, {count} do\n"
-            code += f"        -- 循环第 i 次，共执行 {len(loop_steps)} 个步骤\n"
-            
-            for j, loop_step in enumerate(loop_steps):
-                loop_code = self.generate_lua_step_code(loop_step, j)
-                # 给循环内的代码增加缩进
-                loop_code_lines = loop_code.split('\n')
-                for line in loop_code_lines:
-                    if line.strip():
-                        if line.startswith('    --'):
-                            code += f"    {line}\n"
-                        elif line.startswith('    '):
-                            code += f"    {line}\n"
-                        else:
-                            code += f"        {line}\n"
-            
-            code += f"    end\n"
-            
-        elif step_type == "复合动作":
-            desc = step["description"]
-            code += f"    -- 复合动作: {desc}\n"
-            if "针下、上" in desc and "脉冲" in desc:
-                pulse_match = re.search(r'(\d+)脉冲', desc)
-                repeat_match = re.search(r'重复(\d+)次', desc)
-                pulses = pulse_match.group(1) if pulse_match else "1800"
-                repeats = repeat_match.group(1) if repeat_match else "1"
-                
-                code += f"    for i = 1, {repeats} do\n"
-                code += f"        motor.needle_s_z:move_step_async({pulses}, 20000, 50000)\n"
-                code += f"        time.sleep(500)\n"
-                code += f"        motor.needle_s_z:wait_complete(20000)\n"
-                code += f"        motor.needle_s_z:move_step_async(-{pulses}, 20000, 50000)\n"
-                code += f"        time.sleep(500)\n"
-                code += f"        motor.needle_s_z:wait_complete(20000)\n"
-                code += f"    end\n"
-            else:
-                code += f"    -- TODO: 实现复合动作逻辑\n"
-                
-        code += "\n"
-        return code
+        return self.generator.generate_lua_step_code(step, step_index)
         
     def import_excel(self):
-        if not PANDAS_AVAILABLE:
-            messagebox.showerror("错误", "需要安装pandas库")
+        """从Excel/CSV步骤表导入步骤 (每行一个步骤, 列名见 liquid_import.DEFAULT_COLUMNS)"""
+        file_path = filedialog.askopenfilename(filetypes=[("表格文件", "*.xlsx *.xlsm *.xls *.csv *.tsv"),
+                                                          ("All files", "*.*")])
+        if not file_path:
+            return
+        from liquid_import import import_table  # 按需导入, 不影响启动时间
+        try:
+            result = import_table(file_path)
+        except (OSError, ValueError, RuntimeError) as e:
+            messagebox.showerror("错误", f"导入失败: {e}")
+            return
+        if not result.steps:
+            messagebox.showwarning("警告", "没有导入任何步骤\n" + result.format_errors(10))
+            return
+        if self.steps_data and not messagebox.askyesno(
+                "确认导入", f"导入的 {len(result.steps)} 个步骤将替换当前的 {len(self.steps_data)} 个步骤"):
             return
-        messagebox.showinfo("提示", "Excel导入功能已简化")
+
+        if not self.process_name_var.get():
+            self.process_name_var.set(os.path.splitext(os.path.basename(file_path))[0])
+        self.steps_data = result.steps
+        self.refresh_steps_list()
+        self.update_code_preview()
+        message = f"读取 {result.rows} 行, 导入 {len(result.steps)} 个步骤"
+        if result.error_count:
+            messagebox.showwarning("导入完成", f"{message}, {result.error_count} 行错误已跳过:\n"
+                                   + result.format_errors(10))
+        else:
+            messagebox.showinfo("导入完成", message)
         
     def save_process(self):
         process_name = self.process_name_var.get()
@@ -1290,27 +1108,18 @@ end
             
         file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON files", "*.json")])
         if file_path:
-            process_data = {
-                "name": process_name,
-                "description": self.process_desc_text.get("1.0", tk.END).strip(),
-                "steps": self.steps_data,
-                "created_time": datetime.now().isoformat(),
-                "version": "1.3_with_lua_and_loop_controls"
-            }
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(process_data, f, ensure_ascii=False, indent=2)
+            self.current_process().save(file_path)
             messagebox.showinfo("成功", "流程配置已保存")
             
     def load_process(self):
         file_path = filedialog.askopenfilename(filetypes=[("JSON files", "*.json")])
         if file_path:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                process_data = json.load(f)
+            process = Process.load(file_path)
             
-            self.process_name_var.set(process_data.get("name", ""))
+            self.process_name_var.set(process.name)
             self.process_desc_text.delete("1.0", tk.END)
-            self.process_desc_text.insert("1.0", process_data.get("description", ""))
-            self.steps_data = process_data.get("steps", [])
+            self.process_desc_text.insert("1.0", process.description)
+            self.steps_data = process.steps
             self.refresh_steps_list()
             self.update_code_preview()
             messagebox.showinfo("成功", "流程配置已加载")
@@ -1324,49 +1133,68 @@ end
         output_type = self.output_type.get()
         messagebox.showinfo("成功", f"{output_type}代码已生成")
         
+    def estimate_duration(self):
+        """时序仿真估算流程运行时长 (按当前的优化和并行调度设置)"""
+        if not self.steps_data:
+            messagebox.showwarning("警告", "请先添加处理步骤")
+            return
+        from liquid_sim import simulate
+        result = simulate(self.current_process(), self.optimize_var.get(), self.overlap_var.get(),
+                          self.group_waits_var.get(), self.switch_masks_var.get(), self.deadline_delays_var.get())
+        lines = [f"预计总时长: {result.total_ms / 1000:.3f}s",
+                 f"执行步骤数: {len(result.timings)}",
+                 f"最多同时运动的电机: {result.max_concurrent_moves}个",
+                 "",
+                 "关键路径耗时最长的步骤:"]
+        for timing in sorted(result.critical_path, key=lambda t: t.duration, reverse=True)[:10]:
+            lines.append(f"  步骤 {timing.label}: {timing.step.describe()}  {timing.duration / 1000:.3f}s")
+        lines.extend(f"⚠ {warning}" for warning in result.warnings[:10])
+        messagebox.showinfo("时长估算", "\n".join(lines))
+
+    def fold_repeats(self):
+        """连续重复的步骤序列折叠为循环步骤"""
+        if not self.steps_data:
+            messagebox.showwarning("警告", "请先添加处理步骤")
+            return
+        folded = fold_repeated_steps(self.steps_data)
+        if folded == self.steps_data:
+            messagebox.showinfo("提示", "未发现重复步骤")
+            return
+        if not messagebox.askyesno("确认折叠", f"连续重复的步骤将折叠为循环\n步骤数 {len(self.steps_data)} → {len(folded)}"):
+            return
+        self.steps_data = folded
+        self.refresh_steps_list()
+        self.update_code_preview()
+        print(f"🔁 已折叠重复步骤: {len(folded)} 个步骤")
+
     def save_c_code(self):
         """保存C代码"""
-        if self.output_type.get() != "C":
-            # 临时切换到C模式生成代码
-            old_type = self.output_type.get()
-            self.output_type.set("C")
-            c_code = self.generate_c_function() if self.steps_data else ""
-            self.output_type.set(old_type)
-        else:
-            c_code = self.code_preview.get("1.0", tk.END).strip()
-            
-        if not c_code:
-            messagebox.showwarning("警告", "没有可保存的C代码")
-            return
-            
-        file_path = filedialog.asksaveasfilename(defaultextension=".c", 
-                                               filetypes=[("C files", "*.c"), ("Text files", "*.txt")])
-        if file_path:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(c_code)
-            messagebox.showinfo("成功", "C代码已保存")
+        self.save_code("C", "C代码", ".c", [("C files", "*.c"), ("Text files", "*.txt")])
             
     def save_lua_code(self):
         """保存Lua脚本"""
-        if self.output_type.get() != "Lua":
-            # 临时切换到Lua模式生成代码
-            old_type = self.output_type.get()
-            self.output_type.set("Lua")
-            lua_code = self.generate_lua_function() if self.steps_data else ""
-            self.output_type.set(old_type)
-        else:
-            lua_code = self.code_preview.get("1.0", tk.END).strip()
-            
-        if not lua_code:
-            messagebox.showwarning("警告", "没有可保存的Lua脚本")
+        self.save_code("Lua", "Lua脚本", ".lua", [("Lua files", "*.lua"), ("Text files", "*.txt")])
+        
+    def save_code(self, output_type, label, extension, filetypes):
+        """保存代码: 预览被手动修改过(或尚无步骤)时保存预览内容, 否则直接将生成结果流式写入文件"""
+        preview_code = None
+        if self.output_type.get() == output_type and (self.code_preview.edit_modified() or not self.steps_data):
+            preview_code = self.code_preview.get("1.0", tk.END).strip()
+            if not preview_code:
+                messagebox.showwarning("警告", f"没有可保存的{label}")
+                return
+        elif not self.steps_data:
+            messagebox.showwarning("警告", f"没有可保存的{label}")
             return
             
-        file_path = filedialog.asksaveasfilename(defaultextension=".lua", 
-                                               filetypes=[("Lua files", "*.lua"), ("Text files", "*.txt")])
+        file_path = filedialog.asksaveasfilename(defaultextension=extension, filetypes=filetypes)
         if file_path:
             with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(lua_code)
-            messagebox.showinfo("成功", "Lua脚本已保存")
+                if preview_code is not None:
+                    f.write(preview_code)
+                else:
+                    self.generator.write(self.current_process(), output_type, f.write)
+            messagebox.showinfo("成功", f"{label}已保存")
 
 def main():
     try:
@@ -1380,44 +1208,24 @@ def main():
         y = (root.winfo_screenheight() // 2) - (height // 2)
         root.geometry(f'{width}x{height}+{x}+{y}')
         
-        print("🚀 液路流程配置工具启动成功 - 完整版 + Lua脚本支持")
-        print("\n🎯 新增功能:")
-        print("1. ✅ Lua脚本输出支持")
-        print("2. ✅ 双输出模式 - 可选择C语言或Lua脚本")
-        print("3. ✅ Lua风格的设备控制接口")
-        print("4. ✅ 独立的保存按钮支持两种格式")
-        print("5. ✅ 循环步骤编辑增强 - 完整的上移/下移功能")
-        
-        print("\n🔧 已修复的问题:")
-        print("1. ✅ 循环中电机控制参数缺失 (KeyError: 'param1')")
-        print("2. ✅ 循环下拉框选项与主界面不一致")
-        print("3. ✅ 循环中电机控制缺少同步/异步模式选择")
-        print("4. ✅ 统一了所有电机选项列表")
-        print("5. ✅ 修复了循环步骤上移下移按钮显示问题")
-        
-        print("\n📋 循环功能完整特性:")
-        print("🔘 添加到循环：将配置的步骤添加到循环序列")
-        print("🔘 删除选中：删除选中的循环步骤")
-        print("🔘 ↑ 上移：将选中步骤向上移动一位")
-        print("🔘 ↓ 下移：将选中步骤向下移动一位")  
-        print("🔘 清空全部：清空所有循环步骤（带确认提示）")
-        
-        print("\n⚡ 所有功能已完成:")
-        print("1. 阀门控制 - C: valve_set() / Lua: valve.xxx:set()")
-        print("2. 泵控制 - C: valve_set() / Lua: pump.xxx:set()")
-        print("3. 延时控制 - C: usleep() / Lua: time.sleep()")
-        print("4. 电机控制 - C: 同步/异步模式 / Lua: xxx_sync/xxx_async")
-        print("5. 电机等待 - C: motor_timedwait() / Lua: wait_complete()")
-        print("6. 循环功能 - C: for循环 / Lua: for循环 (完整编辑功能)")
-        print("7. 复合动作 - 自定义操作，两种语言实现")
-        print("\n🎉 工具可以正常使用了！现在循环中包含完整的上移下移按钮！")
+        print("🚀 液路流程配置工具启动成功")
         
         root.mainloop()
         
     except Exception as e:
+        import traceback
         print(f"❌ 程序启动失败: {e}")
         traceback.print_exc()
 
 
+def batch_main(argv=None):
+    """命令行批量生成入口, 参数见liquid_batch"""
+    import liquid_batch
+    return liquid_batch.main(argv)
+
+
 if __name__ == "__main__":
+    # 带参数运行时进入批量生成模式, 否则启动界面
+    if len(sys.argv) > 1:
+        sys.exit(batch_main(sys.argv[1:]))
     main()
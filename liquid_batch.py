@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+液路流程批量代码生成 - 命令行入口
+将save_process保存的流程JSON文件(或包含它们的目录)并行生成C代码和Lua脚本
+用法: python liquid_batch.py [-o 输出目录] [-j 进程数] [--cache-dir 缓存目录] [--deterministic] [-O] [--discover-loops] [--overlap]
+                            [--group-waits] [--switch-masks] [--c-table] [--deadline-delays] [--lua-locals] [--outline]
+                            [--timeout-margin 比例] [--timeout-margin-ms 毫秒] [--default-timeouts] 文件或目录...
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from liquid_cache import GenerationCache
+from liquid_core import DEFAULT_TIMEOUT_MARGIN, DEFAULT_TIMEOUT_MARGIN_MS, CodeGenerator, Process, write_atomic
+from liquid_table import runtime_files
+
+# 输出类型 -> 文件扩展名
+OUTPUT_EXTENSIONS = {"C": ".c", "Lua": ".lua"}
+
+# --outline 时输出的流程库文件名 (不含扩展名)
+LIBRARY_NAME = "liquid_library"
+
+
+def collect_process_files(paths):
+    """展开文件和目录参数, 返回 (流程文件路径, 相对路径) 列表"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if file_name.lower().endswith(".json"):
+                        file_path = os.path.join(dir_path, file_name)
+                        files.append((file_path, os.path.relpath(file_path, path)))
+        else:
+            files.append((path, os.path.basename(path)))
+    return files
+
+
+def compile_process_file(file_path, output_base, cache_dir=None, generator_options=None):
+    """生成单个流程文件的C和Lua输出 (在工作进程中执行)
+
+    generator_options 为 CodeGenerator 的关键字参数;
+    返回 (输入文件, 输出文件列表, 耗时秒数, 错误信息或None, 缓存命中数)
+    """
+    start = time.perf_counter()
+    outputs = []
+    hits = 0
+    try:
+        process = Process.load(file_path)
+        generator = CodeGenerator(**(generator_options or {}))
+        cache = GenerationCache(cache_dir) if cache_dir else None
+        for output_type, ext in OUTPUT_EXTENSIONS.items():
+            output_path = output_base + ext
+            if cache:
+                code, hit = cache.generate(process, output_type, generator)
+                hits += hit
+            else:
+                code = generator.generate(process, output_type)
+            write_atomic(output_path, code)
+            outputs.append(output_path)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return file_path, outputs, time.perf_counter() - start, error, hits
+
+
+def build_library(files, output_dir, generator_options):
+    """生成流程库: 公共序列提取需要全部流程, 在主进程中加载后一次生成"""
+    start = time.perf_counter()
+    processes = []
+    failures = 0
+    for file_path, _ in files:
+        try:
+            processes.append(Process.load(file_path))
+        except Exception as e:
+            failures += 1
+            print(f"❌ {file_path}: {type(e).__name__}: {e}", file=sys.stderr)
+
+    generator = CodeGenerator(**generator_options)
+    outputs = []
+    for output_type, ext in OUTPUT_EXTENSIONS.items():
+        output_path = os.path.join(output_dir, LIBRARY_NAME + ext)
+        write_atomic(output_path, generator.generate_library(processes, output_type))
+        outputs.append(output_path)
+    if generator.c_table:
+        for file_name, content in runtime_files().items():
+            write_atomic(os.path.join(output_dir, file_name), content)
+    print(f"✅ {len(processes)} 个流程 -> {', '.join(outputs)}")
+    print(f"\n共 {len(files)} 个流程, 失败 {failures} 个, 用时 {time.perf_counter() - start:.2f}s")
+    return 1 if failures else 0
+
+
+def output_base_for(file_path, rel_path, output_dir):
+    """输出文件路径(不含扩展名): 默认与输入文件同目录, 指定输出目录时保留相对路径"""
+    if output_dir:
+        return os.path.join(output_dir, os.path.splitext(rel_path)[0])
+    return os.path.splitext(file_path)[0]
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="liquid_batch",
+        description="批量将液路流程JSON文件生成C代码和Lua脚本")
+    parser.add_argument("paths", nargs="+", help="流程JSON文件或目录")
+    parser.add_argument("-o", "--output-dir", help="输出目录 (默认与输入文件同目录)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="并行进程数 (默认CPU核数, 1表示不启用进程池)")
+    parser.add_argument("--cache-dir", help="生成缓存目录, 内容未变化的流程直接使用缓存结果 (需同时指定--deterministic)")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="不在输出中写入生成时间, 保证输出逐字节稳定")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="优化生成代码: 合并连续延时, 删除重复的阀门/泵设置和多余的电机等待, 折叠循环次数")
+    parser.add_argument("--discover-loops", action="store_true",
+                        help="连续重复的步骤序列折叠为循环后生成")
+    parser.add_argument("--overlap", action="store_true",
+                        help="电机并行调度: 阀门/泵/延时之间的异步电机运动尽早启动, 等待推迟到该电机下一次使用之前")
+    parser.add_argument("--group-waits", action="store_true",
+                        help="连续的电机等待合并为一次等待全部电机完成, 共用一个截止时间")
+    parser.add_argument("--switch-masks", action="store_true",
+                        help="连续的阀门/泵开关合并为一次 valve_set_mask(开掩码, 关掩码) (C语言)")
+    parser.add_argument("--c-table", action="store_true",
+                        help="C语言输出为步骤记录表, 由共用的解释函数执行 (同时在输出目录写入liquid_table.h/.c)")
+    parser.add_argument("--deadline-delays", action="store_true",
+                        help="延时等待到从函数入口累计的截止时间, 其它步骤的耗时不累积到延时上")
+    parser.add_argument("--lua-locals", action="store_true",
+                        help="Lua函数入口将设备对象绑定为局部变量, 循环内缓存方法引用")
+    parser.add_argument("--outline", action="store_true",
+                        help=f"全部流程输出到一个流程库 {LIBRARY_NAME}.c/.lua, 重复的步骤序列提取为共用函数")
+    parser.add_argument("--timeout-margin", type=float, default=DEFAULT_TIMEOUT_MARGIN,
+                        help=f"电机等待超时相对运动时间的比例余量 (默认{DEFAULT_TIMEOUT_MARGIN})")
+    parser.add_argument("--timeout-margin-ms", type=int, default=DEFAULT_TIMEOUT_MARGIN_MS,
+                        help=f"电机等待超时的固定余量, 毫秒 (默认{DEFAULT_TIMEOUT_MARGIN_MS})")
+    parser.add_argument("--default-timeouts", action="store_true",
+                        help="异步电机等待使用默认超时 (MOTOR_DEFAULT_TIMEOUT/20000), 不按运动参数计算")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    files = collect_process_files(args.paths)
+    if not files:
+        print("❌ 未找到流程文件", file=sys.stderr)
+        return 1
+
+    generator_options = {
+        "deterministic": args.deterministic,
+        "optimize": args.optimize,
+        "overlap": args.overlap,
+        "discover_loops": args.discover_loops,
+        "group_waits": args.group_waits,
+        "switch_masks": args.switch_masks,
+        "c_table": args.c_table,
+        "lua_locals": args.lua_locals,
+        "deadline_delays": args.deadline_delays,
+        "kinematic_timeouts": not args.default_timeouts,
+        "timeout_margin": args.timeout_margin,
+        "timeout_margin_ms": args.timeout_margin_ms,
+    }
+    if args.outline:
+        return build_library(files, args.output_dir or ".", generator_options)
+
+    if args.cache_dir and not args.deterministic:
+        print("⚠ 未指定--deterministic, 输出含生成时间, 不使用生成缓存", file=sys.stderr)
+
+    tasks = [(file_path, output_base_for(file_path, rel_path, args.output_dir), args.cache_dir, generator_options)
+             for file_path, rel_path in files]
+    jobs = args.jobs or os.cpu_count() or 1
+    jobs = min(jobs, len(tasks))
+
+    start = time.perf_counter()
+    if jobs <= 1:
+        results = (compile_process_file(*task) for task in tasks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(compile_process_file, *zip(*tasks), chunksize=max(1, len(tasks) // (jobs * 4)))
+
+    failures = 0
+    cache_hits = 0
+    try:
+        for file_path, outputs, elapsed, error, hits in results:
+            cache_hits += hits
+            if error:
+                failures += 1
+                print(f"❌ {file_path} ({elapsed * 1000:.1f}ms): {error}", file=sys.stderr)
+            else:
+                cached = " [缓存]" if hits == len(OUTPUT_EXTENSIONS) else ""
+                print(f"✅ {file_path} ({elapsed * 1000:.1f}ms){cached} -> {', '.join(outputs)}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if args.c_table:
+        # 表驱动输出共用的解释函数, 每个输出目录写入一份
+        for dir_path in sorted({os.path.dirname(os.path.abspath(task[1])) for task in tasks}):
+            for file_name, content in runtime_files().items():
+                write_atomic(os.path.join(dir_path, file_name), content)
+            print(f"✅ 解释函数 -> {dir_path}")
+
+    total = time.perf_counter() - start
+    print(f"\n共 {len(tasks)} 个流程, 失败 {failures} 个, 用时 {total:.2f}s (进程数 {jobs})")
+    if args.cache_dir and args.deterministic:
+        print(f"缓存命中 {cache_hits}/{len(tasks) * len(OUTPUT_EXTENSIONS)}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+液路流程生成缓存 - 按内容哈希缓存生成结果
+键由规范化的流程JSON、输出类型、设备映射和生成器版本计算, 命中时直接返回已生成的代码;
+只缓存 deterministic 生成器的输出, 其它输出含生成时间, 不能重复使用
+"""
+
+import hashlib
+import os
+
+from liquid_core import write_atomic
+
+
+class GenerationCache:
+    """磁盘生成缓存, 每个条目保存为 cache_dir/<前2位>/<哈希>.<输出类型>"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(process, output_type, generator):
+        digest = hashlib.sha256()
+        for part in (process.normalized_json(), output_type, generator.config_json()):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _entry_path(self, key, output_type):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{output_type.lower()}")
+
+    def get(self, key, output_type):
+        """返回缓存的代码, 未命中时返回None"""
+        try:
+            with open(self._entry_path(key, output_type), 'r', encoding='utf-8') as f:
+                code = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return code
+
+    def put(self, key, output_type, code):
+        write_atomic(self._entry_path(key, output_type), code)
+
+    def generate(self, process, output_type, generator):
+        """带缓存的生成: 命中时跳过生成, 返回 (代码, 是否命中); 生成器不是deterministic时不使用缓存"""
+        if not generator.deterministic:
+            return generator.generate(process, output_type), False
+        key = self.make_key(process, output_type, generator)
+        code = self.get(key, output_type)
+        if code is not None:
+            return code, True
+        code = generator.generate(process, output_type)
+        self.put(key, output_type, code)
+        return code, False
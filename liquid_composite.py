@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+复合动作语言 - 复合动作描述的词法/语法分析, 编译为普通步骤(Step)
+
+语句以换行或分号分隔, # 之后为注释:
+    移动 电机 距离 [速度 值] [加速度 值]     步进移动并等待完成
+    启动 电机 距离 [速度 值] [加速度 值]     步进移动, 不等待 (之后用"等待")
+    复位 电机                                复位并等待完成
+    等待 电机 [超时 值]                      等待电机完成
+    延时 时间[ms|s]
+    阀门 阀门名 开|关
+    泵 泵名 开|关
+    重复 次数 [次] { 语句... }
+    并行 { 语句... }                          块内的移动/复位同时启动, 块结束时依次等待完成
+
+数值可以是整数或宏名 (延时时间只能是非负整数), 与前面的关键字、速度/加速度/超时和后面的次、单位之间可以不加空格 (如"速度20000"、"重复3次")。
+编译结果与界面添加的步骤相同, 各后端和优化按普通步骤处理;
+不是该语言的描述(如"针下、上1800脉冲重复3次")由 legacy_needle_motion 识别。
+"""
+
+import functools
+import re
+
+from liquid_model import (
+    MOTOR_OPTIONS, OP_DELAY, OP_LOOP, OP_MOTOR, OP_MOTOR_WAIT, OP_PUMP, OP_VALVE, PUMP_OPTIONS, VALVE_OPTIONS,
+    MOTOR_CMD_MOVE_STEP, MOTOR_CMD_RESET, Step, device_id,
+)
+
+# 未指定时的运动参数和等待超时 (与界面添加的步骤一致)
+DEFAULT_SPEED = 20000
+DEFAULT_ACC = 50000
+DEFAULT_WAIT_TIMEOUT = 20000
+
+KEYWORDS = ("移动", "启动", "复位", "等待", "延时", "阀门", "泵", "重复", "并行")
+_MOTION_OPTIONS = {"速度": "speed", "加速度": "acc"}
+
+_TOKEN = re.compile(r"""
+    (?P<space>[ \t\r]+|[#].*)
+  | (?P<sep>[\n;；])
+  | (?P<brace>[{}])
+  | (?P<keyword>""" + "|".join(KEYWORDS) + r""")
+  | (?P<option>加速度|速度|超时)
+  | (?P<num>-?\d+)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*|[^\W\d]\w*)
+""", re.VERBOSE)
+
+_UNITS = {"ms": False, "毫秒": False, "s": True, "秒": True}
+_SWITCH = {"开": True, "关": False}
+
+# 语句 (语法树节点), line为所在行:
+#   ("move", line, 电机, 距离, 速度, 加速度, 是否等待)   ("reset", line, 电机)
+#   ("wait", line, 电机, 超时或None)   ("delay", line, 时间, 单位为s)
+#   ("valve"/"pump", line, 设备, 开)   ("repeat", line, 次数, 语句)   ("parallel", line, 语句)
+
+
+def tokenize(text):
+    """描述 -> [(类型, 值, 行号)], 无法识别的字符抛出ValueError"""
+    tokens = []
+    line = 1
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise ValueError(f"第{line}行: 无法识别的字符 {text[pos]!r}")
+        kind = match.lastgroup
+        if kind == "sep":
+            tokens.append(("sep", match.group(), line))
+            if match.group() == "\n":
+                line += 1
+        elif kind != "space":
+            tokens.append((kind, match.group(), line))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else ("end", "", self.line())
+
+    def line(self):
+        return self.tokens[-1][2] if self.tokens else 1
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def error(self, message, token=None):
+        token = token or self.peek()
+        return ValueError(f"第{token[2]}行: {message}")
+
+    def expect(self, kind, value=None):
+        token = self.next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            shown = token[1] or "结尾"
+            raise self.error(f"应为{value or kind}, 实际为 {shown!r}", token)
+        return token
+
+    def block(self, closing):
+        statements = []
+        while True:
+            kind, value, _ = self.peek()
+            if kind == "sep":
+                self.next()
+            elif kind == "end" or (kind == "brace" and value == "}"):
+                if closing != (kind == "brace"):
+                    raise self.error("缺少 '}'" if closing else "多余的 '}'")
+                if closing:
+                    self.next()
+                return statements
+            else:
+                statements.append(self.statement())
+                if self.peek()[0] not in ("sep", "end", "brace"):
+                    raise self.error(f"语句之后应换行或加分号, 实际为 {self.peek()[1]!r}")
+
+    def value(self):
+        kind, value, _ = token = self.next()
+        if kind == "num":
+            return int(value)
+        if kind == "name" and re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", value):
+            return value
+        raise self.error(f"应为数值或宏名, 实际为 {value or '结尾'!r}", token)
+
+    def device(self, options, what):
+        token = self.next()
+        if token[0] != "name" or token[1] not in options:
+            raise self.error(f"未知{what} {token[1] or '结尾'!r}", token)
+        return token[1]
+
+    def switch(self):
+        token = self.next()
+        if token[1] not in _SWITCH:
+            raise self.error(f"应为 开 或 关, 实际为 {token[1] or '结尾'!r}", token)
+        return _SWITCH[token[1]]
+
+    def statement(self):
+        kind, keyword, line = token = self.next()
+        if kind != "keyword":
+            raise self.error(f"未知语句 {keyword!r}", token)
+        if keyword in ("移动", "启动"):
+            motor = self.device(MOTOR_OPTIONS, "电机")
+            distance = self.value()
+            motion = {"speed": DEFAULT_SPEED, "acc": DEFAULT_ACC}
+            while self.peek()[1] in _MOTION_OPTIONS:
+                option = _MOTION_OPTIONS[self.next()[1]]
+                motion[option] = self.value()
+            return ("move", line, motor, distance, motion["speed"], motion["acc"], keyword == "移动")
+        if keyword == "复位":
+            return ("reset", line, self.device(MOTOR_OPTIONS, "电机"))
+        if keyword == "等待":
+            motor = self.device(MOTOR_OPTIONS, "电机")
+            timeout = None
+            if self.peek()[1] == "超时":
+                self.next()
+                timeout = self.value()
+            return ("wait", line, motor, timeout)
+        if keyword == "延时":
+            kind, value, _ = token = self.next()
+            if kind != "num" or value.startswith("-"):
+                raise self.error(f"延时时间应为非负整数, 实际为 {value or '结尾'!r}", token)
+            time = int(value)
+            seconds = False
+            if self.peek()[1] in _UNITS:
+                seconds = _UNITS[self.next()[1]]
+            return ("delay", line, time, seconds)
+        if keyword == "阀门":
+            return ("valve", line, self.device(VALVE_OPTIONS, "阀门"), self.switch())
+        if keyword == "泵":
+            return ("pump", line, self.device(PUMP_OPTIONS, "泵"), self.switch())
+        if keyword == "重复":
+            count = self.value()
+            if self.peek()[1] == "次":
+                self.next()
+            self.expect("brace", "{")
+            return ("repeat", line, count, self.block(True))
+        self.expect("brace", "{")
+        body = self.block(True)
+        for statement in body:
+            if statement[0] in ("repeat", "parallel", "wait"):
+                raise ValueError(f"第{statement[1]}行: 并行块中不能使用等待、重复和并行")
+        return ("parallel", line, body)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_composite(text):
+    """复合动作描述 -> 语句元组, 语法错误抛出ValueError (按描述缓存)"""
+    statements = _Parser(tokenize(text)).block(False)
+    if not statements:
+        raise ValueError("复合动作为空")
+    return tuple(statements)
+
+
+def _motion_wait(move):
+    """等待启动的运动完成: 不指定超时, 由后端按运动参数确定 (与立即等待相同)"""
+    return Step(OP_MOTOR_WAIT, move.device, move.command, 0, move.p1, move.p2, move.p3)
+
+
+def _compile(statements, started):
+    """语句 -> 步骤列表; started 为已启动未等待的电机 -> 启动步骤, 用于确定等待的超时"""
+    steps = []
+    for statement in statements:
+        kind = statement[0]
+        if kind == "move" or kind == "reset":
+            if kind == "move":
+                _, _, motor, distance, speed, acc, wait = statement
+                command = MOTOR_CMD_MOVE_STEP
+            else:
+                motor, distance, speed, acc, wait = statement[2], 0, DEFAULT_SPEED, DEFAULT_ACC, True
+                command = MOTOR_CMD_RESET
+            step = Step(OP_MOTOR, device_id(motor), command, Step.FLAG_WAIT if wait else 0, distance, speed, acc)
+            if not wait:
+                started[step.device] = step
+            steps.append(step)
+        elif kind == "wait":
+            device = device_id(statement[2])
+            move = started.pop(device, None)
+            if statement[3] is None and move is not None:
+                steps.append(_motion_wait(move))
+            else:
+                timeout = DEFAULT_WAIT_TIMEOUT if statement[3] is None else statement[3]
+                steps.append(Step(OP_MOTOR_WAIT, device, timeout=timeout))
+        elif kind == "delay":
+            steps.append(Step(OP_DELAY, flags=Step.FLAG_SECONDS if statement[3] else 0, p1=statement[2]))
+        elif kind == "valve" or kind == "pump":
+            steps.append(Step(OP_VALVE if kind == "valve" else OP_PUMP, device_id(statement[2]),
+                              flags=Step.FLAG_ON if statement[3] else 0))
+        elif kind == "repeat":
+            steps.append(Step(OP_LOOP, p1=statement[2], steps=tuple(_compile(statement[3], dict(started)))))
+        else:
+            moves = {}
+            for step in _compile(statement[2], started):
+                if step.op == OP_MOTOR and step.flags & Step.FLAG_WAIT:
+                    if step.device in moves:
+                        raise ValueError(f"第{statement[1]}行: 并行块中{step.device_name}多次运动")
+                    step = Step(OP_MOTOR, step.device, step.command, Step.FLAG_WAIT_LATER, step.p1, step.p2, step.p3)
+                    moves[step.device] = step
+                steps.append(step)
+            steps.extend(_motion_wait(move) for move in moves.values())
+    return steps
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_composite(text):
+    """复合动作描述 -> 步骤元组, 不是复合动作语言时返回None (按描述缓存)"""
+    try:
+        return tuple(_compile(parse_composite(text), {}))
+    except ValueError:
+        return None
+
+
+def composite_error(text):
+    """复合动作描述的错误信息, 可以编译时返回None"""
+    try:
+        _compile(parse_composite(text), {})
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+_LEGACY_PULSES = re.compile(r'(\d+)脉冲')
+_LEGACY_REPEATS = re.compile(r'重复(\d+)次')
+
+
+@functools.lru_cache(maxsize=1024)
+def legacy_needle_motion(text):
+    """旧格式的"针下、上N脉冲重复M次"描述 -> (脉冲数, 次数) 字符串, 其它描述返回None"""
+    if "针下、上" not in text or "脉冲" not in text:
+        return None
+    pulse_match = _LEGACY_PULSES.search(text)
+    repeat_match = _LEGACY_REPEATS.search(text)
+    return (pulse_match.group(1) if pulse_match else "1800",
+            repeat_match.group(1) if repeat_match else "1")
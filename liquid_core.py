@@ -0,0 +1,957 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+液路流程代码生成核心 - 无界面依赖
+包含C/Lua代码生成后端, 流程模型见liquid_model, 中间表示与优化见liquid_ir
+不导入tkinter，可在构建服务器等无显示环境下直接使用
+"""
+
+import copy
+import json
+import os
+import re
+from datetime import datetime
+
+from liquid_model import (
+    PROCESS_FILE_VERSION, STEP_TYPES, LOOP_STEP_TYPES,
+    VALVE_OPTIONS, PUMP_OPTIONS, MOTOR_OPTIONS, MOTOR_COMMANDS, DEVICE_MAPPING, LUA_DEVICE_MAPPING,
+    C_MOTOR_COMMANDS, LUA_MOTOR_COMMANDS, C_MOTOR_COMMAND_NAMES, LUA_MOTOR_COMMAND_NAMES,
+    OP_VALVE, OP_PUMP, OP_DELAY, OP_MOTOR, OP_MOTOR_WAIT, OP_LOOP, OP_COMPOSITE, OP_UNKNOWN, OP_CALL, STEP_OPCODES,
+    DEVICE_NAMES, DEVICE_IDS, MOTOR_COMMAND_IDS, MOTOR_CMD_MOVE_STEP,
+    DEFAULT_TIMEOUT_MARGIN, DEFAULT_TIMEOUT_MARGIN_MS, motor_timeout_ms,
+    make_func_name, device_id, parse_number, describe_step_dict, get_step_description, Step, Process,
+)
+from liquid_ir import (
+    batched_switch_devices, build_ir, has_delays, has_grouped_waits, loop_depth, lower, outline_common_sequences, step_nodes,
+)
+from liquid_composite import legacy_needle_motion
+from liquid_table import emit_c_table_function
+
+# 代码生成器版本 - 生成结果变化时递增, 使旧的生成缓存失效
+GENERATOR_VERSION = "5"
+
+# 合并的电机等待使用的辅助函数, 生成的代码中有合并等待时输出在函数之前
+C_WAIT_ALL_HELPER = """#ifndef LIQUID_MOTOR_WAIT_ALL_DEFINED
+#define LIQUID_MOTOR_WAIT_ALL_DEFINED
+#define LIQUID_MAX(a, b) ((a) > (b) ? (a) : (b))
+
+/* 等待多个电机完成, 共用截止时间deadline(ms): 全部完成返回0, 超时返回-1 */
+static int liquid_motor_wait_all(const int *motors, int count, unsigned long long deadline)
+{
+    int k;
+
+    for (k = 0; k < count; k++) {
+        unsigned long long now = get_time();
+        if (motor_timedwait(motors[k], now < deadline ? (int)(deadline - now) : 0) != 0) {
+            return -1;
+        }
+    }
+    return 0;
+}
+#endif
+
+"""
+
+# 截止时间延时使用的辅助函数, 启用 deadline_delays 时输出在函数之前
+C_SLEEP_UNTIL_HELPER = """#ifndef LIQUID_SLEEP_UNTIL_DEFINED
+#define LIQUID_SLEEP_UNTIL_DEFINED
+
+/* 等待到截止时间deadline(ms, get_time()时钟), 已超过时立即返回 */
+static void liquid_sleep_until(unsigned long long deadline)
+{
+    unsigned long long now = get_time();
+
+    if (now < deadline) {
+        usleep((deadline - now) * 1000);
+    }
+}
+#endif
+
+"""
+
+LUA_SLEEP_UNTIL_HELPER = """-- 等待到截止时间deadline(ms, time.get_time()时钟), 已超过时立即返回
+local function sleep_until(deadline)
+    local remaining = deadline - time.get_time()
+    if remaining > 0 then
+        time.sleep(remaining)
+    end
+end
+"""
+
+LUA_WAIT_ALL_HELPER = """-- 等待多个电机完成, 共用超时timeout(ms): 全部完成返回true, 超时返回false
+-- 截止时间由 time.get_time() 计算, 查询电机状态和休眠的耗时都计入超时。
+-- 要求 m:wait_complete(0) 为非阻塞查询 (超时为0时立即返回是否已完成)。
+-- 电机对象只提供阻塞等待和查询, 没有可挂起的等待接口, 因此用轮询(间隔不超过10ms)代替协程并发等待。
+local function wait_all_complete(motors, timeout)
+    local done = {}
+    local pending = #motors
+    local deadline = time.get_time() + timeout
+    while true do
+        for k, m in ipairs(motors) do
+            if not done[k] and m:wait_complete(0) then
+                done[k] = true
+                pending = pending - 1
+            end
+        end
+        if pending == 0 then
+            return true
+        end
+        local remaining = deadline - time.get_time()
+        if remaining <= 0 then
+            return false
+        end
+        time.sleep(math.min(remaining, 10))
+    end
+end
+"""
+
+
+def write_atomic(file_path, content):
+    """先写入同目录临时文件再替换, 避免中断时留下不完整的输出"""
+    import tempfile  # 只在写文件时用到, 不影响界面启动时间
+
+    dir_path = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(dir_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=".tmp_", suffix=os.path.splitext(file_path)[1])
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# 复合动作(针下、上)使用的Lua电机对象
+LUA_NEEDLE_S_Z = "motor.needle_s_z"
+
+_LUA_PATH = re.compile(r"[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)+", re.ASCII)
+
+
+def lua_local_name(path):
+    """Lua全局表中的对象路径 -> 绑定的局部变量名 (valve.sv3 -> valve_sv3); 不是 表.字段 形式时返回None, 不绑定"""
+    return path.replace(".", "_") if _LUA_PATH.fullmatch(path) else None
+
+
+def loop_var(depth):
+    """第depth层(最外层为0)循环的循环变量名: i, i1, i2, ..."""
+    return f"i{depth}" if depth else "i"
+
+
+class CodeWriter:
+    """带缩进管理的代码输出器
+
+    按行写入代码片段, 缩进由 indented() 维护, 不需要事后再拆分重排。
+    sink 为可调用对象 (list.append、文件的 write、预览控件的插入等),
+    输出在累计到 chunk_size 字符时批量交给 sink; 未指定 sink 时保存在内存中, 用 getvalue() 取回。
+    """
+
+    INDENT = "    "
+
+    def __init__(self, sink=None, level=0, chunk_size=65536):
+        self.sink = sink
+        self.level = level
+        self.chunk_size = chunk_size
+        self._prefix = self.INDENT * level
+        self._chunks = []
+        self._pending = 0
+
+    def write(self, text):
+        """原样写入文本"""
+        self._chunks.append(text)
+        if self.sink is not None:
+            self._pending += len(text)
+            if self._pending >= self.chunk_size:
+                self.flush()
+
+    def line(self, text=""):
+        """写入一行, 非空行加上当前缩进"""
+        chunk = self._prefix + text + "\n" if text else "\n"
+        self._chunks.append(chunk)
+        if self.sink is not None:
+            self._pending += len(chunk)
+            if self._pending >= self.chunk_size:
+                self.flush()
+
+    def indented(self):
+        """with w.indented(): 块内的行增加一级缩进"""
+        return self
+
+    def __enter__(self):
+        self.level += 1
+        self._prefix = self.INDENT * self.level
+        return self
+
+    def __exit__(self, *exc_info):
+        self.level -= 1
+        self._prefix = self.INDENT * self.level
+
+    def flush(self):
+        if self.sink is not None and self._chunks:
+            self.sink("".join(self._chunks))
+            self._chunks.clear()
+            self._pending = 0
+
+    def getvalue(self):
+        return "".join(self._chunks)
+
+
+class CodeGenerator:
+    """C/Lua代码生成后端
+
+    两种后端都从步骤列表构建的IR(见liquid_ir)输出代码。
+    deterministic=True 时不在输出中写入生成时间, 相同输入得到逐字节相同的输出;
+    optimize=True 时先对IR执行优化流水线 (延时合并、冗余开关消除、无效等待消除、循环次数折叠);
+    overlap=True 时对IR做电机并行调度, 在相邻的阀门/泵/延时/同步电机控制之间异步电机运动尽早启动、等待尽量推迟;
+    kinematic_timeouts=True 时异步电机的等待超时由运动参数计算 (见 motor_wait_timeout), 否则使用默认超时;
+    group_waits=True 时连续的电机等待合并为一次等待全部电机完成, 共用一个截止时间;
+    switch_masks=True 时连续的阀门/泵开关合并为一次 valve_set_mask(开掩码, 关掩码) (C语言),
+    位掩码由设备映射中的设备宏生成;
+    c_table=True 时C语言输出为步骤记录表和共用的解释函数 (见liquid_table), 代码大小不随步骤数增长;
+    discover_loops=True 时连续重复的步骤序列先折叠为循环 (见 liquid_ir.discover_loops);
+    lua_locals=True 时Lua函数入口将用到的设备对象绑定为局部变量, 循环内调用的方法和 time.sleep 另外缓存引用,
+    避免每次调用都查找全局表和字段;
+    deadline_delays=True 时延时按截止时间执行: 截止时间从函数入口的 get_time() 开始, 每个延时累加延时时间后等待到
+    截止时间, 阀门开关等步骤的耗时计入延时而不累积; 电机等待等阻塞步骤之后截止时间重新取当前时间
+    """
+
+    def __init__(self, device_mapping=None, lua_device_mapping=None, deterministic=False, optimize=False,
+                 overlap=False, kinematic_timeouts=True, timeout_margin=DEFAULT_TIMEOUT_MARGIN,
+                 timeout_margin_ms=DEFAULT_TIMEOUT_MARGIN_MS, group_waits=False, switch_masks=False,
+                 c_table=False, discover_loops=False, lua_locals=False, deadline_delays=False):
+        self.device_mapping = dict(DEVICE_MAPPING if device_mapping is None else device_mapping)
+        self.lua_device_mapping = dict(LUA_DEVICE_MAPPING if lua_device_mapping is None else lua_device_mapping)
+        self.deterministic = deterministic
+        self.optimize = optimize
+        self.overlap = overlap
+        self.kinematic_timeouts = kinematic_timeouts
+        self.timeout_margin = timeout_margin
+        self.timeout_margin_ms = timeout_margin_ms
+        self.group_waits = group_waits
+        self.switch_masks = switch_masks
+        self.c_table = c_table
+        self.discover_loops = discover_loops
+        self.lua_locals = lua_locals
+        self.deadline_delays = deadline_delays
+
+    def snapshot(self):
+        """当前配置的副本 (设备映射也复制), 之后修改本对象的选项和映射不影响副本; 供后台线程生成使用"""
+        generator = copy.copy(self)
+        generator.device_mapping = dict(self.device_mapping)
+        generator.lua_device_mapping = dict(self.lua_device_mapping)
+        return generator
+
+    def config_json(self):
+        """影响生成结果的生成器配置, 用于生成缓存的键"""
+        return json.dumps({
+            "version": GENERATOR_VERSION,
+            "device_mapping": self.device_mapping,
+            "lua_device_mapping": self.lua_device_mapping,
+            "deterministic": self.deterministic,
+            "optimize": self.optimize,
+            "overlap": self.overlap,
+            "kinematic_timeouts": self.kinematic_timeouts,
+            "timeout_margin": self.timeout_margin,
+            "timeout_margin_ms": self.timeout_margin_ms,
+            "group_waits": self.group_waits,
+            "switch_masks": self.switch_masks,
+            "c_table": self.c_table,
+            "discover_loops": self.discover_loops,
+            "lua_locals": self.lua_locals,
+            "deadline_delays": self.deadline_delays,
+        }, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+    def generate(self, process, output_type="C"):
+        """按输出类型生成完整函数"""
+        writer = CodeWriter()
+        self.emit(process, output_type, writer)
+        return writer.getvalue()
+
+    def write(self, process, output_type, sink):
+        """按输出类型生成完整函数, 直接流式写入sink (如文件的write)"""
+        writer = CodeWriter(sink)
+        self.emit(process, output_type, writer)
+        writer.flush()
+
+    def lower(self, steps):
+        """步骤列表 -> 后端输出用的IR节点列表"""
+        return lower(steps, self.optimize, self.overlap, self.group_waits, self.switch_masks, self.discover_loops)
+
+    def emit(self, process, output_type, w):
+        if output_type == "C":
+            self.emit_c_function(process, w)
+        else:
+            self.emit_lua_function(process, w)
+
+    def generate_library(self, processes, output_type="C", min_length=3):
+        """生成流程库: 各流程中重复出现的步骤序列提取为共用函数, 之后依次输出各流程的函数
+
+        公共函数为C的 static 函数、Lua的 local function, 所以流程库需作为一个文件编译/加载;
+        表驱动的C输出已与步骤数无关, 不再提取公共序列
+        """
+        writer = CodeWriter()
+        self.emit_library(processes, output_type, writer, min_length)
+        return writer.getvalue()
+
+    def emit_library(self, processes, output_type, w, min_length=3):
+        programs = [self.lower(process.steps) for process in processes]
+        if output_type == "C" and self.c_table:
+            for process, nodes in zip(processes, programs):
+                emit_c_table_function(self, process, nodes, w)
+                w.write("\n")
+            return
+        helpers, programs = outline_common_sequences(programs, min_length)
+        all_nodes = [node for _, nodes in helpers for node in nodes] + [node for nodes in programs for node in nodes]
+
+        if output_type == "C":
+            self.emit_c_support(all_nodes, w)
+            for name, nodes in helpers:
+                self.emit_c_helper(name, nodes, w)
+            for process, nodes in zip(processes, programs):
+                self.emit_c_prologue(process, w, nodes, support=False)
+                with w.indented():
+                    for node in nodes:
+                        self.emit_c_node(node, w)
+                self.emit_c_epilogue(process, w)
+                w.write("\n")
+        else:
+            if has_grouped_waits(all_nodes):
+                w.write(LUA_WAIT_ALL_HELPER)
+                w.write("\n")
+            if self.deadline_delays and has_delays(all_nodes):
+                w.write(LUA_SLEEP_UNTIL_HELPER)
+                w.write("\n")
+            for name, nodes in helpers:
+                self.emit_lua_helper(name, nodes, w)
+            for process, nodes in zip(processes, programs):
+                self.emit_lua_prologue(process, w, nodes, support=False)
+                with w.indented():
+                    for node in nodes:
+                        self.emit_lua_node(node, w)
+                self.emit_lua_epilogue(process, w)
+                w.write("\n")
+
+    def generate_c_function(self, process):
+        return self.generate(process, "C")
+
+    def generate_lua_function(self, process):
+        """生成Lua脚本函数"""
+        return self.generate(process, "Lua")
+
+    def generate_c_step_code(self, step, step_index):
+        """生成C语言步骤代码"""
+        writer = CodeWriter(level=1)
+        self.emit_c_step(step, step_index, writer)
+        return writer.getvalue()
+
+    def generate_lua_step_code(self, step, step_index):
+        """生成Lua脚本步骤代码"""
+        writer = CodeWriter(level=1)
+        self.emit_lua_step(step, step_index, writer)
+        return writer.getvalue()
+
+    def emit_c_function(self, process, w):
+        nodes = self.lower(process.steps)
+        if self.c_table:
+            emit_c_table_function(self, process, nodes, w)
+            return
+        self.emit_c_prologue(process, w, nodes)
+        with w.indented():
+            for node in nodes:
+                self.emit_c_node(node, w)
+        self.emit_c_epilogue(process, w)
+
+    def emit_c_prologue(self, process, w, nodes=(), support=True):
+        """函数头, 声明nodes中各层循环的循环变量; support为True且nodes中有批量开关时先输出位掩码定义,
+        有合并的电机等待时先输出等待辅助函数, 启用 deadline_delays 且有延时时先输出截止时间延时函数"""
+        process_name = process.display_name
+        if support:
+            self.emit_c_support(nodes, w)
+        loop_vars = "".join(f"    int {loop_var(depth)} = 0;\n" for depth in range(1, loop_depth(nodes)))
+        if self.deadline_delays:
+            loop_vars += "    unsigned long long deadline = get_time();\n"
+        w.write(f"""/* {process.description or process_name} */
+void {process.func_name}(void)
+{{
+    int i = 0;
+{loop_vars}
+    LOG("%llu", {"deadline" if self.deadline_delays else "get_time()"});
+    LOG("liquid_circuit: {process_name} start\\n");
+    
+""")
+
+    def emit_c_support(self, nodes, w):
+        """输出nodes用到的位掩码定义和等待辅助函数"""
+        self.emit_c_switch_masks(nodes, w)
+        if has_grouped_waits(nodes):
+            w.write(C_WAIT_ALL_HELPER)
+        if self.deadline_delays and has_delays(nodes):
+            w.write(C_SLEEP_UNTIL_HELPER)
+
+    def emit_c_helper(self, name, nodes, w):
+        """输出公共步骤序列的 static 函数"""
+        w.write(f"/* 公共步骤序列 ({len(nodes)}个步骤) */\nstatic void {name}(void)\n{{\n")
+        with w.indented():
+            depth = loop_depth(nodes)
+            for k in range(depth):
+                w.line(f"int {loop_var(k)} = 0;")
+            if self.deadline_delays:
+                w.line("unsigned long long deadline = get_time();")
+            if depth or self.deadline_delays:
+                w.line()
+            for k, node in enumerate(nodes):
+                self.emit_c_node(node, w, separator=k < len(nodes) - 1)
+        w.write("}\n\n")
+
+    def emit_c_switch_masks(self, nodes, w):
+        """输出nodes中批量开关用到的位掩码定义"""
+        devices = batched_switch_devices(nodes)
+        if devices:
+            w.write("/* 阀门/泵位掩码 (由设备映射生成) */\n")
+            for device in devices:
+                name = self.c_device(device)
+                w.write(f"#ifndef {name}_MASK\n#define {name}_MASK (1UL << {name})\n#endif\n")
+            w.write("\n")
+
+    def emit_c_epilogue(self, process, w):
+        w.write(f"""
+    LOG("liquid_circuit: {process.display_name} end\\n");
+}}
+""")
+
+    def emit_lua_function(self, process, w):
+        nodes = self.lower(process.steps)
+        self.emit_lua_prologue(process, w, nodes)
+        with w.indented():
+            for node in nodes:
+                self.emit_lua_node(node, w)
+        self.emit_lua_epilogue(process, w)
+
+    def emit_lua_prologue(self, process, w, nodes=(), support=True):
+        """函数头, lua_locals=True 时绑定nodes用到的设备对象; support为True且nodes中有合并的电机等待时
+        先输出等待辅助函数, 启用 deadline_delays 且nodes中有延时时先输出截止时间延时函数"""
+        process_name = process.display_name
+        w.write(f"-- {process.description or process_name}\n")
+        if not self.deterministic:
+            w.write(f"-- 生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        if support and has_grouped_waits(nodes):
+            w.write("\n")
+            w.write(LUA_WAIT_ALL_HELPER)
+        if support and self.deadline_delays and has_delays(nodes):
+            w.write("\n")
+            w.write(LUA_SLEEP_UNTIL_HELPER)
+        bindings = "".join(f"    local {name} = {path}\n" for name, path in self.lua_bindings(nodes))
+        if self.deadline_delays:
+            bindings += "    local deadline = time.get_time()\n"
+        w.write(f"""
+function {process.func_name}()
+    local i = 0
+{bindings}    
+    log.info(string.format("liquid_circuit: %s start", "{process_name}"))
+    
+""")
+
+    def emit_lua_helper(self, name, nodes, w):
+        """输出公共步骤序列的 local function"""
+        w.write(f"-- 公共步骤序列 ({len(nodes)}个步骤)\nlocal function {name}()\n")
+        with w.indented():
+            bindings = self.lua_bindings(nodes)
+            for local, path in bindings:
+                w.line(f"local {local} = {path}")
+            if self.deadline_delays:
+                w.line("local deadline = time.get_time()")
+            if bindings or self.deadline_delays:
+                w.line()
+            for k, node in enumerate(nodes):
+                self.emit_lua_node(node, w, separator=k < len(nodes) - 1)
+        w.write("end\n\n")
+
+    def emit_lua_epilogue(self, process, w):
+        w.write(f"""
+    log.info(string.format("liquid_circuit: %s end", "{process.display_name}"))
+end
+
+-- 调用示例
+-- {process.func_name}()
+""")
+
+    def c_device(self, device):
+        """设备编号 -> C设备宏"""
+        name = DEVICE_NAMES[device]
+        return self.device_mapping.get(name, name)
+
+    def lua_device(self, device):
+        """设备编号 -> Lua设备对象"""
+        name = DEVICE_NAMES[device]
+        return self.lua_device_mapping.get(name, name.lower())
+
+    def lua_ref(self, path):
+        """Lua设备对象的引用: lua_locals=True 时为函数入口绑定的局部变量"""
+        if self.lua_locals:
+            return lua_local_name(path) or path
+        return path
+
+    def lua_call(self, path, method, args, in_loop=False):
+        """Lua方法调用 path:method(args); lua_locals=True 时循环内使用函数入口缓存的方法引用"""
+        local = lua_local_name(path) if self.lua_locals else None
+        if local is None:
+            return f"{path}:{method}({args})"
+        if in_loop:
+            return f"{local}_{method}({local}, {args})" if args else f"{local}_{method}({local})"
+        return f"{local}:{method}({args})"
+
+    def lua_sleep(self, ms, in_loop=False):
+        return f"time_sleep({ms})" if self.lua_locals and in_loop else f"time.sleep({ms})"
+
+    def lua_bindings(self, nodes):
+        """lua_locals=True 时函数入口绑定的局部变量 [(变量名, 表达式)], 按首次使用的顺序
+
+        用到的设备对象全部绑定; 循环(包括复合动作)内调用的方法绑定为 设备变量名_方法名, time.sleep 为 time_sleep
+        (截止时间延时不使用 time.sleep)。
+        与 emit_lua_step_body 中 lua_ref/lua_call/lua_sleep 的使用一一对应
+        """
+        if not self.lua_locals:
+            return []
+        bindings = {}
+
+        def use(path, method, in_loop):
+            local = lua_local_name(path)
+            if local is not None:
+                bindings.setdefault(local, path)
+                if method and in_loop:
+                    bindings.setdefault(f"{local}_{method}", f"{local}.{method}")
+
+        def visit(nodes, in_loop):
+            for node in nodes:
+                step = node.step
+                op = step.op
+                if op == OP_VALVE or op == OP_PUMP:
+                    for switch in step.steps or (step,):
+                        use(self.lua_device(switch.device), "set", in_loop)
+                elif op == OP_DELAY:
+                    if in_loop and not self.deadline_delays:
+                        bindings.setdefault("time_sleep", "time.sleep")
+                elif op == OP_MOTOR:
+                    motor = self.lua_device(step.device)
+                    cmd = LUA_MOTOR_COMMAND_NAMES[step.command] if step.command >= 0 else "reset"
+                    sync = step.flags & Step.FLAG_SYNC
+                    use(motor, f"{cmd}_{'sync' if sync else 'async'}", in_loop)
+                    if not sync and step.flags & Step.FLAG_WAIT:
+                        use(motor, "wait_complete", in_loop)
+                elif op == OP_MOTOR_WAIT:
+                    for wait in step.steps:
+                        use(self.lua_device(wait.device), None, in_loop)
+                    if not step.steps:
+                        use(self.lua_device(step.device), "wait_complete", in_loop)
+                elif op == OP_LOOP:
+                    visit(node.body if node.body is not None else build_ir(step.steps), True)
+                elif op == OP_COMPOSITE and legacy_needle_motion(step.text):
+                    use(LUA_NEEDLE_S_Z, "move_step_async", True)
+                    if not self.deadline_delays:
+                        bindings.setdefault("time_sleep", "time.sleep")
+                    use(LUA_NEEDLE_S_Z, "wait_complete", True)
+
+        visit(nodes, False)
+        return list(bindings.items())
+
+    def motor_wait_timeout(self, step, default):
+        """异步电机控制等待完成的超时(ms)
+
+        步进移动按param1(步数)、param2(速度)、param3(加速度)的梯形速度曲线计算运动时间,
+        加上 timeout_margin 比例余量和 timeout_margin_ms 固定余量; 复位等运动距离未知的命令、
+        参数不是数值或未启用 kinematic_timeouts 时返回default
+        """
+        if (not self.kinematic_timeouts or step.command != MOTOR_CMD_MOVE_STEP
+                or type(step.p1) is not int or type(step.p2) is not int or type(step.p3) is not int
+                or step.p2 <= 0 or step.p3 <= 0):
+            return default
+        return motor_timeout_ms(step.p1, step.p2, step.p3, self.timeout_margin, self.timeout_margin_ms)
+
+    def wait_timeout(self, step, default):
+        """电机等待步骤的超时: 生成的IR中的等待(timeout为None)按运动参数确定"""
+        if step.timeout is None:
+            return self.motor_wait_timeout(step, default)
+        return step.timeout
+
+    def _max_timeouts(self, waits, default):
+        """合并等待的共用超时: 数值超时只保留最大值, 非数值超时(宏名等)去重后由生成代码在运行时取最大"""
+        numbers = []
+        names = []
+        for wait in waits:
+            timeout = self.wait_timeout(wait, default)
+            if type(timeout) is int:
+                numbers.append(timeout)
+            elif str(timeout) not in names:
+                names.append(str(timeout))
+        if numbers:
+            names.insert(0, str(max(numbers)))
+        return names
+
+    def emit_c_step(self, step, step_index, w, separator=True):
+        """按当前缩进输出一个C语言步骤, separator控制步骤后的空行 (循环体内不输出)"""
+        for node in step_nodes(step, str(step_index + 1)):
+            self.emit_c_node(node, w, separator)
+
+    def emit_c_node(self, node, w, separator=True, depth=0):
+        w.line(f"// 步骤 {node.label}: {node.step.describe()}")
+        self.emit_c_step_body(node.step, w, node.body, depth)
+        if separator:
+            w.line()
+
+    def emit_c_step_body(self, step, w, body=None, depth=0):
+        """输出C语言步骤的代码部分 (不含步骤注释行), body为循环体的IR节点, 未指定时由step.steps构建;
+        depth为所在的循环层数, 循环和复合动作使用该层的循环变量 (见 loop_var)"""
+        op = step.op
+
+        if (op == OP_VALVE or op == OP_PUMP) and step.steps:
+            masks = ([], [])
+            for switch in step.steps:
+                masks[not switch.flags & Step.FLAG_ON].append(f"{self.c_device(switch.device)}_MASK")
+            on_mask, off_mask = (" | ".join(mask) or "0" for mask in masks)
+            w.line(f"valve_set_mask({on_mask}, {off_mask});")
+
+        elif op == OP_VALVE or op == OP_PUMP:
+            device = self.c_device(step.device)
+            action = "ON" if step.flags & Step.FLAG_ON else "OFF"
+            w.line(f"valve_set({device}, {action});")
+
+        elif op == OP_DELAY:
+            self._emit_c_delay(w, step.delay_ms)
+
+        elif op == OP_MOTOR:
+            motor = self.c_device(step.device)
+            cmd = C_MOTOR_COMMAND_NAMES[step.command] if step.command >= 0 else "CMD_MOTOR_RST"
+            param1, param2, param3 = step.p1, step.p2, step.p3
+
+            if step.flags & Step.FLAG_SYNC:
+                timeout = step.timeout
+                w.line(f"if (motor_move_ctl_sync({motor}, {cmd}, {param1}, {param2}, {param3}, {timeout}) < 0) {{")
+                with w.indented():
+                    w.line("LOG(\"liquid_circuit: motor sync operation failed\\n\");")
+                    w.line("FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_PUMP);")
+                w.line("}")
+                self._emit_c_reanchor(w)
+            else:
+                w.line("FAULT_CHECK_START(MODULE_FAULT_LEVEL2);")
+                w.line(f"if (motor_move_ctl_async({motor}, {cmd}, {param1}, {param2}, {param3}) < 0) {{")
+                with w.indented():
+                    w.line("LOG(\"liquid_circuit: motor async operation failed\\n\");")
+                    w.line("FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_PUMP);")
+                w.line("}")
+                w.line("FAULT_CHECK_END();")
+
+                if step.flags & Step.FLAG_WAIT:
+                    self._emit_c_motor_wait(w, motor, self.motor_wait_timeout(step, "MOTOR_DEFAULT_TIMEOUT"))
+                elif not step.flags & Step.FLAG_WAIT_LATER:
+                    w.line("// 注意: 需要在后续步骤中添加对应的电机等待步骤")
+
+        elif op == OP_CALL:
+            w.line(f"{step.text}();")
+            self._emit_c_reanchor(w)
+
+        elif op == OP_MOTOR_WAIT:
+            if step.steps:
+                self._emit_c_motor_wait_all(w, step.steps)
+            else:
+                self._emit_c_motor_wait(w, self.c_device(step.device), self.wait_timeout(step, "MOTOR_DEFAULT_TIMEOUT"))
+
+        elif op == OP_LOOP:
+            count = step.p1
+            if body is None:
+                body = build_ir(step.steps)
+            var = loop_var(depth)
+            w.line(f"for ({var}=0; {var}<{count}; {var}++) {{")
+            with w.indented():
+                w.line(f"// 循环第 {var}+1 次，共执行 {len(body)} 个步骤")
+                for node in body:
+                    self.emit_c_node(node, w, separator=False, depth=depth + 1)
+            w.line("}")
+
+        elif op == OP_COMPOSITE:
+            desc = step.text
+            w.line(f"/* 复合动作: {desc} */")
+            motion = legacy_needle_motion(desc)
+            if motion:
+                pulses, repeats = motion
+
+                var = loop_var(depth)
+                w.line(f"for ({var}=0; {var}<{repeats}; {var}++) {{")
+                with w.indented():
+                    for distance in (pulses, f"-{pulses}"):
+                        w.line(f"if (motor_move_ctl_async(MOTOR_NEEDLE_S_Z, CMD_MOTOR_MOVE_STEP, {distance}, NEEDLE_S_Z_REMOVE_SPEED, NEEDLE_S_Z_REMOVE_ACC) < 0) {{")
+                        with w.indented():
+                            w.line("FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_Z);")
+                        w.line("}")
+                        self._emit_c_delay(w, 500)
+                        w.line("if (motor_timedwait(MOTOR_NEEDLE_S_Z, MOTOR_DEFAULT_TIMEOUT) != 0) {")
+                        with w.indented():
+                            w.line("LOG(\"liquid_circuit: motor wait timeout!\\n\");")
+                            w.line("FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_Z);")
+                        w.line("}")
+                        self._emit_c_reanchor(w)
+                w.line("}")
+            else:
+                w.line("// TODO: 实现复合动作逻辑")
+
+    def _emit_c_delay(self, w, ms):
+        if self.deadline_delays:
+            w.line(f"deadline += {ms};")
+            w.line("liquid_sleep_until(deadline);")
+        else:
+            w.line(f"usleep({ms}*1000);")
+
+    def _emit_c_reanchor(self, w):
+        """阻塞步骤之后截止时间重新取当前时间, 之后的延时不计入阻塞的时间"""
+        if self.deadline_delays:
+            w.line("deadline = get_time();")
+
+    def _emit_c_motor_wait(self, w, motor, timeout):
+        w.line("FAULT_CHECK_START(MODULE_FAULT_LEVEL2);")
+        w.line(f"if (motor_timedwait({motor}, {timeout}) != 0) {{")
+        with w.indented():
+            w.line("LOG(\"liquid_circuit: motor wait timeout!\\n\");")
+            w.line("FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_PUMP);")
+        w.line("}")
+        w.line("FAULT_CHECK_END();")
+        self._emit_c_reanchor(w)
+
+    def _emit_c_motor_wait_all(self, w, waits):
+        timeouts = self._max_timeouts(waits, "MOTOR_DEFAULT_TIMEOUT")
+        timeout = timeouts[0]
+        for other in timeouts[1:]:
+            timeout = f"LIQUID_MAX({timeout}, {other})"
+        w.line("{")
+        with w.indented():
+            w.line(f"static const int motors[] = {{{', '.join(self.c_device(wait.device) for wait in waits)}}};")
+            w.line("FAULT_CHECK_START(MODULE_FAULT_LEVEL2);")
+            w.line(f"if (liquid_motor_wait_all(motors, {len(waits)}, get_time() + {timeout}) != 0) {{")
+            with w.indented():
+                w.line("LOG(\"liquid_circuit: motor wait timeout!\\n\");")
+                w.line("FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, (void *)MODULE_FAULT_NEEDLE_S_PUMP);")
+            w.line("}")
+            w.line("FAULT_CHECK_END();")
+        w.line("}")
+        self._emit_c_reanchor(w)
+
+    def emit_lua_step(self, step, step_index, w, separator=True):
+        """按当前缩进输出一个Lua步骤, separator控制步骤后的空行 (循环体内不输出)"""
+        for node in step_nodes(step, str(step_index + 1)):
+            self.emit_lua_node(node, w, separator)
+
+    def emit_lua_node(self, node, w, separator=True, depth=0):
+        w.line(f"-- 步骤 {node.label}: {node.step.describe()}")
+        self.emit_lua_step_body(node.step, w, node.body, depth)
+        if separator:
+            w.line()
+
+    def emit_lua_step_body(self, step, w, body=None, depth=0):
+        """输出Lua步骤的代码部分 (不含步骤注释行), body和depth同emit_c_step_body"""
+        op = step.op
+        in_loop = depth > 0
+
+        if (op == OP_VALVE or op == OP_PUMP) and step.steps:
+            # Lua设备接口没有按位掩码的批量开关, 批量开关仍逐个设置
+            for switch in step.steps:
+                self.emit_lua_step_body(switch, w, depth=depth)
+
+        elif op == OP_VALVE or op == OP_PUMP:
+            device = self.lua_device(step.device)
+            action = "true" if step.flags & Step.FLAG_ON else "false"
+            w.line(self.lua_call(device, "set", action, in_loop))
+
+        elif op == OP_DELAY:
+            time_val = step.delay_ms
+            if self.deadline_delays:
+                w.line(f"deadline = deadline + {time_val}")
+                w.line(f"sleep_until(deadline)  -- 延时{time_val}ms")
+            else:
+                w.line(f"{self.lua_sleep(time_val, in_loop)}  -- 延时{time_val}ms")
+
+        elif op == OP_MOTOR:
+            motor = self.lua_device(step.device)
+            cmd = LUA_MOTOR_COMMAND_NAMES[step.command] if step.command >= 0 else "reset"
+            param1, param2, param3 = step.p1, step.p2, step.p3
+
+            if step.flags & Step.FLAG_SYNC:
+                timeout = step.timeout
+                call = self.lua_call(motor, f"{cmd}_sync", f"{param1}, {param2}, {param3}, {timeout}", in_loop)
+                w.line(f"local result = {call}")
+                w.line("if not result then")
+                with w.indented():
+                    w.line("log.error(\"liquid_circuit: motor sync operation failed\")")
+                    w.line("error(\"Motor operation failed\")")
+                w.line("end")
+                self._emit_lua_reanchor(w)
+            else:
+                call = self.lua_call(motor, f"{cmd}_async", f"{param1}, {param2}, {param3}", in_loop)
+                w.line(f"local result = {call}")
+                w.line("if not result then")
+                with w.indented():
+                    w.line("log.error(\"liquid_circuit: motor async operation failed\")")
+                    w.line("error(\"Motor operation failed\")")
+                w.line("end")
+
+                if step.flags & Step.FLAG_WAIT:
+                    self._emit_lua_motor_wait(w, motor, self.motor_wait_timeout(step, "20000"), in_loop)
+                elif not step.flags & Step.FLAG_WAIT_LATER:
+                    w.line("-- 注意: 需要在后续步骤中添加对应的电机等待步骤")
+
+        elif op == OP_CALL:
+            w.line(f"{step.text}()")
+            self._emit_lua_reanchor(w)
+
+        elif op == OP_MOTOR_WAIT:
+            if step.steps:
+                self._emit_lua_motor_wait_all(w, step.steps)
+            else:
+                self._emit_lua_motor_wait(w, self.lua_device(step.device), self.wait_timeout(step, "20000"), in_loop)
+
+        elif op == OP_LOOP:
+            count = step.p1
+            if body is None:
+                body = build_ir(step.steps)
+            var = loop_var(depth)
+            w.line(f"for {var} = 1, {count} do")
+            with w.indented():
+                w.line(f"-- 循环第 {var} 次，共执行 {len(body)} 个步骤")
+                for node in body:
+                    self.emit_lua_node(node, w, separator=False, depth=depth + 1)
+            w.line("end")
+
+        elif op == OP_COMPOSITE:
+            desc = step.text
+            w.line(f"-- 复合动作: {' '.join(desc.splitlines())}")
+            motion = legacy_needle_motion(desc)
+            if motion:
+                pulses, repeats = motion
+
+                w.line(f"for {loop_var(depth)} = 1, {repeats} do")
+                with w.indented():
+                    for distance in (pulses, f"-{pulses}"):
+                        w.line(self.lua_call(LUA_NEEDLE_S_Z, "move_step_async", f"{distance}, 20000, 50000", True))
+                        if self.deadline_delays:
+                            w.line("deadline = deadline + 500")
+                            w.line("sleep_until(deadline)")
+                        else:
+                            w.line(self.lua_sleep(500, True))
+                        w.line(self.lua_call(LUA_NEEDLE_S_Z, "wait_complete", "20000", True))
+                        self._emit_lua_reanchor(w)
+                w.line("end")
+            else:
+                w.line("-- TODO: 实现复合动作逻辑")
+
+    def _emit_lua_reanchor(self, w):
+        if self.deadline_delays:
+            w.line("deadline = time.get_time()")
+
+    def _emit_lua_motor_wait(self, w, motor, timeout, in_loop=False):
+        w.line(f"if not {self.lua_call(motor, 'wait_complete', timeout, in_loop)} then")
+        with w.indented():
+            w.line("log.error(\"liquid_circuit: motor wait timeout!\")")
+            w.line("error(\"Motor wait timeout\")")
+        w.line("end")
+        self._emit_lua_reanchor(w)
+
+    def _emit_lua_motor_wait_all(self, w, waits):
+        timeouts = self._max_timeouts(waits, "20000")
+        timeout = timeouts[0] if len(timeouts) == 1 else f"math.max({', '.join(timeouts)})"
+        motors = ", ".join(self.lua_ref(self.lua_device(wait.device)) for wait in waits)
+        w.line(f"if not wait_all_complete({{{motors}}}, {timeout}) then")
+        with w.indented():
+            w.line("log.error(\"liquid_circuit: motor wait timeout!\")")
+            w.line("error(\"Motor wait timeout\")")
+        w.line("end")
+        self._emit_lua_reanchor(w)
+
+
+class RenderedCode:
+    """分段的生成结果: 函数头、各步骤的注释行与代码、函数尾
+
+    按顺序拼接后与 CodeGenerator.generate 的输出一致, 预览据此只更新变化的部分
+    """
+
+    __slots__ = ("output_type", "prologue", "headers", "bodies", "epilogue")
+
+    def __init__(self, output_type, prologue, headers, bodies, epilogue):
+        self.output_type = output_type
+        self.prologue = prologue
+        self.headers = headers
+        self.bodies = bodies
+        self.epilogue = epilogue
+
+    def text(self):
+        parts = [self.prologue]
+        for header, body in zip(self.headers, self.bodies):
+            parts.append(header)
+            parts.append(body)
+        parts.append(self.epilogue)
+        return "".join(parts)
+
+
+class StepCodeCache:
+    """按步骤内容缓存生成的步骤代码
+
+    缓存键为 (输出类型, IR节点内容), 片段不含与位置相关的"步骤 N"注释行,
+    因此添加、删除、移动步骤时只有内容变化的步骤需要重新生成
+    """
+
+    COMMENT_PREFIX = {"C": "//", "Lua": "--"}
+
+    def __init__(self, generator):
+        self.generator = generator
+        self._config = generator.config_json()
+        self._entries = {}
+
+    def render(self, process, output_type, cancel=None, generator=None):
+        """生成分段结果; cancel为threading.Event等对象, 生成过程中被置位时放弃并返回None
+
+        generator 为本次生成使用的生成器 (默认为构造时的生成器)。在其它线程中修改选项时应传入
+        CodeGenerator.snapshot() 的副本, 缓存键按该副本的配置计算, 片段不会存到其它配置下
+        """
+        generator = generator or self.generator
+        config = generator.config_json()
+        if config != self._config:
+            self._entries.clear()
+            self._config = config
+
+        if output_type == "C" and generator.c_table:
+            # 表驱动输出中的跳转位置与步骤位置相关, 不分段缓存
+            return RenderedCode(output_type, generator.generate(process, output_type), [], [], "")
+
+        if output_type == "C":
+            emit_prologue, emit_body, emit_epilogue = (
+                generator.emit_c_prologue, generator.emit_c_step_body, generator.emit_c_epilogue)
+        else:
+            emit_prologue, emit_body, emit_epilogue = (
+                generator.emit_lua_prologue, generator.emit_lua_step_body, generator.emit_lua_epilogue)
+        header_prefix = f"{CodeWriter.INDENT}{self.COMMENT_PREFIX[output_type]} 步骤 "
+
+        entries = self._entries
+        used = {}
+        headers = []
+        bodies = []
+        nodes = generator.lower(process.steps)
+        for i, node in enumerate(nodes):
+            if cancel is not None and i & 0xFF == 0 and cancel.is_set():
+                return None
+            key = (output_type, node.key())
+            entry = entries.get(key)
+            if entry is None:
+                w = CodeWriter(level=1)
+                emit_body(node.step, w, node.body)
+                w.line()
+                entry = entries[key] = (node.step.describe(), w.getvalue())
+            used[key] = entry
+            headers.append(f"{header_prefix}{node.label}: {entry[0]}\n")
+            bodies.append(entry[1])
+
+        # 缓存过大时只保留本次用到的片段
+        if len(entries) > 4 * len(used) + 256:
+            self._entries = used
+
+        prologue = CodeWriter()
+        emit_prologue(process, prologue, nodes)
+        epilogue = CodeWriter()
+        emit_epilogue(process, epilogue)
+        return RenderedCode(output_type, prologue.getvalue(), headers, bodies, epilogue.getvalue())
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+表格导入 - 从Excel/CSV步骤表逐行读取步骤
+每行一个步骤, 第一行(第一个非空行)为表头, 列名可配置; 错误按行记录, 不中断导入
+用法: python liquid_import.py 表格文件 [-o 流程.json] [--sheet 工作表] [--column 字段=列名]...
+"""
+
+import argparse
+import csv
+import os
+import re
+import sys
+
+from liquid_model import (
+    OP_LOOP, MOTOR_COMMANDS, MOTOR_OPTIONS, PUMP_OPTIONS, VALVE_OPTIONS, Process, Step, parse_number,
+)
+
+# 步骤字段 -> 默认列名; 列名也可以直接使用字段名 (与流程JSON的键相同)
+DEFAULT_COLUMNS = {
+    "type": "类型", "device": "设备", "action": "动作", "time": "时间", "unit": "单位",
+    "motor": "电机", "command": "命令", "mode": "模式",
+    "param1": "参数1", "param2": "参数2", "param3": "参数3",
+    "timeout": "超时", "wait_complete": "等待完成", "count": "次数", "description": "描述",
+}
+
+# 结束当前循环的行类型: "循环"行开始一个循环, 之后的行直到"循环结束"为循环体, 可以嵌套
+LOOP_END = "循环结束"
+
+_TRUE_VALUES = {"是", "true", "yes", "y", "1", "等待"}
+_FALSE_VALUES = {"否", "false", "no", "n", "0", "不等待"}
+
+# 电机参数、超时和循环次数: 整数或宏名 (宏名原样写入生成的代码); 延时时间只能是整数
+_VALUE = re.compile(r"-?\d+|[A-Za-z_][A-Za-z0-9_]*")
+_TIME = re.compile(r"\d+")
+
+
+class ImportResult:
+    """导入结果: 步骤列表、读取的数据行数和错误 ([(行号, 信息)], 最多保留max_errors条)"""
+
+    __slots__ = ("steps", "rows", "errors", "error_count")
+
+    def __init__(self, steps, rows, errors, error_count):
+        self.steps = steps
+        self.rows = rows
+        self.errors = errors
+        self.error_count = error_count
+
+    def format_errors(self, limit=20):
+        lines = [f"第{row}行: {message}" for row, message in self.errors[:limit]]
+        if self.error_count > len(lines):
+            lines.append(f"... 共 {self.error_count} 行错误")
+        return "\n".join(lines)
+
+
+def _cell_text(value):
+    """单元格 -> 去除首尾空白的字符串; 空单元格为"", 整数值的浮点数(Excel数值)去掉小数部分"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if value != value:     # NaN (pandas的空单元格)
+            return ""
+        if value.is_integer():
+            return str(int(value))
+    return str(value).strip()
+
+
+def iter_csv_rows(path, encoding="utf-8-sig", delimiter=None):
+    """逐行读取CSV (.tsv默认以制表符分隔)"""
+    if delimiter is None:
+        delimiter = "\t" if path.lower().endswith(".tsv") else ","
+    with open(path, "r", encoding=encoding, newline="") as f:
+        yield from csv.reader(f, delimiter=delimiter)
+
+
+def iter_xlsx_rows(path, sheet=None):
+    """以只读模式逐行读取xlsx工作表, 不加载整个工作簿"""
+    try:
+        import openpyxl  # 可选依赖, 读取xlsx时才导入
+    except ImportError:
+        raise RuntimeError("需要安装openpyxl库") from None
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.active
+        yield from worksheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def iter_xls_rows(path, sheet=None):
+    """读取旧格式xls工作表 (pandas一次读入整个工作表, xls格式不支持流式读取)"""
+    try:
+        import pandas as pd  # 可选依赖, 导入较慢, 读取xls时才导入
+    except ImportError:
+        raise RuntimeError("需要安装pandas库") from None
+    frame = pd.read_excel(path, sheet_name=sheet or 0, header=None, dtype=object)
+    yield from frame.itertuples(index=False, name=None)
+
+
+def read_rows(path, sheet=None, encoding="utf-8-sig"):
+    """按扩展名逐行读取表格文件"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".xlsx", ".xlsm"):
+        return iter_xlsx_rows(path, sheet)
+    if ext == ".xls":
+        return iter_xls_rows(path, sheet)
+    return iter_csv_rows(path, encoding)
+
+
+def _column_indexes(header, columns):
+    """表头行 -> {字段: 列号}, 列名与配置的列名或字段名相同即匹配"""
+    names = [_cell_text(cell) for cell in header]
+    indexes = {}
+    for field, column in columns.items():
+        for name in (column, field):
+            if name in names:
+                indexes[field] = names.index(name)
+                break
+    if "type" not in indexes:
+        raise ValueError(f"表头中没有类型列 ({columns['type']})")
+    return indexes
+
+
+def _choice(value, options, what):
+    if value not in options:
+        raise ValueError(f"未知{what} {value!r}" if value else f"缺少{what}")
+    return value
+
+
+def _value(value, what, default=None, pattern=_VALUE, expected="整数或宏名"):
+    """数值单元格: 为空时返回default (default为None时报缺少), 格式不对时抛出ValueError"""
+    if not value:
+        if default is None:
+            raise ValueError(f"缺少{what}")
+        return default
+    if not pattern.fullmatch(value):
+        raise ValueError(f"{what}应为{expected}, 实际为 {value!r}")
+    return value
+
+
+def _flag(value, default):
+    if not value:
+        return default
+    if value.lower() in _TRUE_VALUES:
+        return True
+    if value.lower() in _FALSE_VALUES:
+        return False
+    raise ValueError(f"等待完成应为 是 或 否, 实际为 {value!r}")
+
+
+def _row_step(step_type, get):
+    """一行 -> 流程JSON格式的步骤 (与界面添加的步骤格式相同), get(字段)返回单元格文本"""
+    if step_type in ("阀门控制", "泵控制"):
+        options = VALVE_OPTIONS if step_type == "阀门控制" else PUMP_OPTIONS
+        return {"type": step_type, "device": _choice(get("device"), options, "设备"),
+                "action": _choice(get("action"), ("开", "关"), "动作")}
+    if step_type == "延时":
+        return {"type": step_type, "time": _value(get("time"), "时间", pattern=_TIME, expected="非负整数"),
+                "unit": _choice(get("unit") or "ms", ("ms", "s"), "单位")}
+    if step_type == "电机控制":
+        step = {"type": step_type, "motor": _choice(get("motor") or get("device"), MOTOR_OPTIONS, "电机"),
+                "command": _choice(get("command"), MOTOR_COMMANDS, "命令"),
+                "mode": _choice(get("mode") or "异步", ("同步", "异步"), "模式"),
+                "param1": _value(get("param1"), "参数1", "0"), "param2": _value(get("param2"), "参数2", "20000"),
+                "param3": _value(get("param3"), "参数3", "50000")}
+        if step["mode"] == "同步":
+            step["timeout"] = _value(get("timeout"), "超时", "20000")
+        else:
+            step["wait_complete"] = _flag(get("wait_complete"), True)
+        return step
+    if step_type == "电机等待":
+        return {"type": step_type, "motor": _choice(get("motor") or get("device"), MOTOR_OPTIONS, "电机"),
+                "timeout": _value(get("timeout"), "超时", "20000")}
+    if step_type == "复合动作":
+        if not get("description"):
+            raise ValueError("缺少描述")
+        return {"type": step_type, "description": get("description")}
+    raise ValueError(f"未知步骤类型 {step_type!r}")
+
+
+def import_steps(rows, columns=None, max_errors=1000):
+    """表格行 -> ImportResult
+
+    逐行转换为步骤, 不保留已读取的行; 出错的行记录错误后跳过。
+    columns 为 {字段: 列名}, 未指定的字段使用 DEFAULT_COLUMNS。
+    """
+    columns = dict(DEFAULT_COLUMNS, **(columns or {}))
+    steps = []
+    loops = []      # 未结束的循环: (行号, 次数, 外层步骤列表)
+    errors = []
+    error_count = 0
+    data_rows = 0
+    indexes = None
+
+    def error(row, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < max_errors:
+            errors.append((row, message))
+
+    for row_number, row in enumerate(rows, 1):
+        cells = [_cell_text(cell) for cell in row]
+        if not any(cells):
+            continue
+        if indexes is None:
+            indexes = _column_indexes(cells, columns)
+            continue
+        data_rows += 1
+
+        def get(field):
+            index = indexes.get(field)
+            return cells[index] if index is not None and index < len(cells) else ""
+
+        step_type = get("type")
+        try:
+            if step_type == "循环":
+                loops.append((row_number, parse_number(_value(get("count"), "次数")), steps))
+                steps = []
+            elif step_type == LOOP_END:
+                if not loops:
+                    raise ValueError("没有对应的循环")
+                _, count, outer = loops.pop()
+                outer.append(Step(OP_LOOP, p1=count, steps=tuple(steps)))
+                steps = outer
+            else:
+                steps.append(Step.from_dict(_row_step(step_type, get)))
+        except ValueError as e:
+            error(row_number, str(e))
+
+    while loops:
+        row_number, count, outer = loops.pop()
+        error(row_number, f"循环没有{LOOP_END}, 到表格结尾结束")
+        outer.append(Step(OP_LOOP, p1=count, steps=tuple(steps)))
+        steps = outer
+    if indexes is None:
+        raise ValueError("表格为空")
+    return ImportResult(steps, data_rows, errors, error_count)
+
+
+def import_table(path, sheet=None, columns=None, encoding="utf-8-sig", max_errors=1000):
+    """读取表格文件中的步骤, 返回ImportResult"""
+    return import_steps(read_rows(path, sheet, encoding), columns, max_errors)
+
+
+def _column_option(text):
+    field, sep, column = text.partition("=")
+    if not sep or field not in DEFAULT_COLUMNS:
+        raise argparse.ArgumentTypeError(f"应为 字段=列名, 字段为 {', '.join(DEFAULT_COLUMNS)} 之一")
+    return field, column
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="liquid_import", description="从Excel/CSV步骤表导入液路流程")
+    parser.add_argument("path", help="表格文件 (.xlsx/.xls/.csv/.tsv)")
+    parser.add_argument("-o", "--output", help="输出的流程JSON文件 (默认与表格同名)")
+    parser.add_argument("--name", help="流程名称 (默认为表格文件名)")
+    parser.add_argument("--sheet", help="工作表名称 (默认为活动工作表)")
+    parser.add_argument("--encoding", default="utf-8-sig", help="CSV文件编码 (默认utf-8-sig)")
+    parser.add_argument("--column", action="append", type=_column_option, default=[], metavar="字段=列名",
+                        help="列名映射, 可重复指定 (默认: " +
+                             ", ".join(f"{field}={column}" for field, column in DEFAULT_COLUMNS.items()) + ")")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    base = os.path.splitext(args.path)[0]
+    try:
+        result = import_table(args.path, args.sheet, dict(args.column), args.encoding)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"❌ {args.path}: {e}", file=sys.stderr)
+        return 1
+    Process(args.name or os.path.basename(base), "", result.steps).save(args.output or base + ".json")
+    print(f"{args.path}: 读取 {result.rows} 行, 导入 {len(result.steps)} 个步骤")
+    if result.error_count:
+        print(result.format_errors(), file=sys.stderr)
+    return 1 if result.error_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
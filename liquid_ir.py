@@ -0,0 +1,735 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+液路流程中间表示(IR)与优化
+由步骤列表构建IR, 经优化流水线处理后交给C/Lua后端输出, 两种后端共用同一份IR
+"""
+
+import ast
+import heapq
+import itertools
+import operator
+
+from liquid_composite import compile_composite, legacy_needle_motion
+from liquid_model import OP_VALVE, OP_PUMP, OP_DELAY, OP_MOTOR, OP_MOTOR_WAIT, OP_LOOP, OP_COMPOSITE, OP_UNKNOWN, OP_CALL, Step
+
+
+class IRNode:
+    """IR节点: 一个(可能经过合并或改写的)步骤
+
+    label 为代码注释中的步骤编号: 原样保留的步骤为 "3", 合并的步骤为 "3~5",
+    展开的循环体步骤为 "6.1"。循环节点的 body 为循环体的IRNode列表, 其它节点为None。
+    """
+
+    __slots__ = ("step", "label", "body")
+
+    def __init__(self, step, label, body=None):
+        self.step = step
+        self.label = label
+        self.body = body
+
+    @classmethod
+    def from_step(cls, step, label):
+        return cls(step, label, build_ir(step.steps) if step.op == OP_LOOP else None)
+
+    def key(self):
+        """生成代码的可哈希键 (不含本节点的编号), 内容相同的节点生成的代码相同"""
+        if self.body is None:
+            return self.step.key()
+        return self.step.key(), tuple((node.label, node.key()) for node in self.body)
+
+    def __repr__(self):
+        return f"IRNode({self.label!r}, {self.step!r})"
+
+
+def build_ir(steps):
+    """步骤列表 -> IR节点列表 (未优化, 除复合动作外与步骤一一对应)"""
+    return [node for i, step in enumerate(steps) for node in step_nodes(step, str(i + 1))]
+
+
+def step_nodes(step, label):
+    """一个步骤的IR节点: 复合动作语言的复合动作展开为编译得到的步骤, 编号为 "6.1"、"6.2"…"""
+    compiled = compile_composite(step.text) if step.op == OP_COMPOSITE else None
+    if compiled is None:
+        return [IRNode.from_step(step, label)]
+    return [IRNode.from_step(inner, f"{label}.{j + 1}") for j, inner in enumerate(compiled)]
+
+
+def _with_body(node, body):
+    """循环体变化时返回新的循环节点, 步骤数随之更新"""
+    if len(body) == len(node.body) and all(a is b for a, b in zip(body, node.body)):
+        return node
+    step = Step(OP_LOOP, p1=node.step.p1, steps=tuple(n.step for n in body))
+    return IRNode(step, node.label, body)
+
+
+def _merge_label(first, last):
+    return f"{first.label.split('~')[0]}~{last.label}"
+
+
+def _walk(nodes):
+    for node in nodes:
+        yield node
+        if node.body is not None:
+            yield from _walk(node.body)
+
+
+# ---- 循环次数常量折叠 ----
+
+_FOLD_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.USub: operator.neg, ast.UAdd: operator.pos,
+}
+
+
+def _eval_constant(expr):
+    if isinstance(expr, ast.Constant) and type(expr.value) is int:
+        return expr.value
+    if isinstance(expr, ast.BinOp) and type(expr.op) in _FOLD_OPERATORS:
+        return _FOLD_OPERATORS[type(expr.op)](_eval_constant(expr.left), _eval_constant(expr.right))
+    if isinstance(expr, ast.UnaryOp) and type(expr.op) in _FOLD_OPERATORS:
+        return _FOLD_OPERATORS[type(expr.op)](_eval_constant(expr.operand))
+    raise ValueError("不是整数常量表达式")
+
+
+def fold_constant(value):
+    """整数常量表达式(如 "2*3"、"0x10")求值为整数, 含宏名等无法求值时返回原值"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return _eval_constant(ast.parse(value.strip(), mode="eval").body)
+    except (SyntaxError, ValueError, TypeError):
+        return value
+
+
+def fold_loop_counts(nodes):
+    """循环次数常量折叠: 次数求值为整数, 不执行的循环和空循环删除, 只执行1次的循环展开"""
+    result = []
+    for node in nodes:
+        if node.body is None:
+            result.append(node)
+            continue
+        body = fold_loop_counts(node.body)
+        count = fold_constant(node.step.p1)
+        if isinstance(count, int) and (count <= 0 or not body):
+            continue
+        if count == 1:
+            result.extend(IRNode(child.step, f"{node.label}.{child.label}", child.body) for child in body)
+            continue
+        loop = _with_body(node, body)
+        if count != loop.step.p1:
+            loop = IRNode(Step(OP_LOOP, p1=count, steps=loop.step.steps), loop.label, body)
+        result.append(loop)
+    return result
+
+
+# ---- 循环发现 ----
+
+def find_tandem_repeats(tokens, max_period=16, min_saved=1):
+    """查找串联重复: 返回 [(起点, 周期, 次数)], 各段互不重叠
+
+    对每个周期p, 自后向前计算 match[i] = 从i开始与i+p处相同的连续长度, 从i开始周期p的重复次数为
+    match[i] // p + 1; 自前向后在每个位置取减少步骤数 (次数-1)*周期-1 最多的周期 (相同时取较短的周期),
+    减少数不小于min_saved时折叠。耗时与 序列长度*max_period 成正比
+    """
+    n = len(tokens)
+    matches = []
+    for p in range(1, min(max_period, n // 2) + 1):
+        match = [0] * (n + 1)
+        for i in range(n - p - 1, -1, -1):
+            if tokens[i] == tokens[i + p]:
+                match[i] = match[i + 1] + 1
+        matches.append(match)
+
+    repeats = []
+    i = 0
+    while i < n:
+        best = None
+        best_saved = min_saved - 1
+        for p, match in enumerate(matches, 1):
+            count = match[i] // p + 1
+            saved = (count - 1) * p - 1
+            if count >= 2 and saved > best_saved:
+                best, best_saved = (i, p, count), saved
+        if best is None:
+            i += 1
+        else:
+            repeats.append(best)
+            i += best[1] * best[2]
+    return repeats
+
+
+def discover_loops(nodes, max_period=16):
+    """循环发现: 连续重复的步骤序列折叠为循环 (循环体中的重复同样折叠, 可生成嵌套循环)
+
+    循环节点编号为被折叠的步骤范围 "3~11", 循环体为第一次重复的节点, 保留原编号
+    """
+    nodes = [_with_body(node, discover_loops(node.body, max_period)) if node.body is not None else node
+             for node in nodes]
+    repeats = find_tandem_repeats([node.step.key() for node in nodes], max_period)
+    if not repeats:
+        return nodes
+    result = []
+    i = 0
+    for start, period, count in repeats:
+        result.extend(nodes[i:start])
+        label = _merge_label(nodes[start], nodes[start + period * count - 1])
+        body = discover_loops(nodes[start:start + period], max_period)
+        result.append(IRNode(Step(OP_LOOP, p1=count, steps=tuple(node.step for node in body)), label, body))
+        i = start + period * count
+    result.extend(nodes[i:])
+    return result
+
+
+def _fold_loop_step(step, max_period):
+    body = fold_repeated_steps(step.steps, max_period)
+    if len(body) == len(step.steps) and all(a is b for a, b in zip(body, step.steps)):
+        return step
+    return Step(OP_LOOP, p1=step.p1, steps=tuple(body))
+
+
+def fold_repeated_steps(steps, max_period=16):
+    """在步骤列表中发现连续重复的步骤序列, 返回折叠为循环步骤后的新列表 (编辑器按需使用, 不修改输入)
+
+    循环步骤内的步骤同样折叠; 保留原始数据的(非规范格式)循环步骤不修改
+    """
+    steps = [_fold_loop_step(step, max_period) if step.op == OP_LOOP and step._src is None else step
+             for step in steps]
+    repeats = find_tandem_repeats([step.key() for step in steps], max_period)
+    result = []
+    i = 0
+    for start, period, count in repeats:
+        result.extend(steps[i:start])
+        body = fold_repeated_steps(steps[start:start + period], max_period)
+        result.append(Step(OP_LOOP, p1=count, steps=tuple(body)))
+        i = start + period * count
+    result.extend(steps[i:])
+    return result
+
+
+# ---- 冗余开关消除 ----
+
+def _switched_devices(nodes):
+    return {node.step.device for node in _walk(nodes) if node.step.op in (OP_VALVE, OP_PUMP)}
+
+
+def _runs_at_least_once(loop):
+    return isinstance(loop.step.p1, int) and loop.step.p1 > 0
+
+
+def eliminate_redundant_sets(nodes):
+    """冗余开关消除: 阀门/泵已确定处于目标状态时删除重复的设置
+
+    循环体从未知状态开始分析; 循环后其中设置过的设备取循环体结束时的状态, 次数不确定时视为未知
+    """
+    return _eliminate_redundant_sets(nodes)[0]
+
+
+def _eliminate_redundant_sets(nodes):
+    """返回 (优化后的节点列表, 结束时已确定的设备状态)"""
+    result = []
+    state = {}  # 设备编号 -> 是否打开
+    for node in nodes:
+        op = node.step.op
+        if op == OP_VALVE or op == OP_PUMP:
+            on = bool(node.step.flags & Step.FLAG_ON)
+            if state.get(node.step.device) == on:
+                continue
+            state[node.step.device] = on
+        elif node.body is not None:
+            body, body_state = _eliminate_redundant_sets(node.body)
+            node = _with_body(node, body)
+            for device in _switched_devices(body):
+                state.pop(device, None)
+            if _runs_at_least_once(node):
+                state.update(body_state)
+        elif op == OP_UNKNOWN:
+            state.clear()
+        result.append(node)
+    return result, state
+
+
+# ---- 无效等待消除 ----
+
+_SETTLING_FLAGS = Step.FLAG_SYNC | Step.FLAG_WAIT
+
+
+def _unsettled_motors(nodes):
+    """循环体执行后可能仍在运动的电机, None表示无法确定"""
+    motors = set()
+    for node in _walk(nodes):
+        op = node.step.op
+        if op == OP_MOTOR:
+            if not node.step.flags & _SETTLING_FLAGS:
+                motors.add(node.step.device)
+        elif op != OP_VALVE and op != OP_PUMP and op != OP_DELAY and op != OP_MOTOR_WAIT and op != OP_LOOP:
+            return None
+    return motors
+
+
+def remove_dead_waits(nodes):
+    """无效等待消除: 电机已确定运动完成(同步执行、已立即等待或已等待过)时删除多余的电机等待"""
+    return _remove_dead_waits(nodes)[0]
+
+
+def _remove_dead_waits(nodes):
+    """返回 (优化后的节点列表, 结束时确定已停止的电机)"""
+    result = []
+    settled = set()  # 确定已停止的电机
+    for node in nodes:
+        op = node.step.op
+        if op == OP_MOTOR:
+            if node.step.flags & _SETTLING_FLAGS:
+                settled.add(node.step.device)
+            else:
+                settled.discard(node.step.device)
+        elif op == OP_MOTOR_WAIT:
+            if node.step.device in settled:
+                continue
+            settled.add(node.step.device)
+        elif node.body is not None:
+            body, body_settled = _remove_dead_waits(node.body)
+            node = _with_body(node, body)
+            moving = _unsettled_motors(body)
+            if moving is None:
+                settled.clear()
+            else:
+                settled -= moving
+            if _runs_at_least_once(node):
+                settled |= body_settled
+        elif op != OP_VALVE and op != OP_PUMP and op != OP_DELAY:
+            # 复合动作等可能驱动电机的步骤
+            settled.clear()
+        result.append(node)
+    return result, settled
+
+
+# ---- 延时合并 ----
+
+def coalesce_delays(nodes):
+    """延时合并: 连续的延时步骤合并为一个, 0ms的延时删除"""
+    result = []
+    for node in nodes:
+        step = node.step
+        if node.body is not None:
+            node = _with_body(node, coalesce_delays(node.body))
+        elif step.op == OP_DELAY and type(step.p1) is int:
+            if step.delay_ms == 0:
+                continue
+            prev = result[-1] if result else None
+            if prev is not None and prev.step.op == OP_DELAY and type(prev.step.p1) is int:
+                result[-1] = IRNode(Step(OP_DELAY, p1=prev.step.delay_ms + step.delay_ms), _merge_label(prev, node))
+                continue
+        result.append(node)
+    return result
+
+
+# ---- 电机并行调度 ----
+
+_CHAIN = -1  # 阀门、泵、延时和同步电机控制共用的顺序资源, 这些步骤之间保持原有顺序, 并作为异步电机步骤的屏障
+
+
+def _split_motor_wait(node):
+    """异步电机控制+立即等待 -> 启动节点和等待节点 (编号相同)
+
+    等待节点不指定超时, 并带有运动的命令和参数, 由后端按与立即等待相同的规则确定超时
+    """
+    step = node.step
+    start = Step(OP_MOTOR, step.device, step.command, (step.flags & ~Step.FLAG_WAIT) | Step.FLAG_WAIT_LATER,
+                 step.p1, step.p2, step.p3)
+    wait = Step(OP_MOTOR_WAIT, step.device, step.command, 0, step.p1, step.p2, step.p3)
+    return IRNode(start, node.label), IRNode(wait, node.label)
+
+
+def _resources(step):
+    op = step.op
+    if op == OP_MOTOR:
+        return (step.device, _CHAIN) if step.flags & Step.FLAG_SYNC else (step.device,)
+    if op == OP_MOTOR_WAIT:
+        return (step.device,)
+    if op == OP_DELAY:
+        return (_CHAIN,)
+    return step.device, _CHAIN
+
+
+def _is_chain(step):
+    """阀门、泵、延时和同步电机控制: 异步电机的启动和等待都不能越过这些步骤"""
+    return _CHAIN in _resources(step)
+
+
+def _is_async_start(step):
+    return step.op == OP_MOTOR and not step.flags & (Step.FLAG_SYNC | Step.FLAG_WAIT)
+
+
+def _schedule_segment(nodes):
+    """对不含循环和复合动作的一段步骤重新排序
+
+    依赖关系: 使用同一设备的步骤保持原有顺序; 阀门/泵/延时/同步电机控制是双向的屏障,
+    异步电机启动和等待只在相邻两个屏障之间、与其它电机的启动和等待重新排序 (液路动作执行时电机的位置不变)。
+    在此约束下异步电机启动尽早执行; 电机等待推迟到该电机下一次被使用之前, 没有后续使用时推迟到下一个屏障之前。
+    """
+    n = len(nodes)
+    if n < 2:
+        return nodes
+    successors = [[] for _ in range(n)]
+    pending = [0] * n
+    last = {}
+    since_barrier = []   # 上一个屏障之后的异步电机启动和等待
+
+    def depend(i, j):
+        if not successors[j] or successors[j][-1] != i:
+            successors[j].append(i)
+            pending[i] += 1
+
+    for i, node in enumerate(nodes):
+        for resource in _resources(node.step):
+            j = last.get(resource)
+            if j is not None:
+                depend(i, j)
+            last[resource] = i
+        if _is_chain(node.step):
+            for j in since_barrier:
+                depend(i, j)
+            since_barrier = []
+        else:
+            j = last.get(_CHAIN)
+            if j is not None:
+                depend(i, j)
+            since_barrier.append(i)
+
+    # 排序键: (类别, 期望位置); 异步启动为类别0, 其它为1; 等待的期望位置为该电机下一次使用之前
+    keys = [None] * n
+    next_use = {}
+    for i in range(n - 1, -1, -1):
+        step = nodes[i].step
+        if _is_async_start(step):
+            keys[i] = (0, i)
+        elif step.op == OP_MOTOR_WAIT:
+            keys[i] = (1, next_use.get(step.device, n) - 0.5)
+        else:
+            keys[i] = (1, i)
+        if step.op == OP_MOTOR or step.op == OP_MOTOR_WAIT:
+            next_use[step.device] = i
+
+    ready = [(keys[i], i) for i in range(n) if pending[i] == 0]
+    heapq.heapify(ready)
+    result = []
+    while ready:
+        _, i = heapq.heappop(ready)
+        result.append(nodes[i])
+        for j in successors[i]:
+            pending[j] -= 1
+            if pending[j] == 0:
+                heapq.heappush(ready, (keys[j], j))
+    return result
+
+
+def schedule_overlap(nodes):
+    """电机并行调度: 让互不相关的电机运动彼此重叠执行
+
+    异步电机控制的立即等待拆分为单独的等待节点, 然后在循环、复合动作等之间的每一段内重新排序
+    (见 _schedule_segment)。循环体单独调度, 每次循环结束前完成循环体内的全部等待。
+    """
+    result = []
+    segment = []
+    for node in nodes:
+        step = node.step
+        if node.body is not None or step.op not in (OP_VALVE, OP_PUMP, OP_DELAY, OP_MOTOR, OP_MOTOR_WAIT):
+            result.extend(_schedule_segment(segment))
+            segment = []
+            if node.body is not None:
+                node = _with_body(node, schedule_overlap(node.body))
+            result.append(node)
+        elif step.op == OP_MOTOR and step.flags & Step.FLAG_WAIT:
+            segment.extend(_split_motor_wait(node))
+        else:
+            segment.append(node)
+    result.extend(_schedule_segment(segment))
+    return result
+
+
+# ---- 电机等待合并 ----
+
+def group_motor_waits(nodes):
+    """等待合并: 连续两个以上(不同电机)的电机等待合并为一个共用截止时间的等待
+
+    合并后的节点为电机等待步骤, steps 为被合并的各个等待步骤 (同一电机只保留第一个)
+    """
+    result = []
+    run = []
+
+    def flush():
+        waits = {}
+        for node in run:
+            waits.setdefault(node.step.device, node.step)
+        if len(waits) >= 2:
+            step = Step(OP_MOTOR_WAIT, run[0].step.device, steps=tuple(waits.values()))
+            result.append(IRNode(step, _merge_label(run[0], run[-1])))
+        else:
+            result.extend(run)
+        run.clear()
+
+    for node in nodes:
+        if node.step.op == OP_MOTOR_WAIT and not node.step.steps:
+            run.append(node)
+            continue
+        flush()
+        if node.body is not None:
+            node = _with_body(node, group_motor_waits(node.body))
+        result.append(node)
+    flush()
+    return result
+
+
+def loop_depth(nodes):
+    """IR的最大循环嵌套层数 (复合动作按一层计), 后端据此声明各层的循环变量"""
+    depth = 0
+    for node in nodes:
+        if node.body is not None:
+            depth = max(depth, 1 + loop_depth(node.body))
+        elif node.step.op == OP_COMPOSITE:
+            depth = max(depth, 1)
+    return depth
+
+
+def has_grouped_waits(nodes):
+    """IR中是否有合并的电机等待 (后端据此输出等待辅助函数)"""
+    return any(node.step.op == OP_MOTOR_WAIT and node.step.steps for node in _walk(nodes))
+
+
+def has_delays(nodes):
+    """IR中是否有延时 (包括旧格式复合动作中的暂停), 启用截止时间延时时后端据此输出 sleep_until 辅助函数"""
+    return any(node.step.op == OP_DELAY or (node.step.op == OP_COMPOSITE and legacy_needle_motion(node.step.text))
+               for node in _walk(nodes))
+
+
+# ---- 阀门/泵批量开关 ----
+
+def batch_switches(nodes):
+    """批量开关: 连续两个以上的阀门/泵开关(中间没有延时、电机等步骤)合并为一次按位掩码的开关
+
+    合并后的节点为阀门控制步骤, steps 为被合并的各个开关步骤; 同一设备在一组中只能出现一次,
+    再次出现时开始新的一组, 保持该设备先后两次开关的效果
+    """
+    result = []
+    run = []
+
+    def flush():
+        if len(run) >= 2:
+            step = Step(OP_VALVE, run[0].step.device, steps=tuple(node.step for node in run))
+            result.append(IRNode(step, _merge_label(run[0], run[-1])))
+        else:
+            result.extend(run)
+        run.clear()
+
+    for node in nodes:
+        step = node.step
+        if (step.op == OP_VALVE or step.op == OP_PUMP) and not step.steps:
+            if any(other.step.device == step.device for other in run):
+                flush()
+            run.append(node)
+            continue
+        flush()
+        if node.body is not None:
+            node = _with_body(node, batch_switches(node.body))
+        result.append(node)
+    flush()
+    return result
+
+
+def batched_switch_devices(nodes):
+    """IR中批量开关用到的设备编号 (按首次出现的顺序), 后端据此输出位掩码定义"""
+    devices = {}
+    for node in _walk(nodes):
+        if node.step.op == OP_VALVE and node.step.steps:
+            for switch in node.step.steps:
+                devices.setdefault(switch.device, None)
+    return list(devices)
+
+
+# ---- 公共序列提取 ----
+
+def _loop_bodies(programs):
+    """各程序中(含嵌套)的循环体, 按循环节点内容去重: 循环键 -> [循环体, 出现次数]"""
+    bodies = {}
+    for nodes in programs:
+        for node in _walk(nodes):
+            if node.body is not None:
+                entry = bodies.setdefault(node.key(), [node.body, 0])
+                entry[1] += 1
+    return bodies
+
+
+def _select_sequences(sequences, weights, min_length, max_length, min_count):
+    """按哈希分组查找重复的窗口, 从长到短贪心选择收益为正的公共序列
+
+    sequences 为节点编号列表, weights 为各序列在生成代码中出现的次数;
+    返回 (选中的序列列表, 各序列中被替换的位置 {起点: 序列下标})
+    """
+    claimed = [bytearray(len(tokens)) for tokens in sequences]
+    starts = [{} for _ in sequences]
+    selected = []
+    for length in range(max_length, min_length - 1, -1):
+        windows = {}
+        for s, tokens in enumerate(sequences):
+            used = claimed[s]
+            # 窗口内有已替换位置时跳过: free[i] 为从i开始连续未替换的位置数
+            free = [0] * (len(tokens) + 1)
+            for i in range(len(tokens) - 1, -1, -1):
+                free[i] = 0 if used[i] else free[i + 1] + 1
+            for i in range(len(tokens) - length + 1):
+                if free[i] >= length:
+                    windows.setdefault(tuple(tokens[i:i + length]), []).append((s, i))
+
+        for window, places in windows.items():
+            if len(places) < 2 and weights[places[0][0]] < min_count:
+                continue
+            # 同一序列中互不重叠、且未被本轮先选中的序列占用的出现位置
+            chosen = []
+            count = 0
+            last = (-1, -1)
+            for s, i in places:
+                if (s == last[0] and i < last[1]) or any(claimed[s][i:i + length]):
+                    continue
+                chosen.append((s, i))
+                count += weights[s]
+                last = (s, i + length)
+            # 收益: 替换为调用后减少的步骤代码数 (公共序列本身输出一次, 每处调用计为一个步骤)
+            if count < min_count or count * length - length - count <= 0:
+                continue
+            index = len(selected)
+            selected.append(window)
+            for s, i in chosen:
+                claimed[s][i:i + length] = b"\x01" * length
+                starts[s][i] = index
+    return selected, starts
+
+
+def _outline_round(programs, min_length, max_length, min_count, names):
+    """一轮公共序列提取, 新的公共函数名依次取自names; 返回 (新的公共函数列表, 替换后的程序列表)"""
+    bodies = _loop_bodies(programs)
+    sequences = [list(nodes) for nodes in programs] + [entry[0] for entry in bodies.values()]
+    weights = [1] * len(programs) + [entry[1] for entry in bodies.values()]
+    ids = {}
+    tokens = [[ids.setdefault(node.key(), len(ids)) for node in nodes] for nodes in sequences]
+    selected, starts = _select_sequences(tokens, weights, min_length, max_length, min_count)
+    names = [next(names) for _ in selected]
+    loop_index = {key: len(programs) + k for k, key in enumerate(bodies)}
+    rewritten_loops = {}
+
+    def rewrite(s):
+        nodes = sequences[s]
+        result = []
+        i = 0
+        while i < len(nodes):
+            index = starts[s].get(i)
+            if index is not None:
+                replaced = nodes[i:i + len(selected[index])]
+                step = Step(OP_CALL, steps=tuple(node.step for node in replaced), text=names[index])
+                result.append(IRNode(step, _merge_label(replaced[0], replaced[-1])))
+                i += len(replaced)
+                continue
+            result.append(rewrite_loop(nodes[i]))
+            i += 1
+        return result
+
+    def rewrite_loop(node):
+        if node.body is None:
+            return node
+        key = node.key()
+        if key not in rewritten_loops:
+            rewritten_loops[key] = rewrite(loop_index[key])
+        return _with_body(node, rewritten_loops[key])
+
+    new_programs = [rewrite(s) for s in range(len(programs))]
+
+    # 公共函数体取第一处出现的步骤, 编号改为函数内的序号
+    first = {}
+    for s, places in enumerate(starts):
+        for i, index in places.items():
+            first.setdefault(index, (s, i))
+    helpers = []
+    for index, window in enumerate(selected):
+        s, i = first[index]
+        body = [rewrite_loop(node) for node in sequences[s][i:i + len(window)]]
+        helpers.append((names[index], [IRNode(node.step, str(k + 1), node.body) for k, node in enumerate(body)]))
+    return helpers, new_programs
+
+
+def outline_common_sequences(programs, min_length=3, max_length=16, min_count=2, prefix="liquid_seq_"):
+    """公共序列提取: 在多个程序(及其循环体)中查找重复出现的连续步骤, 提取为共用的函数
+
+    programs 为各流程的IR节点列表。按节点内容编号后, 对每个长度用哈希表对窗口分组,
+    从长到短贪心选择 出现次数*长度 > 长度+出现次数 的序列, 每轮耗时与步骤总数*max_length成正比;
+    之后把公共函数体也作为程序继续提取, 直到没有新的公共序列, 较长的公共函数中再调用较短的。
+    返回 (公共函数列表, 替换后的程序列表); 公共函数为 (函数名, IR节点列表), 按被调用者在前的顺序排列,
+    被替换的步骤改为调用节点: 操作码为 OP_CALL, text为函数名, steps为被替换的步骤
+    """
+    names = (f"{prefix}{k}" for k in itertools.count(1))
+    programs = list(programs)
+    helpers = []
+    while True:
+        new_helpers, rewritten = _outline_round(programs + [nodes for _, nodes in helpers],
+                                                min_length, max_length, min_count, names)
+        helpers = [(name, nodes) for (name, _), nodes in zip(helpers, rewritten[len(programs):])] + new_helpers
+        programs = rewritten[:len(programs)]
+        if not new_helpers:
+            break
+
+    # 被调用者在前: 公共函数中(包括循环体内)可能调用其它公共函数
+    bodies = dict(helpers)
+    order = []
+
+    def visit(name):
+        if name in order:
+            return
+        for node in _walk(bodies[name]):
+            if node.step.op == OP_CALL:
+                visit(node.step.text)
+        order.append(name)
+
+    for name, _ in helpers:
+        visit(name)
+
+    # 按输出顺序重新编号
+    renamed = {name: f"{prefix}{k + 1}" for k, name in enumerate(order)}
+
+    def rename(nodes):
+        result = []
+        for node in nodes:
+            if node.step.op == OP_CALL:
+                node = IRNode(Step(OP_CALL, steps=node.step.steps, text=renamed[node.step.text]), node.label)
+            elif node.body is not None:
+                node = _with_body(node, rename(node.body))
+            result.append(node)
+        return result
+
+    return [(renamed[name], rename(bodies[name])) for name in order], [rename(nodes) for nodes in programs]
+
+
+# 优化流水线 (按顺序执行): 先展开和删除循环, 再消除冗余步骤, 最后合并因删除而相邻的延时
+OPTIMIZATION_PASSES = (fold_loop_counts, eliminate_redundant_sets, remove_dead_waits, coalesce_delays)
+
+
+def optimize(nodes, passes=OPTIMIZATION_PASSES):
+    """依次执行优化遍, 返回新的IR节点列表 (不修改输入)"""
+    for optimization_pass in passes:
+        nodes = optimization_pass(nodes)
+    return nodes
+
+
+def lower(steps, optimized=False, overlap=False, group_waits=False, switch_masks=False, loops=False):
+    """步骤列表 -> 后端输出和时序仿真使用的IR: 依次为可选的循环发现、优化流水线、电机并行调度、等待合并和批量开关"""
+    nodes = build_ir(steps)
+    if loops:
+        nodes = discover_loops(nodes)
+    if optimized:
+        nodes = optimize(nodes)
+    if overlap:
+        nodes = schedule_overlap(nodes)
+    if group_waits:
+        nodes = group_motor_waits(nodes)
+    if switch_masks:
+        nodes = batch_switches(nodes)
+    return nodes
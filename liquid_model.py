@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+液路流程模型 - 步骤类型、设备定义、步骤(Step)与流程(Process)
+与save_process保存的JSON格式互转, 不依赖界面和代码生成后端
+"""
+
+import copy
+import json
+import math
+from datetime import datetime
+
+# 流程文件版本
+PROCESS_FILE_VERSION = "1.3_with_lua_and_loop_controls"
+
+# 步骤类型
+STEP_TYPES = [
+    "阀门控制", "泵控制", "延时", "电机控制", "电机等待", "循环", "复合动作"
+]
+
+# 循环内允许的步骤类型
+LOOP_STEP_TYPES = ["阀门控制", "泵控制", "延时", "电机控制", "电机等待", "循环"]
+
+# 设备选项列表 - 统一定义
+VALVE_OPTIONS = [
+    "SV1", "SV2", "SV3", "SV4", "SV5", "SV6",
+    "SV7", "SV8", "SV9", "SV10", "SV11", "SV12"
+]
+
+PUMP_OPTIONS = [
+    "隔膜泵Q1", "隔膜泵Q2", "隔膜泵Q3", "隔膜泵Q4",
+    "隔膜泵F1", "隔膜泵F2", "隔膜泵F3", "隔膜泵F4"
+]
+
+MOTOR_OPTIONS = [
+    "样本针柱塞泵", "试剂针柱塞泵", "特殊清洗液泵",
+    "样本针X轴", "样本针Y轴", "样本针Z轴",
+    "试剂针Y轴", "试剂针Z轴"
+]
+
+MOTOR_COMMANDS = ["复位", "步进移动", "速度移动", "停止"]
+
+# 设备配置映射
+DEVICE_MAPPING = {
+    # 阀门
+    "SV1": "VALVE_SV1", "SV2": "VALVE_SV2", "SV3": "VALVE_SV3",
+    "SV4": "VALVE_SV4", "SV5": "VALVE_SV5", "SV6": "VALVE_SV6",
+    "SV7": "VALVE_SV7", "SV8": "VALVE_SV8", "SV9": "VALVE_SV9",
+    "SV10": "VALVE_SV10", "SV11": "VALVE_SV11", "SV12": "VALVE_SV12",
+    # 隔膜泵
+    "隔膜泵Q1": "DIAPHRAGM_PUMP_Q1", "隔膜泵Q2": "DIAPHRAGM_PUMP_Q2",
+    "隔膜泵Q3": "DIAPHRAGM_PUMP_Q3", "隔膜泵Q4": "DIAPHRAGM_PUMP_Q4",
+    "隔膜泵F1": "DIAPHRAGM_PUMP_F1", "隔膜泵F2": "DIAPHRAGM_PUMP_F2",
+    "隔膜泵F3": "DIAPHRAGM_PUMP_F3", "隔膜泵F4": "DIAPHRAGM_PUMP_F4",
+    # 电机
+    "样本针柱塞泵": "MOTOR_NEEDLE_S_PUMP", "试剂针柱塞泵": "MOTOR_NEEDLE_R2_PUMP",
+    "特殊清洗液泵": "MOTOR_CLEARER_PUMP", "样本针X轴": "MOTOR_NEEDLE_S_X",
+    "样本针Y轴": "MOTOR_NEEDLE_S_Y", "样本针Z轴": "MOTOR_NEEDLE_S_Z",
+    "试剂针Y轴": "MOTOR_NEEDLE_R2_Y", "试剂针Z轴": "MOTOR_NEEDLE_R2_Z",
+}
+
+# Lua设备映射 (简化的Lua接口)
+LUA_DEVICE_MAPPING = {
+    # 阀门 - 使用Lua风格的命名
+    "SV1": "valve.sv1", "SV2": "valve.sv2", "SV3": "valve.sv3",
+    "SV4": "valve.sv4", "SV5": "valve.sv5", "SV6": "valve.sv6",
+    "SV7": "valve.sv7", "SV8": "valve.sv8", "SV9": "valve.sv9",
+    "SV10": "valve.sv10", "SV11": "valve.sv11", "SV12": "valve.sv12",
+    # 泵
+    "隔膜泵Q1": "pump.q1", "隔膜泵Q2": "pump.q2",
+    "隔膜泵Q3": "pump.q3", "隔膜泵Q4": "pump.q4",
+    "隔膜泵F1": "pump.f1", "隔膜泵F2": "pump.f2",
+    "隔膜泵F3": "pump.f3", "隔膜泵F4": "pump.f4",
+    # 电机
+    "样本针柱塞泵": "motor.needle_s_pump", "试剂针柱塞泵": "motor.needle_r2_pump",
+    "特殊清洗液泵": "motor.clearer_pump", "样本针X轴": "motor.needle_s_x",
+    "样本针Y轴": "motor.needle_s_y", "样本针Z轴": "motor.needle_s_z",
+    "试剂针Y轴": "motor.needle_r2_y", "试剂针Z轴": "motor.needle_r2_z",
+}
+
+# 电机命令映射
+C_MOTOR_COMMANDS = {"复位": "CMD_MOTOR_RST", "步进移动": "CMD_MOTOR_MOVE_STEP",
+                    "速度移动": "CMD_MOTOR_MOVE_SPEED", "停止": "CMD_MOTOR_STOP"}
+LUA_MOTOR_COMMANDS = {"复位": "reset", "步进移动": "move_step",
+                      "速度移动": "move_speed", "停止": "stop"}
+C_MOTOR_COMMAND_NAMES = [C_MOTOR_COMMANDS[name] for name in MOTOR_COMMANDS]
+LUA_MOTOR_COMMAND_NAMES = [LUA_MOTOR_COMMANDS[name] for name in MOTOR_COMMANDS]
+
+
+def make_func_name(process_name):
+    """将流程名称转换为合法的函数名"""
+    func_name = process_name.lower().replace(" ", "_").replace("-", "_")
+    func_name = "".join(c for c in func_name if c.isalnum() or c == "_")
+    if not func_name or func_name[0].isdigit():
+        func_name = "process_" + func_name
+    return func_name
+
+
+# 步骤操作码 (与STEP_TYPES顺序一致)
+OP_VALVE, OP_PUMP, OP_DELAY, OP_MOTOR, OP_MOTOR_WAIT, OP_LOOP, OP_COMPOSITE = range(len(STEP_TYPES))
+OP_UNKNOWN = -1
+OP_CALL = -2        # 调用公共步骤序列 (仅出现在生成的IR中)
+STEP_OPCODES = {name: op for op, name in enumerate(STEP_TYPES)}
+
+# 设备编号: 已知设备按选项顺序编号, 流程文件中出现的其它设备名在加载时追加
+DEVICE_NAMES = VALVE_OPTIONS + PUMP_OPTIONS + MOTOR_OPTIONS
+DEVICE_IDS = {name: i for i, name in enumerate(DEVICE_NAMES)}
+
+MOTOR_COMMAND_IDS = {name: i for i, name in enumerate(MOTOR_COMMANDS)}
+MOTOR_CMD_RESET, MOTOR_CMD_MOVE_STEP, MOTOR_CMD_MOVE_SPEED, MOTOR_CMD_STOP = range(len(MOTOR_COMMANDS))
+
+
+def device_id(name):
+    """设备名 -> 设备编号, 未知设备名分配新编号"""
+    dev = DEVICE_IDS.get(name)
+    if dev is None:
+        dev = DEVICE_IDS[name] = len(DEVICE_NAMES)
+        DEVICE_NAMES.append(name)
+    return dev
+
+
+def parse_number(value):
+    """将参数解析为整数, 无法解析时(如宏名)保留原值"""
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+
+# 复位命令param1为0时估算运动时间使用的步数
+DEFAULT_RESET_STEPS = 20000
+
+
+def motor_move_time_ms(steps, speed, acc):
+    """梯形速度曲线的运动时间(ms): steps为步数, speed为最大速度(步/s), acc为加速度(步/s²)
+
+    距离不足以加速到最大速度时按三角形曲线计算
+    """
+    steps = abs(steps)
+    if steps == 0 or speed <= 0 or acc <= 0:
+        return 0.0
+    if steps >= speed * speed / acc:
+        seconds = steps / speed + speed / acc
+    else:
+        seconds = 2 * math.sqrt(steps / acc)
+    return seconds * 1000
+
+
+# 电机等待超时的默认余量: 运动时间的比例余量和固定余量(ms)
+DEFAULT_TIMEOUT_MARGIN = 0.25
+DEFAULT_TIMEOUT_MARGIN_MS = 200
+
+
+def motor_timeout_ms(steps, speed, acc, margin=DEFAULT_TIMEOUT_MARGIN, margin_ms=DEFAULT_TIMEOUT_MARGIN_MS):
+    """电机等待超时(ms): 梯形曲线运动时间加上比例余量和固定余量, 向上取整"""
+    return math.ceil(motor_move_time_ms(steps, speed, acc) * (1 + margin) + margin_ms)
+
+
+def describe_step_dict(step):
+    """JSON格式步骤的单行描述"""
+    step_type = step["type"]
+    if step_type == "阀门控制":
+        return f"{step['device']} {step['action']}"
+    elif step_type == "泵控制":
+        return f"{step['device']} {step['action']}"
+    elif step_type == "延时":
+        return f"延时{step['time']}{step['unit']}"
+    elif step_type == "电机控制":
+        return f"{step['motor']} {step['command']} ({step.get('mode', '异步')})"
+    elif step_type == "电机等待":
+        return f"等待{step['motor']}完成"
+    elif step_type == "循环":
+        return f"循环{step['count']}次 ({len(step['steps'])}个步骤)"
+    elif step_type == "复合动作":
+        return f"复合动作: {' '.join(step['description'].splitlines())[:20]}..."
+    return "未知步骤"
+
+
+def get_step_description(step):
+    """步骤的单行描述, 用于列表显示和代码注释"""
+    if isinstance(step, dict):
+        return describe_step_dict(step)
+    return step.describe()
+
+
+class Step:
+    """紧凑的步骤表示
+
+    步骤类型为整数操作码, 设备为设备编号, 数值参数在加载时解析为整数。
+    与save_process的JSON格式可无损互转: 与界面生成格式不一致的步骤(如参数为数字、缺少字段)
+    在 to_dict 时按原样返回。步骤创建后视为不可变。
+
+    各类型使用的字段:
+        阀门控制/泵控制: device, FLAG_ON; 生成的IR中批量开关为阀门控制步骤, steps 为被合并的各个开关步骤
+        延时: p1=时间, FLAG_SECONDS
+        电机控制: device, command, p1~p3, FLAG_SYNC 时 timeout, 否则 FLAG_WAIT
+        电机等待: device, timeout; timeout为None时(仅出现在生成的IR中)按command和p1~p3的运动确定超时;
+            生成的IR中合并的电机等待 steps 为被合并的各个电机等待步骤
+        循环: p1=次数, steps
+        复合动作: text
+        调用公共步骤序列 (仅出现在生成的IR中): text=函数名, steps=被替换的步骤
+    """
+
+    __slots__ = ("op", "device", "command", "flags", "p1", "p2", "p3", "timeout", "steps", "text", "_src", "_key")
+
+    FLAG_ON = 1             # 阀门/泵 开
+    FLAG_SECONDS = 2        # 延时单位为s
+    FLAG_SYNC = 4           # 电机同步模式
+    FLAG_WAIT = 8           # 异步电机立即等待完成
+    FLAG_WAIT_LATER = 16    # 异步电机由后面单独的电机等待步骤等待完成 (并行调度生成的IR)
+
+    def __init__(self, op, device=-1, command=-1, flags=0, p1=0, p2=0, p3=0, timeout=None, steps=(), text=""):
+        self.op = op
+        self.device = device
+        self.command = command
+        self.flags = flags
+        self.p1 = p1
+        self.p2 = p2
+        self.p3 = p3
+        self.timeout = timeout
+        self.steps = steps
+        self.text = text
+        self._src = None
+        self._key = None
+
+    @classmethod
+    def from_dict(cls, data):
+        op = STEP_OPCODES.get(data.get("type"), OP_UNKNOWN)
+        step = cls(op)
+        if op == OP_VALVE or op == OP_PUMP:
+            step.device = device_id(data.get("device", ""))
+            step.flags = cls.FLAG_ON if data.get("action") == "开" else 0
+        elif op == OP_DELAY:
+            step.p1 = parse_number(data.get("time", 0))
+            step.flags = cls.FLAG_SECONDS if data.get("unit") == "s" else 0
+        elif op == OP_MOTOR:
+            step.device = device_id(data.get("motor", ""))
+            step.command = MOTOR_COMMAND_IDS.get(data.get("command"), -1)
+            step.p1 = parse_number(data.get("param1", "0"))
+            step.p2 = parse_number(data.get("param2", "20000"))
+            step.p3 = parse_number(data.get("param3", "50000"))
+            if data.get("mode", "异步") == "同步":
+                step.flags = cls.FLAG_SYNC
+                step.timeout = parse_number(data.get("timeout", "20000"))
+            elif data.get("wait_complete", True):
+                step.flags = cls.FLAG_WAIT
+        elif op == OP_MOTOR_WAIT:
+            step.device = device_id(data.get("motor", ""))
+            step.timeout = parse_number(data.get("timeout", "20000"))
+        elif op == OP_LOOP:
+            step.p1 = parse_number(data.get("count", "1"))
+            step.steps = tuple(cls.from_dict(s) for s in data.get("steps", []))
+        elif op == OP_COMPOSITE:
+            step.text = data.get("description", "")
+
+        # 与规范格式不一致时保留原始数据, 保证无损转换
+        if op == OP_UNKNOWN or step.to_dict() != data:
+            step._src = copy.deepcopy(data)
+        return step
+
+    def to_dict(self):
+        if self._src is not None:
+            return copy.deepcopy(self._src)
+        op = self.op
+        data = {"type": STEP_TYPES[op]}
+        if op == OP_VALVE or op == OP_PUMP:
+            data["device"] = DEVICE_NAMES[self.device]
+            data["action"] = "开" if self.flags & self.FLAG_ON else "关"
+        elif op == OP_DELAY:
+            data["time"] = str(self.p1)
+            data["unit"] = "s" if self.flags & self.FLAG_SECONDS else "ms"
+        elif op == OP_MOTOR:
+            data["motor"] = DEVICE_NAMES[self.device]
+            data["command"] = MOTOR_COMMANDS[self.command] if self.command >= 0 else ""
+            data["mode"] = "同步" if self.flags & self.FLAG_SYNC else "异步"
+            data["param1"] = str(self.p1)
+            data["param2"] = str(self.p2)
+            data["param3"] = str(self.p3)
+            if self.flags & self.FLAG_SYNC:
+                data["timeout"] = str(self.timeout)
+            else:
+                data["wait_complete"] = bool(self.flags & self.FLAG_WAIT)
+        elif op == OP_MOTOR_WAIT:
+            data["motor"] = DEVICE_NAMES[self.device]
+            data["timeout"] = str(self.timeout)
+        elif op == OP_LOOP:
+            data["count"] = str(self.p1)
+            data["steps"] = [s.to_dict() for s in self.steps]
+        elif op == OP_COMPOSITE:
+            data["description"] = self.text
+        return data
+
+    @property
+    def type_name(self):
+        return STEP_TYPES[self.op] if self.op >= 0 else self._src.get("type", "")
+
+    @property
+    def device_name(self):
+        return DEVICE_NAMES[self.device]
+
+    @property
+    def delay_ms(self):
+        return int(self.p1) * 1000 if self.flags & self.FLAG_SECONDS else int(self.p1)
+
+    def describe(self):
+        if self._src is not None:
+            return describe_step_dict(self._src)
+        op = self.op
+        if op == OP_VALVE or op == OP_PUMP:
+            if self.steps:
+                return "、".join(s.describe() for s in self.steps)
+            return f"{DEVICE_NAMES[self.device]} {'开' if self.flags & self.FLAG_ON else '关'}"
+        elif op == OP_DELAY:
+            return f"延时{self.p1}{'s' if self.flags & self.FLAG_SECONDS else 'ms'}"
+        elif op == OP_MOTOR:
+            command = MOTOR_COMMANDS[self.command] if self.command >= 0 else ""
+            return f"{DEVICE_NAMES[self.device]} {command} ({'同步' if self.flags & self.FLAG_SYNC else '异步'})"
+        elif op == OP_MOTOR_WAIT:
+            if self.steps:
+                return f"等待{'、'.join(DEVICE_NAMES[s.device] for s in self.steps)}完成"
+            return f"等待{DEVICE_NAMES[self.device]}完成"
+        elif op == OP_LOOP:
+            return f"循环{self.p1}次 ({len(self.steps)}个步骤)"
+        elif op == OP_CALL:
+            return f"调用{self.text} ({len(self.steps)}个步骤)"
+        return f"复合动作: {' '.join(self.text.splitlines())[:20]}..."
+
+    def key(self):
+        """步骤内容的可哈希键, 内容相同的步骤键相同"""
+        if self._key is None:
+            if self._src is not None:
+                self._key = repr(self._src)
+            else:
+                self._key = (self.op, self.device, self.command, self.flags, self.p1, self.p2, self.p3,
+                             self.timeout, self.text, tuple(s.key() for s in self.steps))
+        return self._key
+
+    def __eq__(self, other):
+        return isinstance(other, Step) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f"Step({self.to_dict()!r})"
+
+
+class Process:
+    """液路流程: 名称、描述和步骤(Step)列表, 与save_process保存的JSON格式互转"""
+
+    def __init__(self, name="", description="", steps=None):
+        self.name = name
+        self.description = description
+        self.steps = steps if steps is not None else []
+
+    @property
+    def display_name(self):
+        return self.name or "custom_process"
+
+    @property
+    def func_name(self):
+        return make_func_name(self.display_name)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("name", ""), data.get("description", ""),
+                   [Step.from_dict(step) for step in data.get("steps", [])])
+
+    def steps_to_dicts(self):
+        return [step.to_dict() for step in self.steps]
+
+    def normalized_json(self):
+        """仅包含影响生成结果的内容(不含保存时间等元数据)的规范化JSON"""
+        return json.dumps({"name": self.name, "description": self.description, "steps": self.steps_to_dicts()},
+                          ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "description": self.description,
+            "steps": self.steps_to_dicts(),
+            "created_time": datetime.now().isoformat(),
+            "version": PROCESS_FILE_VERSION
+        }
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+    def save(self, file_path):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+液路流程电机运动时间批量估算 - 基于NumPy的向量化计算
+从大量流程中提取全部电机控制步骤的参数列, 一次计算所有运动时间, 用于产能规划
+用法: python liquid_motion.py [--bins 分组数] [--simulate] 流程文件或目录...
+"""
+
+import argparse
+import sys
+import time
+
+from liquid_batch import collect_process_files
+from liquid_composite import compile_composite, legacy_needle_motion
+from liquid_ir import fold_constant
+from liquid_model import (
+    OP_MOTOR, OP_LOOP, OP_COMPOSITE, MOTOR_CMD_RESET, MOTOR_CMD_MOVE_STEP, MOTOR_CMD_STOP, DEFAULT_RESET_STEPS,
+    DEVICE_NAMES, Process, device_id,
+)
+from liquid_sim import COMPOSITE_ACC, COMPOSITE_MOTOR, COMPOSITE_SPEED, TimingSimulator, simulate
+
+# 可选导入numpy
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+def _require_numpy():
+    if not NUMPY_AVAILABLE:
+        raise RuntimeError("需要安装numpy库")
+
+
+class MotorColumns:
+    """全部电机控制步骤的参数列, 每个步骤一行
+
+    process: 所属流程的序号; motor: 设备编号; command: 命令编号(-1为未知);
+    steps/speed/acc: param1~param3, 不是数值的参数为NaN; count: 执行次数 (所在各层循环次数之积)
+    复合动作语言的复合动作按编译得到的步骤提取; 旧格式的"针下、上"动作每次下降/上升为一次步进移动,
+    使用与时序仿真相同的电机和运动参数
+    """
+
+    __slots__ = ("process_names", "process", "motor", "command", "steps", "speed", "acc", "count")
+
+    def __init__(self, process_names, process, motor, command, steps, speed, acc, count):
+        self.process_names = process_names
+        self.process = process
+        self.motor = motor
+        self.command = command
+        self.steps = steps
+        self.speed = speed
+        self.acc = acc
+        self.count = count
+
+    def __len__(self):
+        return len(self.process)
+
+    @classmethod
+    def from_processes(cls, processes, default_loop_count=1):
+        """从流程列表提取参数列; 循环次数不是常量时按default_loop_count计"""
+        _require_numpy()
+        nan = float("nan")
+        rows = ([], [], [], [], [], [], [])
+
+        def add(*values):
+            for column, value in zip(rows, values):
+                column.append(value)
+
+        def collect(steps, index, count):
+            for step in steps:
+                if step.op == OP_MOTOR:
+                    add(index, step.device, step.command, step.p1, step.p2, step.p3, count)
+                elif step.op == OP_LOOP:
+                    loops = fold_constant(step.p1)
+                    collect(step.steps, index, count * (loops if type(loops) is int else default_loop_count))
+                elif step.op == OP_COMPOSITE:
+                    compiled = compile_composite(step.text)
+                    if compiled is not None:
+                        collect(compiled, index, count)
+                        continue
+                    motion = legacy_needle_motion(step.text)
+                    if motion:
+                        pulses, repeats = (int(value) for value in motion)
+                        add(index, device_id(COMPOSITE_MOTOR), MOTOR_CMD_MOVE_STEP, pulses, COMPOSITE_SPEED,
+                            COMPOSITE_ACC, count * 2 * repeats)
+
+        names = []
+        for index, process in enumerate(processes):
+            names.append(process.display_name)
+            collect(process.steps, index, 1)
+
+        process, motor, command, steps, speed, acc, count = rows
+        numeric = [[value if type(value) is int else nan for value in column] for column in (steps, speed, acc)]
+        return cls(names,
+                   np.array(process, dtype=np.int32), np.array(motor, dtype=np.int32),
+                   np.array(command, dtype=np.int8),
+                   *(np.array(column, dtype=np.float64) for column in numeric),
+                   np.maximum(np.array(count, dtype=np.float64), 0))
+
+
+def move_times_ms(steps, speed, acc, command=None, reset_steps=DEFAULT_RESET_STEPS):
+    """向量化计算梯形/三角形速度曲线的运动时间(ms), 与 liquid_sim 的单步计算 (TimingSimulator._move_duration) 一致
+
+    参数为等长数组; 提供command时, param1为0的复位按reset_steps步计算, 停止命令按减速时间 speed/acc 计。
+    仿真器还按执行时电机的状态截短停止: 电机未在运动时为0, 剩余运动时间更短时取剩余时间; 这里不跟踪电机状态。
+    速度/加速度为NaN时按仿真器的默认值, 步数为NaN时按0步计
+    """
+    _require_numpy()
+    steps = np.nan_to_num(np.abs(np.asarray(steps, dtype=np.float64)), nan=0.0)
+    speed = np.nan_to_num(np.asarray(speed, dtype=np.float64), nan=TimingSimulator.DEFAULT_SPEED)
+    acc = np.nan_to_num(np.asarray(acc, dtype=np.float64), nan=TimingSimulator.DEFAULT_ACC)
+    if command is not None:
+        steps = np.where((command == MOTOR_CMD_RESET) & (steps == 0), reset_steps, steps)
+
+    valid = (speed > 0) & (acc > 0)
+    speed = np.where(valid, speed, 1.0)
+    acc = np.where(valid, acc, 1.0)
+    seconds = np.where(steps >= speed * speed / acc, steps / speed + speed / acc, 2 * np.sqrt(steps / acc))
+    if command is not None:
+        seconds = np.where(command == MOTOR_CMD_STOP, speed / acc, seconds)
+    return np.where(valid, seconds * 1000, 0.0)
+
+
+class MotionEstimate:
+    """批量估算结果
+
+    move_ms: 每个步骤一次运动的时间; per_process_ms: 各流程的电机运动总时间 (按执行次数累计);
+    per_motor_ms: 各电机(设备名)的运动总时间; utilization: 各电机运动时间占总时长的比例,
+    总时长为各流程运行时长之和 (未提供时为各流程运动总时间之和, 即各电机所占的运动时间份额);
+    histogram: (计数, 分组边界), 按执行次数加权; motor_histograms: 各电机按相同分组边界的计数
+    """
+
+    __slots__ = ("columns", "move_ms", "per_process_ms", "per_motor_ms", "utilization",
+                 "histogram", "motor_histograms", "unknown_params", "total_ms")
+
+    def __init__(self, columns, move_ms, per_process_ms, per_motor_ms, utilization,
+                 histogram, motor_histograms, unknown_params, total_ms):
+        self.columns = columns
+        self.move_ms = move_ms
+        self.per_process_ms = per_process_ms
+        self.per_motor_ms = per_motor_ms
+        self.utilization = utilization
+        self.histogram = histogram
+        self.motor_histograms = motor_histograms
+        self.unknown_params = unknown_params
+        self.total_ms = total_ms
+
+    def format_report(self, top=10):
+        columns = self.columns
+        lines = [f"{len(columns.process_names)} 个流程, {len(columns)} 个电机控制步骤, "
+                 f"执行 {int(columns.count.sum())} 次, 运动总时间 {self.per_process_ms.sum() / 1000:.3f}s"]
+        if self.unknown_params:
+            lines.append(f"⚠ {self.unknown_params} 个步骤的参数不是数值, 按默认参数估算")
+
+        lines.append("各电机运动时间:")
+        for name, ms in sorted(self.per_motor_ms.items(), key=lambda item: item[1], reverse=True):
+            lines.append(f"  {name:<12} {ms / 1000:12.3f}s  {self.utilization[name] * 100:6.2f}%")
+
+        lines.append(f"运动时间最长的{min(top, len(columns.process_names))}个流程:")
+        for index in np.argsort(-self.per_process_ms, kind="stable")[:top]:
+            lines.append(f"  {columns.process_names[index]:<24} {self.per_process_ms[index] / 1000:12.3f}s")
+
+        if not len(columns):
+            return "\n".join(lines)
+        counts, edges = self.histogram
+        lines.append("单次运动时间分布:")
+        peak = counts.max() if counts.max() > 0 else 1
+        for i, count in enumerate(counts):
+            bar = "#" * int(round(40 * count / peak))
+            lines.append(f"  {edges[i]:9.1f} - {edges[i + 1]:9.1f}ms {int(count):8d} {bar}")
+        return "\n".join(lines)
+
+
+def estimate(columns, bins=20, process_durations_ms=None, reset_steps=DEFAULT_RESET_STEPS):
+    """对参数列一次性计算运动时间和各项统计, 返回 MotionEstimate"""
+    _require_numpy()
+    move_ms = move_times_ms(columns.steps, columns.speed, columns.acc, columns.command, reset_steps)
+    weighted = move_ms * columns.count
+    process_count = len(columns.process_names)
+    per_process_ms = np.bincount(columns.process, weights=weighted, minlength=process_count)
+
+    motors, motor_index = np.unique(columns.motor, return_inverse=True)
+    motor_ms = np.bincount(motor_index, weights=weighted, minlength=len(motors))
+    if process_durations_ms is not None:
+        total_ms = float(np.sum(process_durations_ms))
+    else:
+        total_ms = float(per_process_ms.sum())
+    names = [DEVICE_NAMES[motor] for motor in motors]
+    per_motor_ms = dict(zip(names, motor_ms.tolist()))
+    utilization = {name: (ms / total_ms if total_ms > 0 else 0.0) for name, ms in per_motor_ms.items()}
+
+    counts, edges = np.histogram(move_ms, bins=bins, weights=columns.count)
+    motor_histograms = {}
+    if len(motors):
+        motor_counts, _, _ = np.histogram2d(motor_index, move_ms, bins=[np.arange(len(motors) + 1), edges],
+                                            weights=columns.count)
+        motor_histograms = dict(zip(names, motor_counts))
+
+    unknown = int(np.count_nonzero(np.isnan(columns.steps) | np.isnan(columns.speed) | np.isnan(columns.acc)))
+    return MotionEstimate(columns, move_ms, per_process_ms, per_motor_ms, utilization,
+                          (counts, edges), motor_histograms, unknown, total_ms)
+
+
+def estimate_processes(processes, bins=20, durations=False, **params):
+    """提取参数列并估算; durations=True 时用时序仿真得到各流程运行时长, 电机利用率相对运行时长计算"""
+    columns = MotorColumns.from_processes(processes)
+    process_durations_ms = [simulate(process, **params).total_ms for process in processes] if durations else None
+    return estimate(columns, bins, process_durations_ms)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="liquid_motion", description="批量估算流程库中全部电机控制步骤的运动时间")
+    parser.add_argument("paths", nargs="+", help="流程JSON文件或目录")
+    parser.add_argument("--bins", type=int, default=20, help="运动时间分布的分组数 (默认20)")
+    parser.add_argument("--top", type=int, default=10, help="列出运动时间最长的流程数 (默认10)")
+    parser.add_argument("--simulate", action="store_true",
+                        help="时序仿真各流程的运行时长, 电机利用率相对运行时长计算 (较慢)")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if not NUMPY_AVAILABLE:
+        print("❌ 需要安装numpy库", file=sys.stderr)
+        return 1
+    processes = []
+    failures = 0
+    for file_path, _ in collect_process_files(args.paths):
+        try:
+            processes.append(Process.load(file_path))
+        except Exception as e:
+            failures += 1
+            print(f"❌ {file_path}: {type(e).__name__}: {e}", file=sys.stderr)
+    if not processes:
+        print("❌ 未找到流程文件", file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    columns = MotorColumns.from_processes(processes)
+    extracted = time.perf_counter()
+    durations = [simulate(process).total_ms for process in processes] if args.simulate else None
+    simulated = time.perf_counter()
+    result = estimate(columns, args.bins, durations)
+    finished = time.perf_counter()
+
+    print(result.format_report(args.top))
+    print(f"\n提取 {(extracted - start) * 1000:.1f}ms, "
+          + (f"仿真 {(simulated - extracted) * 1000:.1f}ms, " if args.simulate else "")
+          + f"计算 {(finished - simulated) * 1000:.1f}ms")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+液路流程时序仿真 - 在虚拟时钟上执行流程, 估算运行时长
+用法: python liquid_sim.py [-O] [--overlap] [--group-waits] [--switch-masks] [--deadline-delays] [--all] 流程文件...
+"""
+
+import argparse
+import heapq
+import sys
+
+from liquid_composite import legacy_needle_motion
+from liquid_ir import fold_constant, lower
+from liquid_model import (
+    OP_VALVE, OP_PUMP, OP_DELAY, OP_MOTOR, OP_MOTOR_WAIT, OP_LOOP, OP_COMPOSITE,
+    MOTOR_CMD_RESET, MOTOR_CMD_STOP, DEFAULT_RESET_STEPS, Process, Step, device_id, motor_move_time_ms,
+)
+
+# 复合动作"针下、上"使用的电机和运动参数 (与生成的Lua代码一致)
+COMPOSITE_MOTOR = "样本针Z轴"
+COMPOSITE_SPEED = 20000
+COMPOSITE_ACC = 50000
+COMPOSITE_PAUSE_MS = 500
+
+
+class StepTiming:
+    """一次步骤执行的时间记录 (ms)
+
+    label 为步骤编号, 循环体内的步骤带有迭代序号, 如 "5[3].2" 为步骤5第3次循环的第2个步骤;
+    异步电机控制的 end 为运动完成时间; pred 为决定本步骤开始或结束时间的前一条记录的索引, -1表示无
+    """
+
+    __slots__ = ("label", "step", "start", "end", "pred")
+
+    def __init__(self, label, step, start, end, pred):
+        self.label = label
+        self.step = step
+        self.start = start
+        self.end = end
+        self.pred = pred
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return f"StepTiming({self.label!r}, {self.start:.3f}, {self.end:.3f})"
+
+
+class SimulationResult:
+    """仿真结果: 总时长、各步骤的执行记录、关键路径和警告"""
+
+    __slots__ = ("total_ms", "timings", "critical_path", "max_concurrent_moves", "warnings")
+
+    def __init__(self, total_ms, timings, critical_path, max_concurrent_moves, warnings):
+        self.total_ms = total_ms
+        self.timings = timings
+        self.critical_path = critical_path
+        self.max_concurrent_moves = max_concurrent_moves
+        self.warnings = warnings
+
+    def format_report(self, show_all=False):
+        lines = [f"总时长 {self.total_ms / 1000:.3f}s, 执行 {len(self.timings)} 个步骤, "
+                 f"最多 {self.max_concurrent_moves} 个电机同时运动"]
+        title, timings = ("全部步骤:", self.timings) if show_all else ("关键路径:", self.critical_path)
+        lines.append(title)
+        for timing in timings:
+            lines.append(f"  {timing.start / 1000:10.3f}s - {timing.end / 1000:10.3f}s  "
+                         f"步骤 {timing.label}: {timing.step.describe()}")
+        for warning in self.warnings:
+            lines.append(f"⚠ {warning}")
+        return "\n".join(lines)
+
+
+class TimingSimulator:
+    """离散事件时序仿真
+
+    流程按顺序执行, 程序时钟只在步骤耗时处前进; 异步电机运动的完成作为事件放入最小堆,
+    电机等待直接跳到对应运动的完成时间, 因此耗时只与执行的步骤数有关, 与流程时长无关。
+
+    模型参数:
+        valve_latency_ms / pump_latency_ms: 阀门/泵开关的响应时间
+        command_latency_ms: 下发电机命令的耗时
+        reset_steps: 复位命令param1为0时按此步数估算运动时间
+        default_loop_count: 循环次数不是常量(如宏名)时按此次数仿真
+    电机运动时间按param1(步数)、param2(速度)、param3(加速度)的梯形速度曲线计算,
+    电机仍在运动时收到的新运动命令在当前运动完成后开始。
+    """
+
+    DEFAULT_SPEED = 20000
+    DEFAULT_ACC = 50000
+
+    def __init__(self, valve_latency_ms=20.0, pump_latency_ms=50.0, command_latency_ms=0.0,
+                 reset_steps=DEFAULT_RESET_STEPS, default_loop_count=1):
+        self.valve_latency_ms = valve_latency_ms
+        self.pump_latency_ms = pump_latency_ms
+        self.command_latency_ms = command_latency_ms
+        self.reset_steps = reset_steps
+        self.default_loop_count = default_loop_count
+
+    def simulate(self, process, optimized=False, overlap=False, group_waits=False, switch_masks=False,
+                 deadline_delays=False):
+        """仿真流程; optimized/overlap/group_waits/switch_masks/deadline_delays 与 CodeGenerator 的同名选项相同,
+        仿真对应生成代码的执行顺序"""
+        return self.run(lower(process.steps, optimized, overlap, group_waits, switch_masks), deadline_delays)
+
+    def run(self, nodes, deadline_delays=False):
+        """仿真IR节点列表, 返回 SimulationResult; deadline_delays=True 时延时等待到截止时间 (见 CodeGenerator)"""
+        self._deadline_delays = deadline_delays
+        self._anchor = 0.0   # 截止时间延时的截止时间
+        self._timings = []
+        self._warnings = []
+        self._warned = set()
+        self._now = 0.0
+        self._last = -1
+        self._busy = {}      # 电机编号 -> (运动完成时间, 记录索引)
+        self._events = []    # 运动完成事件最小堆: (完成时间, 记录索引, 电机编号)
+        self._moving = 0     # 正在运动的电机数
+        self._max_moving = 0
+
+        self._run_nodes(nodes, "")
+
+        total = self._now
+        last = self._last
+        while self._events:
+            end, index, _ = heapq.heappop(self._events)
+            if end >= total:
+                total, last = end, index
+        return SimulationResult(total, self._timings, self._critical_path(last), self._max_moving, self._warnings)
+
+    def _critical_path(self, index):
+        path = []
+        while index >= 0:
+            timing = self._timings[index]
+            # 执行过循环体的循环记录由循环体内的记录代替
+            if timing.step.op != OP_LOOP or timing.pred < index:
+                path.append(timing)
+            index = timing.pred
+        path.reverse()
+        return path
+
+    def _warn(self, node, label, message):
+        if id(node) not in self._warned:
+            self._warned.add(id(node))
+            self._warnings.append(f"步骤 {label}: {message}")
+
+    def _record(self, label, step, start, end, pred):
+        self._timings.append(StepTiming(label, step, start, end, pred))
+        return len(self._timings) - 1
+
+    def _advance(self, label, step, duration):
+        """顺序执行的步骤: 程序时钟前进duration"""
+        timings = self._timings
+        start = self._now
+        self._now = end = start + duration
+        timings.append(StepTiming(label, step, start, end, self._last))
+        self._last = len(timings) - 1
+
+    def _run_nodes(self, nodes, prefix):
+        for node in nodes:
+            label = prefix + node.label
+            step = node.step
+            op = step.op
+            if op == OP_VALVE and step.steps:
+                # 批量开关: 一次操作, 响应时间按其中最慢的设备
+                self._advance(label, step, max(self.pump_latency_ms if s.op == OP_PUMP else self.valve_latency_ms
+                                               for s in step.steps))
+            elif op == OP_VALVE:
+                self._advance(label, step, self.valve_latency_ms)
+            elif op == OP_PUMP:
+                self._advance(label, step, self.pump_latency_ms)
+            elif op == OP_DELAY:
+                if type(step.p1) is not int:
+                    self._warn(node, label, f"延时时间 {step.p1} 不是数值, 按0ms计")
+                    self._advance(label, step, 0.0)
+                elif self._deadline_delays:
+                    # 等待到截止时间, 之前步骤的耗时计入延时
+                    self._anchor += step.delay_ms
+                    self._advance(label, step, max(self._anchor - self._now, 0.0))
+                else:
+                    self._advance(label, step, step.delay_ms)
+            elif op == OP_MOTOR:
+                self._run_motor(node, label)
+            elif op == OP_MOTOR_WAIT:
+                self._wait_motor(label, step, [wait.device for wait in step.steps] or [step.device])
+            elif op == OP_LOOP:
+                self._run_loop(node, label)
+            elif op == OP_COMPOSITE:
+                self._run_composite(node, label)
+            else:
+                self._warn(node, label, "未知步骤类型, 按0ms计")
+                self._advance(label, step, 0.0)
+
+    def _move_duration(self, node, label):
+        step = node.step
+        steps, speed, acc = step.p1, step.p2, step.p3
+        if type(speed) is not int or type(acc) is not int or type(steps) is not int:
+            self._warn(node, label, "电机参数不是数值, 按默认参数估算")
+            speed = speed if type(speed) is int else self.DEFAULT_SPEED
+            acc = acc if type(acc) is int else self.DEFAULT_ACC
+            steps = steps if type(steps) is int else 0
+        if step.command == MOTOR_CMD_STOP:
+            return speed / acc * 1000 if speed > 0 and acc > 0 else 0.0
+        if step.command == MOTOR_CMD_RESET and steps == 0:
+            steps = self.reset_steps
+        return motor_move_time_ms(steps, speed, acc)
+
+    def _start_move(self, label, step, motor, duration, stop=False):
+        """下发电机运动命令, 返回运动完成时间"""
+        start = self._now
+        issue = start + self.command_latency_ms
+        begin, pred = issue, self._last
+        busy = self._busy
+        events = self._events
+
+        # 处理已完成的运动事件; 被停止或排队代替的旧运动已不计入运动中的电机数
+        while events and events[0][0] <= issue:
+            _, i, m = heapq.heappop(events)
+            if busy[m][1] == i:
+                self._moving -= 1
+
+        current = busy.get(motor)
+        if current is not None and current[0] > issue:
+            self._moving -= 1
+            if stop:
+                duration = min(duration, current[0] - issue)
+            else:
+                begin, pred = current
+        elif stop:
+            duration = 0.0
+        end = begin + duration
+        index = self._record(label, step, start, end, pred)
+        busy[motor] = (end, index)
+        heapq.heappush(events, (end, index, motor))
+        self._moving += 1
+        if self._moving > self._max_moving:
+            self._max_moving = self._moving
+
+        self._now = issue
+        self._last = index
+        return end
+
+    def _run_motor(self, node, label):
+        step = node.step
+        duration = self._move_duration(node, label)
+        end = self._start_move(label, step, step.device, duration, step.command == MOTOR_CMD_STOP)
+        if step.flags & (Step.FLAG_SYNC | Step.FLAG_WAIT):
+            self._now = self._anchor = end
+
+    def _wait_motor(self, label, step, motors):
+        """等待motors中的全部电机运动完成 (合并的等待有多个电机)"""
+        start = self._now
+        end, pred = start, self._last
+        for motor in motors:
+            busy = self._busy.get(motor)
+            if busy is not None and busy[0] > end:
+                end, pred = busy
+        self._now = self._anchor = end
+        self._last = self._record(label, step, start, end, pred)
+
+    def _run_loop(self, node, label):
+        count = fold_constant(node.step.p1)
+        if type(count) is not int:
+            self._warn(node, label, f"循环次数 {count} 不是常量, 按{self.default_loop_count}次仿真")
+            count = self.default_loop_count
+        index = self._record(label, node.step, self._now, self._now, self._last)
+        for k in range(1, count + 1):
+            self._run_nodes(node.body, f"{label}[{k}].")
+        timing = self._timings[index]
+        timing.end = self._now
+        if self._last > index:
+            timing.pred = self._last
+        self._last = index
+
+    def _run_composite(self, node, label):
+        motion = legacy_needle_motion(node.step.text)
+        if not motion:
+            self._warn(node, label, "复合动作未实现, 按0ms计")
+            self._advance(label, node.step, 0.0)
+            return
+        pulses, repeats = (int(value) for value in motion)
+
+        # 每次下降/上升: 异步运动, 暂停500ms后等待运动完成
+        stroke = motor_move_time_ms(pulses, COMPOSITE_SPEED, COMPOSITE_ACC)
+        duration = 2 * repeats * max(stroke, COMPOSITE_PAUSE_MS)
+        self._now = self._anchor = self._start_move(label, node.step, device_id(COMPOSITE_MOTOR), duration)
+
+
+def simulate(process, optimized=False, overlap=False, group_waits=False, switch_masks=False, deadline_delays=False,
+             **params):
+    """按默认(或指定的)模型参数仿真流程"""
+    return TimingSimulator(**params).simulate(process, optimized, overlap, group_waits, switch_masks, deadline_delays)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="liquid_sim", description="估算液路流程的运行时长和关键路径")
+    parser.add_argument("paths", nargs="+", help="流程JSON文件")
+    parser.add_argument("-O", "--optimize", action="store_true", help="仿真优化后的流程 (同liquid_batch -O)")
+    parser.add_argument("--overlap", action="store_true", help="仿真电机并行调度后的流程 (同liquid_batch --overlap)")
+    parser.add_argument("--group-waits", action="store_true",
+                        help="仿真合并电机等待后的流程 (同liquid_batch --group-waits)")
+    parser.add_argument("--switch-masks", action="store_true",
+                        help="仿真阀门/泵批量开关后的流程 (同liquid_batch --switch-masks)")
+    parser.add_argument("--deadline-delays", action="store_true",
+                        help="仿真截止时间延时 (同liquid_batch --deadline-delays)")
+    parser.add_argument("--all", action="store_true", help="列出全部步骤的执行时间, 而不只是关键路径")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    failures = 0
+    for path in args.paths:
+        try:
+            process = Process.load(path)
+        except Exception as e:
+            failures += 1
+            print(f"❌ {path}: {type(e).__name__}: {e}", file=sys.stderr)
+            continue
+        result = simulate(process, args.optimize, args.overlap, args.group_waits, args.switch_masks,
+                          args.deadline_delays)
+        print(f"{path} ({process.display_name})")
+        print(result.format_report(args.all))
+        print()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+界面启动时间基准 - 在新的解释器进程中测量导入耗时分布和首个窗口显示的时间
+用法: python liquid_startup.py [-n 次数] [--top N] [--record 记录文件] [--budget-ms 毫秒]
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# 启动耗时较大、界面启动时不应导入的可选依赖
+HEAVY_MODULES = ("pandas", "numpy", "openpyxl")
+
+# 子进程: 创建主窗口并完成第一次绘制后输出标记
+_WINDOW_SCRIPT = """
+import tkinter as tk
+import liquid
+root = tk.Tk()
+app = liquid.LiquidProcessGenerator(root)
+root.update()
+print("@window", flush=True)
+root.destroy()
+"""
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _run(args):
+    env = dict(os.environ, PYTHONIOENCODING="utf-8")
+    return subprocess.Popen([sys.executable] + args, cwd=_HERE, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=True, encoding="utf-8", errors="replace")
+
+
+def parse_importtime(text):
+    """-X importtime 的输出 -> {模块: (自身耗时us, 累计耗时us)}"""
+    modules = {}
+    for line in text.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        modules[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+    return modules
+
+
+def profile_imports(module="liquid"):
+    """在新进程中导入module, 返回 {模块: (自身耗时us, 累计耗时us)}"""
+    proc = _run(["-X", "importtime", "-c", f"import {module}"])
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(err.strip().splitlines()[-1] if err.strip() else f"导入{module}失败")
+    return parse_importtime(err)
+
+
+def time_to_first_window():
+    """从启动解释器到主窗口第一次绘制完成的时间(ms)"""
+    start = time.perf_counter()
+    proc = _run(["-c", _WINDOW_SCRIPT])
+    elapsed = None
+    for line in proc.stdout:
+        if line.startswith("@window"):
+            elapsed = (time.perf_counter() - start) * 1000
+    _, err = proc.communicate()
+    if elapsed is None:
+        raise RuntimeError(err.strip().splitlines()[-1] if err.strip() else "窗口未能显示")
+    return elapsed
+
+
+def measure(runs=3):
+    """运行runs次, 返回各项耗时的中位数和最后一次的导入耗时分布"""
+    import_ms, window_ms = [], []
+    window_error = None
+    modules = {}
+    for _ in range(runs):
+        modules = profile_imports()
+        import_ms.append(modules["liquid"][1] / 1000)
+        if window_error is None:
+            try:
+                window_ms.append(time_to_first_window())
+            except RuntimeError as e:
+                window_error = str(e)
+    return {
+        "import_ms": statistics.median(import_ms),
+        "window_ms": statistics.median(window_ms) if window_ms else None,
+        "window_error": window_error,
+        "heavy_modules": [name for name in HEAVY_MODULES if name in modules],
+        "modules": modules,
+    }
+
+
+def format_report(result, top=15):
+    lines = [f"导入liquid: {result['import_ms']:.1f}ms"]
+    if result["window_ms"] is not None:
+        lines.append(f"首个窗口: {result['window_ms']:.1f}ms (含解释器启动)")
+    else:
+        lines.append(f"首个窗口: 无法测量 ({result['window_error']})")
+    if result["heavy_modules"]:
+        lines.append(f"⚠ 启动时导入了 {', '.join(result['heavy_modules'])}")
+    lines.append(f"自身耗时最长的{top}个模块:")
+    ranked = sorted(result["modules"].items(), key=lambda item: item[1][0], reverse=True)[:top]
+    for name, (self_us, cumulative_us) in ranked:
+        lines.append(f"  {self_us / 1000:8.2f}ms  {cumulative_us / 1000:8.2f}ms  {name}")
+    return "\n".join(lines)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="liquid_startup", description="测量界面启动的导入耗时和首个窗口显示时间")
+    parser.add_argument("-n", "--runs", type=int, default=3, help="运行次数, 取中位数 (默认3)")
+    parser.add_argument("--top", type=int, default=15, help="列出自身耗时最长的模块数 (默认15)")
+    parser.add_argument("--record", metavar="文件", help="追加一行JSON记录 (时间、耗时和导入最慢的模块), 用于跟踪变化")
+    parser.add_argument("--budget-ms", type=float,
+                        help="首个窗口(无法显示窗口时为导入)耗时超过该值或导入了重量级依赖时返回非零")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    try:
+        result = measure(max(args.runs, 1))
+    except RuntimeError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    print(format_report(result, args.top))
+
+    if args.record:
+        slowest = sorted(result["modules"].items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "import_ms": round(result["import_ms"], 1),
+            "window_ms": None if result["window_ms"] is None else round(result["window_ms"], 1),
+            "heavy_modules": result["heavy_modules"],
+            "slowest_modules": {name: self_us for name, (self_us, _) in slowest},
+        }
+        with open(args.record, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    if args.budget_ms is not None:
+        elapsed = result["window_ms"] if result["window_ms"] is not None else result["import_ms"]
+        if elapsed > args.budget_ms or result["heavy_modules"]:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
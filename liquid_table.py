@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+表驱动C后端 - 流程输出为 static const 步骤记录表, 由共用的解释函数 liquid_run_table 执行
+生成代码的大小不再随步骤数增长: 每个步骤只占一条记录, 故障检查等代码只在解释函数中出现一次
+"""
+
+from liquid_composite import legacy_needle_motion
+from liquid_ir import build_ir
+from liquid_model import (
+    OP_VALVE, OP_PUMP, OP_DELAY, OP_MOTOR, OP_MOTOR_WAIT, OP_LOOP, OP_COMPOSITE, C_MOTOR_COMMAND_NAMES, Step,
+)
+
+# 解释函数的头文件和源文件, 与各流程的输出放在同一目录
+C_TABLE_HEADER_FILE = "liquid_table.h"
+C_TABLE_SOURCE_FILE = "liquid_table.c"
+
+C_TABLE_HEADER = """/* 液路流程步骤表解释器 (由液路代码生成器生成) */
+#ifndef LIQUID_TABLE_H
+#define LIQUID_TABLE_H
+
+/* 步骤记录操作码 */
+#define LIQUID_OP_NOP           0
+#define LIQUID_OP_VALVE         1   /* valve_set(device, ON/OFF) */
+#define LIQUID_OP_VALVE_MASK    2   /* valve_set_mask(p1, p2) */
+#define LIQUID_OP_DELAY         3   /* 延时p1 ms, LIQUID_F_ANCHORED时按截止时间 */
+#define LIQUID_OP_MOVE_SYNC     4   /* 同步电机控制, 超时timeout */
+#define LIQUID_OP_MOVE_ASYNC    5   /* 异步电机控制, LIQUID_F_WAIT时立即等待完成 */
+#define LIQUID_OP_WAIT          6   /* 等待电机完成 */
+#define LIQUID_OP_LOOP          7   /* 循环开始: counters[depth] = p1, 次数不大于0时跳到p2 */
+#define LIQUID_OP_END           8   /* 循环结束: --counters[depth] 大于0时跳到p1 */
+
+/* 步骤记录标志 */
+#define LIQUID_F_ON             0x01    /* 阀门/泵 开 */
+#define LIQUID_F_WAIT           0x02    /* 异步电机立即等待完成 */
+#define LIQUID_F_SAME_DEADLINE  0x04    /* 与前一条电机等待共用截止时间 (合并的电机等待) */
+#define LIQUID_F_FAULT_Z        0x08    /* 故障模块为 MODULE_FAULT_NEEDLE_S_Z, 否则为 MODULE_FAULT_NEEDLE_S_PUMP */
+#define LIQUID_F_ANCHORED       0x10    /* 延时等待到截止时间: 上一个截止时间加p1, 之前步骤的耗时计入延时;
+                                           截止时间从开始执行时取, 电机等待等阻塞步骤之后重新取当前时间 */
+
+typedef struct {
+    unsigned char op;       /* LIQUID_OP_* */
+    unsigned char flags;    /* LIQUID_F_* */
+    unsigned char command;  /* 电机命令 */
+    unsigned char depth;    /* 循环层数 (循环计数器下标) */
+    short device;
+    long p1;
+    long p2;
+    long p3;
+    long timeout;
+} liquid_step_t;
+
+/* 顺序执行count条步骤记录; counters为循环计数器, 长度不小于最大循环层数 */
+void liquid_run_table(const liquid_step_t *table, int count, long *counters);
+
+#endif
+"""
+
+C_TABLE_SOURCE = """/* 液路流程步骤表解释器 (由液路代码生成器生成) */
+#include <unistd.h>     /* usleep */
+
+/* 固件接口: valve_set、valve_set_mask、get_time、motor_move_ctl_*、motor_timedwait、FAULT_CHECK_*、ON/OFF 等,
+   与流程代码使用的相同。编译时以 -DLIQUID_FIRMWARE_H='"固件头文件.h"' 指定, 未指定时包含 liquid_firmware.h */
+#ifdef LIQUID_FIRMWARE_H
+#include LIQUID_FIRMWARE_H
+#else
+#include "liquid_firmware.h"
+#endif
+
+#include "liquid_table.h"
+
+#define LIQUID_FAULT_MODULE(s) \\
+    (((s)->flags & LIQUID_F_FAULT_Z) ? (void *)MODULE_FAULT_NEEDLE_S_Z : (void *)MODULE_FAULT_NEEDLE_S_PUMP)
+
+static void liquid_table_wait(const liquid_step_t *s, unsigned long long deadline)
+{
+    unsigned long long now = get_time();
+
+    FAULT_CHECK_START(MODULE_FAULT_LEVEL2);
+    if (motor_timedwait(s->device, now < deadline ? (long)(deadline - now) : 0) != 0) {
+        LOG("liquid_circuit: motor wait timeout!\\n");
+        FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, LIQUID_FAULT_MODULE(s));
+    }
+    FAULT_CHECK_END();
+}
+
+void liquid_run_table(const liquid_step_t *table, int count, long *counters)
+{
+    unsigned long long start = 0;
+    unsigned long long deadline = 0;
+    unsigned long long anchor = get_time();
+    int pc = 0;
+
+    while (pc < count) {
+        const liquid_step_t *s = &table[pc++];
+
+        switch (s->op) {
+        case LIQUID_OP_VALVE:
+            valve_set(s->device, (s->flags & LIQUID_F_ON) ? ON : OFF);
+            break;
+        case LIQUID_OP_VALVE_MASK:
+            valve_set_mask((unsigned long)s->p1, (unsigned long)s->p2);
+            break;
+        case LIQUID_OP_DELAY:
+            if (s->flags & LIQUID_F_ANCHORED) {
+                unsigned long long now = get_time();
+
+                anchor += s->p1;
+                if (now < anchor) {
+                    usleep((anchor - now) * 1000);
+                }
+            } else {
+                usleep(s->p1 * 1000);
+            }
+            break;
+        case LIQUID_OP_MOVE_SYNC:
+            if (motor_move_ctl_sync(s->device, s->command, s->p1, s->p2, s->p3, s->timeout) < 0) {
+                LOG("liquid_circuit: motor sync operation failed\\n");
+                FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, LIQUID_FAULT_MODULE(s));
+            }
+            anchor = get_time();
+            break;
+        case LIQUID_OP_MOVE_ASYNC:
+            FAULT_CHECK_START(MODULE_FAULT_LEVEL2);
+            if (motor_move_ctl_async(s->device, s->command, s->p1, s->p2, s->p3) < 0) {
+                LOG("liquid_circuit: motor async operation failed\\n");
+                FAULT_CHECK_DEAL(FAULT_NEEDLE_S, MODULE_FAULT_LEVEL2, LIQUID_FAULT_MODULE(s));
+            }
+            FAULT_CHECK_END();
+            if (s->flags & LIQUID_F_WAIT) {
+                liquid_table_wait(s, get_time() + s->timeout);
+                anchor = get_time();
+            }
+            break;
+        case LIQUID_OP_WAIT:
+            /* 合并的电机等待共用截止时间: 各等待超时的最大值 */
+            if (!(s->flags & LIQUID_F_SAME_DEADLINE)) {
+                start = get_time();
+                deadline = start + s->timeout;
+            } else if (start + s->timeout > deadline) {
+                deadline = start + s->timeout;
+            }
+            liquid_table_wait(s, deadline);
+            anchor = get_time();
+            break;
+        case LIQUID_OP_LOOP:
+            counters[s->depth] = s->p1;
+            if (s->p1 <= 0) {
+                pc = (int)s->p2;
+            }
+            break;
+        case LIQUID_OP_END:
+            if (--counters[s->depth] > 0) {
+                pc = (int)s->p1;
+            }
+            break;
+        default:
+            break;
+        }
+    }
+}
+"""
+
+# 记录字段顺序, 与 liquid_step_t 一致
+_FIELDS = ("op", "flags", "command", "depth", "device", "p1", "p2", "p3", "timeout")
+
+
+def runtime_files():
+    """解释函数的 {文件名: 内容}, 表驱动输出需要与之一起编译"""
+    return {C_TABLE_HEADER_FILE: C_TABLE_HEADER, C_TABLE_SOURCE_FILE: C_TABLE_SOURCE}
+
+
+class StepTable:
+    """由IR节点列表构建的步骤记录表
+
+    records 为 (注释行列表, 字段列表) 的列表, 字段为C初始化表达式;
+    循环展开为 LIQUID_OP_LOOP / LIQUID_OP_END 两条跳转记录, max_depth 为最大循环层数
+    """
+
+    def __init__(self, generator, nodes):
+        self.generator = generator
+        self.records = []
+        self.max_depth = 0
+        self._depth = 0
+        self._comments = []
+        self.add_nodes(nodes)
+        # 最后一条记录之后的注释 (如未实现的复合动作)
+        self.trailing_comments = self._comments
+
+    def add(self, op, flags=(), command="0", device="0", p1=0, p2=0, p3=0, timeout=0):
+        fields = [op, " | ".join(flags) or "0", command, str(self._depth), device, str(p1), str(p2), str(p3),
+                  str(timeout)]
+        self.records.append((self._comments, fields))
+        self._comments = []
+        return len(self.records) - 1
+
+    def add_loop(self, count, add_body):
+        start = self.add("LIQUID_OP_LOOP", p1=count)
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        add_body()
+        self._depth -= 1
+        end = self.add("LIQUID_OP_END", p1=start + 1)
+        self.records[start][1][_FIELDS.index("p2")] = str(end + 1)
+
+    def add_delay(self, ms):
+        flags = ("LIQUID_F_ANCHORED",) if self.generator.deadline_delays else ()
+        self.add("LIQUID_OP_DELAY", flags, p1=ms)
+
+    def add_nodes(self, nodes):
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        generator = self.generator
+        step = node.step
+        op = step.op
+        self._comments.append(f"步骤 {node.label}: {step.describe()}")
+
+        if (op == OP_VALVE or op == OP_PUMP) and step.steps:
+            masks = ([], [])
+            for switch in step.steps:
+                masks[not switch.flags & Step.FLAG_ON].append(f"{generator.c_device(switch.device)}_MASK")
+            on_mask, off_mask = (" | ".join(mask) or "0" for mask in masks)
+            self.add("LIQUID_OP_VALVE_MASK", p1=on_mask, p2=off_mask)
+
+        elif op == OP_VALVE or op == OP_PUMP:
+            flags = ("LIQUID_F_ON",) if step.flags & Step.FLAG_ON else ()
+            self.add("LIQUID_OP_VALVE", flags, device=generator.c_device(step.device))
+
+        elif op == OP_DELAY:
+            self.add_delay(step.delay_ms)
+
+        elif op == OP_MOTOR:
+            device = generator.c_device(step.device)
+            command = C_MOTOR_COMMAND_NAMES[step.command] if step.command >= 0 else "CMD_MOTOR_RST"
+            params = {"p1": step.p1, "p2": step.p2, "p3": step.p3}
+            if step.flags & Step.FLAG_SYNC:
+                self.add("LIQUID_OP_MOVE_SYNC", (), command, device, timeout=step.timeout, **params)
+            elif step.flags & Step.FLAG_WAIT:
+                self.add("LIQUID_OP_MOVE_ASYNC", ("LIQUID_F_WAIT",), command, device,
+                         timeout=generator.motor_wait_timeout(step, "MOTOR_DEFAULT_TIMEOUT"), **params)
+            else:
+                self.add("LIQUID_OP_MOVE_ASYNC", (), command, device, **params)
+
+        elif op == OP_MOTOR_WAIT:
+            for k, wait in enumerate(step.steps or (step,)):
+                self.add("LIQUID_OP_WAIT", ("LIQUID_F_SAME_DEADLINE",) if k else (),
+                         device=generator.c_device(wait.device),
+                         timeout=generator.wait_timeout(wait, "MOTOR_DEFAULT_TIMEOUT"))
+
+        elif op == OP_LOOP:
+            body = node.body if node.body is not None else build_ir(step.steps)
+            self.add_loop(step.p1, lambda: self.add_nodes(body))
+
+        elif op == OP_COMPOSITE:
+            motion = legacy_needle_motion(step.text)
+            if motion:
+                pulses, repeats = motion
+                self.add_loop(repeats, lambda: self._add_needle_pulse(pulses))
+            else:
+                self._comments.append("TODO: 实现复合动作逻辑")
+
+    def _add_needle_pulse(self, pulses):
+        for distance in (pulses, f"-{pulses}"):
+            self.add("LIQUID_OP_MOVE_ASYNC", ("LIQUID_F_FAULT_Z",), "CMD_MOTOR_MOVE_STEP", "MOTOR_NEEDLE_S_Z",
+                     distance, "NEEDLE_S_Z_REMOVE_SPEED", "NEEDLE_S_Z_REMOVE_ACC")
+            self.add_delay(500)
+            self.add("LIQUID_OP_WAIT", ("LIQUID_F_FAULT_Z",), device="MOTOR_NEEDLE_S_Z",
+                     timeout="MOTOR_DEFAULT_TIMEOUT")
+
+
+def emit_c_table_function(generator, process, nodes, w):
+    """输出表驱动的C函数: 步骤记录表和调用 liquid_run_table 的函数"""
+    table = StepTable(generator, nodes)
+    records = table.records or [(["空流程"], ["LIQUID_OP_NOP", "0", "0", "0", "0", "0", "0", "0", "0"])]
+    process_name = process.display_name
+    table_name = f"{process.func_name}_steps"
+
+    w.write(f"/* {process.description or process_name} */\n")
+    w.write(f"#include \"{C_TABLE_HEADER_FILE}\"\n\n")
+    generator.emit_c_switch_masks(nodes, w)
+    w.write(f"static const liquid_step_t {table_name}[] = {{\n")
+    with w.indented():
+        for index, (comments, fields) in enumerate(records):
+            for comment in comments:
+                w.line(f"/* {comment} */")
+            w.line(f"{{{', '.join(fields)}}},  /* {index} */")
+        for comment in table.trailing_comments:
+            w.line(f"/* {comment} */")
+    w.write("};\n\n")
+
+    counters = "counters" if table.max_depth else "0"
+    w.write(f"void {process.func_name}(void)\n{{\n")
+    with w.indented():
+        if table.max_depth:
+            w.line(f"long counters[{table.max_depth}];")
+            w.line()
+        w.line("LOG(\"%llu\", get_time());")
+        w.line(f"LOG(\"liquid_circuit: {process_name} start\\n\");")
+        w.line(f"liquid_run_table({table_name}, sizeof({table_name}) / sizeof({table_name}[0]), {counters});")
+        w.line(f"LOG(\"liquid_circuit: {process_name} end\\n\");")
+    w.write("}\n")
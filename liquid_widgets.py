@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+液路流程配置工具的自定义控件
+"""
+
+import tkinter as tk
+from tkinter import ttk
+import tkinter.font as tkfont
+
+
+class VirtualListView(ttk.Frame):
+    """只绘制可见行的列表视图, 用于包含大量步骤的流程
+
+    行内容不保存在控件中, 而是按需通过 row_text(索引) 取得, 因此
+    滚动、选择和刷新的开销只与可见行数有关, 与总行数无关。
+    提供与 tk.Listbox 相同的 curselection/selection_set/see 接口。
+    """
+
+    SELECT_BACKGROUND = "#3874d8"
+    SELECT_FOREGROUND = "white"
+    BACKGROUND = "white"
+    FOREGROUND = "black"
+
+    def __init__(self, master, count, row_text, height=8, font=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.count = count          # 返回总行数
+        self.row_text = row_text    # 返回指定行的显示文本
+        self.font = tkfont.Font(font=font) if font else tkfont.nametofont("TkDefaultFont")
+        self.row_height = self.font.metrics("linespace") + 2
+
+        self.canvas = tk.Canvas(self, height=height * self.row_height, background=self.BACKGROUND,
+                                highlightthickness=1, takefocus=1)
+        self.canvas.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+
+        self.top = 0            # 第一个可见行的索引
+        self.selected = None    # 选中行的索引
+        self._total = 0
+        self._full_rows = height  # 完整显示的行数
+        self._slots = []        # 每个可见位置的 (背景矩形, 文本) 画布对象
+        self._drawn = []        # 每个可见位置当前显示的 (行索引, 文本, 是否选中)
+
+        self.canvas.bind("<Configure>", self._on_configure)
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<MouseWheel>", self._on_mousewheel)
+        self.canvas.bind("<Button-4>", lambda e: self._scroll_units(-3))
+        self.canvas.bind("<Button-5>", lambda e: self._scroll_units(3))
+        self.canvas.bind("<Up>", lambda e: self._move_selection(-1))
+        self.canvas.bind("<Down>", lambda e: self._move_selection(1))
+
+    # ---- Listbox兼容接口 ----
+
+    def curselection(self):
+        if self.selected is not None and self.selected < self._total:
+            return (self.selected,)
+        return ()
+
+    def selection_set(self, index):
+        old = self.selected
+        self.selected = index
+        self._redraw_rows(index, index)
+        if old is not None and old != index:
+            self._redraw_rows(old, old)
+
+    def selection_clear(self, *args):
+        old = self.selected
+        self.selected = None
+        if old is not None:
+            self._redraw_rows(old, old)
+
+    def see(self, index):
+        visible = self.visible_rows()
+        if index < self.top:
+            self._set_top(index)
+        elif index >= self.top + visible:
+            self._set_top(index - visible + 1)
+
+    def yview(self, *args):
+        if not args:
+            return self._fractions()
+        if args[0] == "moveto":
+            self._set_top(int(float(args[1]) * self._total))
+        elif args[0] == "scroll":
+            amount = int(args[1])
+            if args[2] == "pages":
+                amount *= self.visible_rows()
+            self._set_top(self.top + amount)
+
+    # ---- 刷新 ----
+
+    def refresh(self, first=0):
+        """行数或第first行之后的内容发生变化时调用, 只重绘受影响的可见行"""
+        self._total = self.count()
+        if self.selected is not None and self.selected >= self._total:
+            self.selected = None
+        self._set_top(self.top, force_from=first)
+
+    def refresh_rows(self, first, last):
+        """第first到第last行(含)的内容发生变化时调用"""
+        self._redraw_rows(first, last, force=True)
+
+    def visible_rows(self):
+        return self._full_rows
+
+    # ---- 内部实现 ----
+
+    def _fractions(self):
+        if self._total == 0:
+            return 0.0, 1.0
+        return self.top / self._total, min(1.0, (self.top + self.visible_rows()) / self._total)
+
+    def _set_top(self, top, force_from=None):
+        top = max(0, min(top, self._total - self.visible_rows()))
+        if top != self.top:
+            self.top = top
+            force_from = 0
+        if force_from is not None:
+            self._redraw_rows(max(force_from, self.top), self.top + len(self._slots) - 1, force=True)
+        self.scrollbar.set(*self._fractions())
+
+    def _redraw_rows(self, first, last, force=False):
+        first = max(first, self.top)
+        last = min(last, self.top + len(self._slots) - 1)
+        for index in range(first, last + 1):
+            slot = index - self.top
+            if index < self._total:
+                state = (index, self.row_text(index) if force or self._drawn[slot][0] != index
+                         else self._drawn[slot][1], index == self.selected)
+            else:
+                state = (None, "", False)
+            if state == self._drawn[slot]:
+                continue
+            rect, text = self._slots[slot]
+            selected = state[2]
+            self.canvas.itemconfigure(rect, fill=self.SELECT_BACKGROUND if selected else self.BACKGROUND)
+            self.canvas.itemconfigure(text, text=state[1],
+                                      fill=self.SELECT_FOREGROUND if selected else self.FOREGROUND)
+            self._drawn[slot] = state
+
+    def _on_configure(self, event):
+        # 画布大小变化时调整可见位置的数量, 已有画布对象重复使用
+        self._full_rows = max(1, event.height // self.row_height)
+        needed = max(1, -(-event.height // self.row_height))
+        while len(self._slots) < needed:
+            y = len(self._slots) * self.row_height
+            rect = self.canvas.create_rectangle(0, y, event.width, y + self.row_height,
+                                                outline="", fill=self.BACKGROUND)
+            text = self.canvas.create_text(4, y + 1, anchor=tk.NW, font=self.font, fill=self.FOREGROUND)
+            self._slots.append((rect, text))
+            self._drawn.append((None, "", False))
+        while len(self._slots) > needed:
+            for item in self._slots.pop():
+                self.canvas.delete(item)
+            self._drawn.pop()
+        for slot, (rect, text) in enumerate(self._slots):
+            y = slot * self.row_height
+            self.canvas.coords(rect, 0, y, event.width, y + self.row_height)
+        self._total = self.count()
+        self._set_top(self.top, force_from=0)
+
+    def _on_click(self, event):
+        self.canvas.focus_set()
+        index = self.top + event.y // self.row_height
+        if index < self._total:
+            self.selection_set(index)
+            self.event_generate("<<ListboxSelect>>")
+
+    def _on_mousewheel(self, event):
+        return self._scroll_units(int(-1*(event.delta/120)) * 3)
+
+    def _scroll_units(self, amount):
+        self._set_top(self.top + amount)
+        return "break"
+
+    def _move_selection(self, delta):
+        if self._total == 0:
+            return "break"
+        index = 0 if self.selected is None else max(0, min(self._total - 1, self.selected + delta))
+        self.selection_set(index)
+        self.see(index)
+        self.event_generate("<<ListboxSelect>>")
+        return "break"